@@ -24,6 +24,9 @@ PADRAO_REFERENCIA = re.compile(r"(19|20)\d{2}[-_]?(0[1-9]|1[0-2])")
 
 TEMPO_ESPERA_COPIA = 2  # segundos
 
+TAMANHO_BLOCO_DOWNLOAD = 1024 * 1024  # 1 MB
+TENTATIVAS_DOWNLOAD = 5
+
 # ================= LOG =================
 
 logging.basicConfig(
@@ -47,6 +50,51 @@ def extrair_zip(zip_path, destino):
     with zipfile.ZipFile(zip_path, "r") as zip_ref:
         zip_ref.extractall(destino)
 
+def baixar_arquivo(url, destino):
+    """Baixa em blocos para destino.part, retomando com Range/If-Range se a conexão cair"""
+    parcial = destino.with_name(destino.name + ".part")
+    parcial.unlink(missing_ok=True)
+    etag = None
+    total = None
+
+    for tentativa in range(1, TENTATIVAS_DOWNLOAD + 1):
+        inicio = parcial.stat().st_size if parcial.exists() else 0
+        headers = dict(HEADERS)
+        if inicio and etag:
+            headers["Range"] = f"bytes={inicio}-"
+            headers["If-Range"] = etag
+
+        try:
+            with requests.get(url, headers=headers, stream=True, timeout=(30, 300)) as r:
+                if r.status_code == 206:
+                    modo = "ab"
+                    total = int(r.headers["Content-Range"].rsplit("/", 1)[1])
+                elif r.status_code == 200:
+                    # Servidor ignorou o Range ou o arquivo mudou: recomeça do zero
+                    modo = "wb"
+                    total = int(r.headers["Content-Length"]) if "Content-Length" in r.headers else None
+                else:
+                    r.raise_for_status()
+                    raise Exception(f"Resposta inesperada no download: HTTP {r.status_code}")
+
+                etag = r.headers.get("ETag")
+                with open(parcial, modo) as f:
+                    for bloco in r.iter_content(TAMANHO_BLOCO_DOWNLOAD):
+                        f.write(bloco)
+
+            if total is None or parcial.stat().st_size >= total:
+                parcial.replace(destino)
+                return
+            logging.warning(f"⚠️ Download incompleto ({parcial.stat().st_size}/{total} bytes)")
+        except requests.RequestException as e:
+            if tentativa == TENTATIVAS_DOWNLOAD:
+                raise
+            logging.warning(f"⚠️ Falha no download (tentativa {tentativa}): {e}")
+
+        time.sleep(min(2 ** tentativa, 30))
+
+    raise Exception(f"Download incompleto após {TENTATIVAS_DOWNLOAD} tentativas")
+
 def processar_zip(caminho_zip):
     nome = caminho_zip.name
     logging.info(f"📄 Arquivo detectado: {nome}")
@@ -90,9 +138,7 @@ def processar_zip(caminho_zip):
     caminho_zip_final = pasta_destino / "DANFE-XML.zip"
 
     logging.info(f"📥 Baixando ZIP final: {zip_final}")
-    r = requests.get(f"{DOWNLOAD_URL}/{zip_final}", timeout=300)
-    with open(caminho_zip_final, "wb") as f:
-        f.write(r.content)
+    baixar_arquivo(f"{DOWNLOAD_URL}/{zip_final}", caminho_zip_final)
 
     logging.info(f"💾 ZIP salvo em: {caminho_zip_final}")
 
@@ -1,5 +1,8 @@
-from flask import Flask, render_template, request, jsonify, send_file, send_from_directory
+from flask import Flask, Request, g, render_template, request, jsonify, send_file, send_from_directory
 from flask_cors import CORS
+from werkzeug.datastructures import FileStorage
+from werkzeug.exceptions import HTTPException
+from werkzeug.middleware.proxy_fix import ProxyFix
 import os
 import zipfile
 import shutil
@@ -12,6 +15,22 @@ import logging
 import sys
 from datetime import datetime
 import tempfile
+import csv
+import io
+import hashlib
+import json
+import time
+import uuid
+import codecs
+import threading
+import queue
+import multiprocessing
+import bisect
+import glob
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
 from functools import wraps
 
 
@@ -31,7 +50,29 @@ logger = logging.getLogger(__name__)
 # ========================================
 # INICIALIZAÇÃO DA APLICAÇÃO
 # ========================================
+class RequestUploadDireto(Request):
+    """
+    Grava cada arquivo do multipart direto na pasta do lote (request.pasta_upload),
+    em blocos, em vez do spool temporário do Werkzeug seguido de arquivo.save().
+    """
+    pasta_upload = None
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.pasta_upload is None:
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
+        nome = limpar_nome_arquivo(os.path.basename(filename or 'arquivo'))
+        fd, caminho = tempfile.mkstemp(dir=self.pasta_upload, prefix='upload_', suffix=f'_{nome}')
+        os.close(fd)
+        return open(caminho, 'w+b')
+
 app = Flask(__name__)
+app.request_class = RequestUploadDireto
+
+# Proxies reversos confiáveis na frente da aplicação: só os X-Forwarded-For deles definem o IP do cliente
+PROXY_HOPS = int(os.getenv('PROXY_HOPS', 0))
+if PROXY_HOPS > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_HOPS)
 
 # Configurar CORS com segurança
 ALLOWED_ORIGINS = os.getenv('ALLOWED_ORIGINS', '*').split(',')
@@ -40,8 +81,9 @@ logger.info(f"🔒 CORS configurado para: {ALLOWED_ORIGINS}")
 CORS(app, resources={
     r"/*": {
         "origins": ALLOWED_ORIGINS,
-        "methods": ["GET", "POST", "OPTIONS", "DELETE"],
-        "allow_headers": ["Content-Type"],
+        "methods": ["GET", "POST", "PUT", "OPTIONS", "DELETE"],
+        "allow_headers": ["Content-Type", "X-Chunk-SHA256", "Range", "If-Range", "If-None-Match"],
+        "expose_headers": ["ETag", "Accept-Ranges", "Content-Range", "Content-Length"],
         "max_age": 3600
     }
 })
@@ -59,6 +101,41 @@ logger.info(f"🌍 Ambiente: {'PRODUÇÃO' if IS_PRODUCTION else 'DESENVOLVIMENT
 logger.info(f"📁 Upload folder: {UPLOAD_FOLDER}")
 logger.info(f"📁 Output folder: {TEMP_OUTPUT}")
 
+# Pool de processos para renderização dos DANFEs
+CPUS_DISPONIVEIS = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+# Cada worker do gunicorn tem seu pool: o padrão divide as CPUs entre eles (WEB_CONCURRENCY, lido também pelo gunicorn)
+GUNICORN_WORKERS = max(int(os.getenv('WEB_CONCURRENCY', 1)), 1)
+RENDER_WORKERS = int(os.getenv('RENDER_WORKERS', max(CPUS_DISPONIVEIS // GUNICORN_WORKERS, 1)))
+RENDER_MP_CONTEXT = os.getenv('RENDER_MP_CONTEXT', 'spawn')
+RENDER_JANELA = int(os.getenv('RENDER_JANELA', RENDER_WORKERS * 4))
+RENDER_AUTOTESTE = os.getenv('RENDER_AUTOTESTE', '1') != '0'
+# Limite de XMLs em andamento no pool somando todos os lotes do worker
+DOCUMENTOS_EM_VOO = int(os.getenv('DOCUMENTOS_EM_VOO', RENDER_JANELA))
+_documentos_em_voo = threading.BoundedSemaphore(max(DOCUMENTOS_EM_VOO, 1))
+# ZIPs com muitos XMLs são lidos e analisados no pool, em faixas de membros
+EXTRACAO_PARALELA_MIN = int(os.getenv('EXTRACAO_PARALELA_MIN', 2000))
+EXTRACAO_BLOCO = int(os.getenv('EXTRACAO_BLOCO', 500))
+# ZIP/RAR dentro de ZIP/RAR: abertos em memória até esta profundidade (0 = ignorados)
+ARQUIVOS_ANINHADOS_PROFUNDIDADE = int(os.getenv('ARQUIVOS_ANINHADOS_PROFUNDIDADE', 3))
+ARQUIVOS_ANINHADOS_MAX_MB = int(os.getenv('ARQUIVOS_ANINHADOS_MAX_MB', 500))
+# Proteção contra zip bomb: total descompactado do lote e razão de compressão por membro
+DESCOMPACTADO_MAX_MB = int(os.getenv('DESCOMPACTADO_MAX_MB', 4096))
+RAZAO_COMPRESSAO_MAX = int(os.getenv('RAZAO_COMPRESSAO_MAX', 200))
+
+# Nível de compressão por tipo no ZIP de resultado (0 = ZIP_STORED)
+ZIP_NIVEL_PDF = int(os.getenv('ZIP_NIVEL_PDF', 0))
+ZIP_NIVEL_XML = int(os.getenv('ZIP_NIVEL_XML', 6))
+
+# Saída dos PDFs: 'individual' ({chave}.pdf por NF-e), 'destinatario' (um PDF por pasta) ou 'lote' (um PDF só)
+MODOS_PDF = ('individual', 'destinatario', 'lote')
+PDF_MODO_PADRAO = os.getenv('PDF_MODO_PADRAO', 'individual')
+
+# Cache de PDFs renderizados (chave de acesso + hash do XML), com limite de tamanho
+CACHE_FOLDER = os.getenv('CACHE_FOLDER', '/tmp/danfe_cache' if IS_PRODUCTION else 'danfe_cache')
+CACHE_MAX_MB = int(os.getenv('CACHE_MAX_MB', 1024))
+logger.info(f"📁 Cache de DANFEs: {CACHE_FOLDER if CACHE_MAX_MB > 0 else 'desabilitado'}")
+logger.info(f"⚙️ Workers de renderização: {RENDER_WORKERS}")
+
 # Tentar importar rarfile (biblioteca para .RAR)
 try:
     import rarfile
@@ -69,6 +146,15 @@ except ImportError:
     logger.warning("⚠️ rarfile não instalado - arquivos .RAR não serão suportados")
     logger.warning("   Para habilitar: pip install rarfile")
 
+# PDF unificado (um PDF por destinatário ou por lote) depende do pypdf
+try:
+    from pypdf import PdfReader, PdfWriter
+    PYPDF_AVAILABLE = True
+except ImportError:
+    PYPDF_AVAILABLE = False
+    logger.warning("⚠️ pypdf não instalado - saída em PDF unificado não será suportada")
+    logger.warning("   Para habilitar: pip install pypdf")
+
 # ========================================
 # FUNÇÕES AUXILIARES
 # ========================================
@@ -80,6 +166,7 @@ def validar_cnpj_api(f):
 
         # Acesso via site (sem header) → permitido
         if not cnpj:
+            g.cnpj = None
             return f(*args, **kwargs)
 
         cnpj = re.sub(r"\D", "", cnpj)
@@ -89,6 +176,7 @@ def validar_cnpj_api(f):
             return jsonify({"erro": "CNPJ não autorizado"}), 403
 
         logger.info(f"🔐 Acesso autorizado para CNPJ: {cnpj}")
+        g.cnpj = cnpj
         return f(*args, **kwargs)
 
     return decorated
@@ -111,23 +199,96 @@ def carregar_cnpjs_autorizados():
 
 CNPJS_AUTORIZADOS = carregar_cnpjs_autorizados()
 
-def is_xml_nfe(xml_path):
+NFE_NS = {'nfe': 'http://www.portalfiscal.inf.br/nfe'}
+REGEX_ENCODING_XML = re.compile(rb'^\s*<\?xml[^>]*?encoding\s*=\s*["\']([A-Za-z0-9._-]+)["\']')
+
+class DocumentoXML(namedtuple('DocumentoXML', ['nome_arquivo', 'conteudo', 'encoding', 'is_nfe', 'nome', 'documento', 'chave',
+                                               'emissao', 'valor', 'origem'], defaults=(None, None, None))):
+    """XML lido e analisado uma única vez, pronto para a renderização (origem: membro do upload)"""
+    __slots__ = ()
+
+    @property
+    def texto(self):
+        return self.conteudo.decode(self.encoding)
+
+def detectar_encoding_xml(conteudo):
+    """Detecta o encoding pelo BOM ou pela declaração <?xml ... encoding="..."?>"""
+    if conteudo.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if conteudo.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'utf-16'
+
+    match = REGEX_ENCODING_XML.match(conteudo[:256])
+    return match.group(1).decode('ascii').lower() if match else 'utf-8'
+
+def decodificar_xml(conteudo):
+    """Decodifica o XML com o encoding declarado, caindo para utf-8/iso-8859-1"""
+    for encoding in (detectar_encoding_xml(conteudo), 'utf-8', 'iso-8859-1'):
+        try:
+            return conteudo.decode(encoding), encoding
+        except (UnicodeDecodeError, LookupError):
+            continue
+
+def dados_destinatario(root, nome_arquivo):
+    """Extrai nome, CNPJ/CPF do destinatário e a chave de acesso de uma NFe já analisada"""
+    dest = root.find('.//nfe:dest', NFE_NS)
+    if dest is None:
+        logger.warning(f"⚠️ Destinatário não encontrado em {nome_arquivo}")
+        return None, None, None
+
+    nome_elem = dest.find('nfe:xNome', NFE_NS)
+    cnpj_elem = dest.find('nfe:CNPJ', NFE_NS)
+    cpf_elem = dest.find('nfe:CPF', NFE_NS)
+
+    nome = nome_elem.text if nome_elem is not None else 'CLIENTE_DESCONHECIDO'
+    documento = cnpj_elem.text if cnpj_elem is not None else (cpf_elem.text if cpf_elem is not None else '00000000000000')
+
+    chave_elem = root.find('.//nfe:infNFe', NFE_NS)
+    chave = chave_elem.get('Id', '').replace('NFe', '') if chave_elem is not None else nome_arquivo.replace('.xml', '')
+
+    logger.debug(f"✅ Dados extraídos: {nome[:30]}... - {documento}")
+    return limpar_nome_arquivo(nome), documento, chave
+
+def dados_emissao(root):
+    """Data de emissão (dhEmi, ou dEmi no leiaute 2.00) e valor total (vNF) da NFe"""
+    emissao = root.find('.//nfe:ide/nfe:dhEmi', NFE_NS)
+    if emissao is None:
+        emissao = root.find('.//nfe:ide/nfe:dEmi', NFE_NS)
+    valor = root.find('.//nfe:total/nfe:ICMSTot/nfe:vNF', NFE_NS)
+    return (
+        emissao.text if emissao is not None else None,
+        valor.text if valor is not None else None
+    )
+
+def carregar_xml(conteudo, nome_arquivo):
     """
-    Verifica se o XML é uma NFe válida.
-    Ignora eventos, NFSe e outros XMLs fiscais.
+    Etapa única de ingestão: decodifica os bytes, analisa o XML uma vez e
+    identifica se é NFe, o destinatário e a chave de acesso.
+    Ignora eventos, NFSe e outros XMLs fiscais (is_nfe=False).
     """
+    texto, encoding = decodificar_xml(conteudo)
     try:
-        tree = ET.parse(xml_path)
-        root = tree.getroot()
+        root = ET.fromstring(texto)
+    except Exception as e:
+        logger.warning(f"⚠️ Erro ao validar tipo do XML {nome_arquivo}: {str(e)}")
+        return DocumentoXML(nome_arquivo, conteudo, encoding, False, None, None, None)
 
-        # Namespace padrão da NFe
-        ns = {'nfe': 'http://www.portalfiscal.inf.br/nfe'}
+    if root.find('.//nfe:infNFe', NFE_NS) is None:
+        return DocumentoXML(nome_arquivo, conteudo, encoding, False, None, None, None)
 
-        return root.find('.//nfe:infNFe', ns) is not None
+    try:
+        nome, documento, chave = dados_destinatario(root, nome_arquivo)
+        emissao, valor = dados_emissao(root)
     except Exception as e:
-        logger.warning(f"⚠️ Erro ao validar tipo do XML {os.path.basename(xml_path)}: {str(e)}")
-        return False
+        logger.error(f"❌ Erro ao processar XML {nome_arquivo}: {str(e)}")
+        nome, documento, chave, emissao, valor = None, None, None, None, None
+
+    return DocumentoXML(nome_arquivo, conteudo, encoding, True, nome, documento, chave, emissao, valor)
 
+def ler_xml(xml_path):
+    """Lê o arquivo do disco uma única vez e retorna o DocumentoXML"""
+    with open(xml_path, 'rb') as f:
+        return carregar_xml(f.read(), os.path.basename(xml_path))
 
 def is_valid_zip(path):
     """Verifica se o arquivo é um ZIP válido"""
@@ -145,181 +306,702 @@ def sanitize_path(base_dir, filename):
     Previne Zip Slip vulnerability
     Garante que o caminho extraído está dentro do diretório base
     """
-    filepath = os.path.normpath(os.path.join(base_dir, filename))
-    if not filepath.startswith(os.path.abspath(base_dir)):
+    base = os.path.abspath(base_dir)
+    filepath = os.path.abspath(os.path.join(base, filename))
+    if filepath != base and not filepath.startswith(base + os.sep):
         raise ValueError(f"⚠️ Caminho suspeito detectado: {filename}")
     return filepath
 
-def safe_extract_zip(zip_path, extract_dir):
-    """Extrai ZIP de forma segura, prevenindo Zip Slip"""
-    logger.info(f"📂 Extraindo ZIP com validação de segurança...")
-    
-    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-        for member in zip_ref.namelist():
-            target_path = sanitize_path(extract_dir, member)
-            
-            if member.endswith('/'):
-                os.makedirs(target_path, exist_ok=True)
-            else:
-                os.makedirs(os.path.dirname(target_path), exist_ok=True)
-                with zip_ref.open(member) as source, open(target_path, 'wb') as target:
-                    shutil.copyfileobj(source, target)
-    
-    logger.info(f"✅ ZIP extraído com segurança em: {extract_dir}")
+def validar_membros(arquivo_ref, base_dir, orcamento):
+    """
+    Valida o ZIP/RAR antes de ler qualquer membro: caminhos contra Zip Slip e
+    tamanhos declarados contra zip bomb (razão de compressão de cada membro e
+    total descompactado do lote, acumulado em orcamento)
+    """
+    for info in arquivo_ref.infolist():
+        sanitize_path(base_dir, info.filename)
+        if info.is_dir():
+            continue
 
-def safe_extract_rar(rar_path, extract_dir):
-    """Extrai RAR de forma segura"""
-    if not RAR_AVAILABLE:
-        raise Exception("Suporte para RAR não disponível. Instale: pip install rarfile")
-    
-    logger.info(f"📂 Extraindo RAR com validação de segurança...")
-    
-    with rarfile.RarFile(rar_path, 'r') as rar_ref:
-        for member in rar_ref.namelist():
-            target_path = sanitize_path(extract_dir, member)
-            
-            if member.endswith('/') or member.endswith('\\'):
-                os.makedirs(target_path, exist_ok=True)
-            else:
-                os.makedirs(os.path.dirname(target_path), exist_ok=True)
-                with rar_ref.open(member) as source, open(target_path, 'wb') as target:
-                    shutil.copyfileobj(source, target)
-    
-    logger.info(f"✅ RAR extraído com segurança em: {extract_dir}")
+        # Membros pequenos (XMLs repetitivos) comprimem muito sem risco
+        if info.file_size > 1024 * 1024 and info.file_size > RAZAO_COMPRESSAO_MAX * max(info.compress_size, 1):
+            logger.error(f"🚨 Razão de compressão suspeita: {info.filename} ({info.compress_size} -> {info.file_size} bytes)")
+            raise ErroLote(f"Arquivo suspeito (zip bomb): {info.filename}", 413)
+
+        orcamento['descompactado'] += info.file_size
+        if orcamento['descompactado'] > DESCOMPACTADO_MAX_MB * 1024 * 1024:
+            logger.error(f"🚨 Lote excede {DESCOMPACTADO_MAX_MB} MB descompactados")
+            raise ErroLote(f"Conteúdo descompactado excede o limite de {DESCOMPACTADO_MAX_MB} MB", 413)
 
-def extrair_dados_xml(xml_path):
-    """Extrai informações do destinatário do XML"""
+def abrir_aninhados(arquivo_ref, base_dir, orcamento, profundidade=1):
+    """
+    Abre os ZIP/RAR contidos em arquivo_ref direto do stream do membro, em memória
+    (BytesIO), sem gravar no disco, com as mesmas validações do arquivo externo.
+    Retorna os handles abertos, incluindo os dos níveis mais internos, na ordem do arquivo.
+    Compactados internos corrompidos ou fundos demais ficam de fora do lote, listados
+    em arquivo_ref.compactados_ignorados como (origem, motivo); Zip Slip e os limites
+    de tamanho continuam recusando o lote inteiro.
+    """
+    arquivo_ref.compactados_ignorados = []
+    abertos = []
     try:
-        logger.debug(f"📄 Extraindo dados do XML: {os.path.basename(xml_path)}")
-        tree = ET.parse(xml_path)
-        root = tree.getroot()
-        
-        ns = {'nfe': 'http://www.portalfiscal.inf.br/nfe'}
-        
-        dest = root.find('.//nfe:dest', ns)
-        if dest is None:
-            logger.warning(f"⚠️ Destinatário não encontrado em {os.path.basename(xml_path)}")
-            return None, None, None
-            
-        nome_elem = dest.find('nfe:xNome', ns)
-        cnpj_elem = dest.find('nfe:CNPJ', ns)
-        cpf_elem = dest.find('nfe:CPF', ns)
-        
-        nome = nome_elem.text if nome_elem is not None else 'CLIENTE_DESCONHECIDO'
-        documento = cnpj_elem.text if cnpj_elem is not None else (cpf_elem.text if cpf_elem is not None else '00000000000000')
+        for info in arquivo_ref.infolist():
+            nome = info.filename.lower()
+            if info.is_dir() or not nome.endswith(('.zip', '.rar')):
+                continue
+
+            origem = f"{arquivo_ref.nome_upload}/{info.filename}"
+            if ARQUIVOS_ANINHADOS_PROFUNDIDADE <= 0:
+                logger.warning(f"⚠️ Compactado interno ignorado: {origem}")
+                continue
+            if profundidade > ARQUIVOS_ANINHADOS_PROFUNDIDADE:
+                logger.warning(f"⚠️ Compactado interno ignorado (além de {ARQUIVOS_ANINHADOS_PROFUNDIDADE} níveis): {origem}")
+                arquivo_ref.compactados_ignorados.append(
+                    (origem, f"Compactado interno além de {ARQUIVOS_ANINHADOS_PROFUNDIDADE} níveis")
+                )
+                continue
+            if nome.endswith('.rar') and not RAR_AVAILABLE:
+                logger.warning(f"⚠️ RAR interno ignorado (rarfile não instalado): {origem}")
+                continue
+
+            orcamento['aninhados'] += info.file_size
+            if orcamento['aninhados'] > ARQUIVOS_ANINHADOS_MAX_MB * 1024 * 1024:
+                raise ErroLote(f"Compactados internos excedem o limite de {ARQUIVOS_ANINHADOS_MAX_MB} MB", 413)
+
+            with arquivo_ref.open(info) as source:
+                dados = io.BytesIO(source.read())
+            try:
+                interno = zipfile.ZipFile(dados, 'r') if nome.endswith('.zip') else rarfile.RarFile(dados, 'r')
+            except Exception:
+                logger.warning(f"⚠️ Compactado interno ignorado (inválido ou corrompido): {origem}")
+                arquivo_ref.compactados_ignorados.append((origem, 'Não é um ZIP/RAR válido ou está corrompido'))
+                continue
+
+            interno.nome_upload = origem
+            abertos.append(interno)
+            validar_membros(interno, base_dir, orcamento)
+            logger.info(f"📦 Compactado interno aberto em memória: {origem}")
+            abertos.extend(abrir_aninhados(interno, base_dir, orcamento, profundidade + 1))
+    except Exception:
+        for interno in abertos:
+            interno.close()
+        raise
+
+    return abertos
+
+def iterar_xmls_compactado(arquivo_ref):
+    """
+    Gera (nome_membro, bytes) de cada .xml diretamente do handle do
+    ZipFile/RarFile, sem extrair para o disco.
+    """
+    for info in arquivo_ref.infolist():
+        if info.is_dir() or not info.filename.lower().endswith('.xml'):
+            continue
+
+        with arquivo_ref.open(info) as source:
+            yield info.filename, source.read()
+
+def processar_xml_para_danfe(doc):
+    """Converte o DocumentoXML em DANFE e retorna (sucesso, mensagem, bytes do PDF)"""
+    try:
+        if not doc.nome or not doc.documento:
+            return False, "Erro ao extrair dados do XML", None
         
-        chave_elem = root.find('.//nfe:infNFe', ns)
-        chave = chave_elem.get('Id', '').replace('NFe', '') if chave_elem is not None else os.path.basename(xml_path).replace('.xml', '')
+        danfe = Danfe(xml=doc.texto)
+        pdf = bytes(danfe.output())
         
-        logger.debug(f"✅ Dados extraídos: {nome[:30]}... - {documento}")
-        return limpar_nome_arquivo(nome), documento, chave
+        return True, f"Processado: {doc.nome}", pdf
     except Exception as e:
-        logger.error(f"❌ Erro ao processar XML {os.path.basename(xml_path)}: {str(e)}")
-        return None, None, None
+        logger.error(f"❌ Erro ao processar {doc.nome_arquivo}: {str(e)}")
+        return False, f"Erro: {str(e)}", None
+
+def escrever_no_zip(zipf, arcname, dados, nivel):
+    """Grava um membro no ZIP de resultado (nível 0 = ZIP_STORED, sem recompressão)"""
+    if nivel <= 0:
+        zipf.writestr(arcname, dados, compress_type=zipfile.ZIP_STORED)
+    else:
+        zipf.writestr(arcname, dados, compress_type=zipfile.ZIP_DEFLATED, compresslevel=nivel)
+
+def gravar_documento_zip(zipf, doc, pdf):
+    """Grava XML e PDF da NFe em DANFE-XML/{nome} - {documento}/ no ZIP de resultado; retorna o caminho do PDF"""
+    pasta = f"DANFE-XML/{doc.nome} - {doc.documento}"
+    escrever_no_zip(zipf, f"{pasta}/{doc.chave}.xml", doc.conteudo, ZIP_NIVEL_XML)
+    if pdf is None:
+        return None
+    escrever_no_zip(zipf, f"{pasta}/{doc.chave}.pdf", pdf, ZIP_NIVEL_PDF)
+    return f"{pasta}/{doc.chave}.pdf"
+
+_pool_renderizacao = None
+_pool_lock = threading.Lock()
+
+def obter_pool_renderizacao():
+    """Retorna o pool de renderização do processo atual (criado sob demanda)"""
+    global _pool_renderizacao
+    with _pool_lock:
+        if _pool_renderizacao is None:
+            # Herdado pelos processos do pool, que importam este módulo sem repetir o autoteste
+            os.environ['DANFE_PROCESSO_RENDERIZACAO'] = '1'
+            _pool_renderizacao = ProcessPoolExecutor(
+                max_workers=RENDER_WORKERS,
+                mp_context=multiprocessing.get_context(RENDER_MP_CONTEXT),
+                initializer=aquecer_renderizador
+            )
+            logger.info(f"⚙️ Pool de renderização iniciado com {RENDER_WORKERS} processos")
+        return _pool_renderizacao
+
+def descartar_pool_renderizacao(pool):
+    """Descarta um pool quebrado (worker morto) para que o próximo lote crie outro"""
+    global _pool_renderizacao
+    with _pool_lock:
+        if _pool_renderizacao is pool:
+            _pool_renderizacao = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+# ========================================
+# AQUECIMENTO E AUTOTESTE DO RENDERIZADOR
+# ========================================
+
+# Nota de exemplo usada no autoteste e no aquecimento de cada processo do pool
+XML_AUTOTESTE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'nfe_autoteste.xml')
+
+_autoteste = {'status': 'pendente', 'segundos': None, 'erro': None}
+_preaquecimento_pid = None
+_preaquecimento_lock = threading.Lock()
+
+def renderizar_amostra():
+    """Renderiza a nota de exemplo; retorna (sucesso, mensagem, segundos)"""
+    inicio = time.perf_counter()
+    sucesso, mensagem, pdf = processar_xml_para_danfe(ler_xml(XML_AUTOTESTE))
+    if sucesso and not pdf.startswith(b'%PDF'):
+        sucesso, mensagem = False, "Renderizador não gerou um PDF válido"
+    return sucesso, mensagem, time.perf_counter() - inicio
+
+def executar_autoteste():
+    """
+    Renderiza a nota de exemplo no processo atual. Com gunicorn --preload roda
+    uma vez no mestre e os workers herdam bibliotecas e caches já carregados.
+    """
+    try:
+        sucesso, mensagem, segundos = renderizar_amostra()
+    except Exception as e:
+        sucesso, mensagem, segundos = False, f"Erro: {str(e)}", None
+
+    _autoteste['status'] = 'ok' if sucesso else 'falhou'
+    _autoteste['segundos'] = round(segundos, 3) if segundos is not None else None
+    _autoteste['erro'] = None if sucesso else mensagem
+    if sucesso:
+        logger.info(f"✅ Autoteste de renderização OK ({segundos * 1000:.0f} ms)")
+    else:
+        logger.error(f"❌ Autoteste de renderização falhou: {mensagem}")
 
-def processar_xml_para_danfe(xml_path, output_dir):
-    """Converte XML em DANFE (PDF)"""
+def aquecer_renderizador():
+    """Inicializador do pool: carrega as bibliotecas e renderiza a amostra antes do primeiro XML real"""
     try:
-        nome_cliente, documento, chave = extrair_dados_xml(xml_path)
-        
-        if not nome_cliente or not documento:
-            return False, "Erro ao extrair dados do XML"
-        
-        nome_pasta = f"{nome_cliente} - {documento}"
-        pasta_cliente = os.path.join(output_dir, nome_pasta)
-        os.makedirs(pasta_cliente, exist_ok=True)
-        
-        xml_destino = os.path.join(pasta_cliente, f"{chave}.xml")
-        shutil.copy2(xml_path, xml_destino)
-        
-        pdf_destino = os.path.join(pasta_cliente, f"{chave}.pdf")
-        
-        # Tentar diferentes encodings
-        xml_content = None
-        for encoding in ['utf-8', 'iso-8859-1', 'latin1', 'cp1252']:
+        renderizar_amostra()
+    except Exception as e:
+        # Falha aqui quebraria o pool inteiro; o erro real aparece no primeiro XML
+        logger.warning(f"⚠️ Aquecimento do renderizador falhou: {str(e)}")
+
+def preaquecer_pool():
+    """Sobe todos os processos do pool do worker atual, sem esperar o primeiro lote"""
+    global _preaquecimento_pid
+    if RENDER_WORKERS <= 1 or _preaquecimento_pid == os.getpid():
+        return
+    with _preaquecimento_lock:
+        if _preaquecimento_pid == os.getpid():
+            return
+        _preaquecimento_pid = os.getpid()
+
+    # Cada submit sem processo ocioso cria um novo processo, que roda aquecer_renderizador
+    pool = obter_pool_renderizacao()
+    for _ in range(RENDER_WORKERS):
+        pool.submit(os.getpid)
+    logger.info(f"🔥 Pré-aquecendo {RENDER_WORKERS} processos de renderização")
+
+# ========================================
+# MÉTRICAS
+# ========================================
+
+# Cada worker do gunicorn mantém suas métricas em memória e exporta um snapshot
+# para METRICS_FOLDER; o /metrics soma os snapshots de todos os workers.
+METRICS_FOLDER = os.getenv('METRICS_FOLDER', '/tmp/danfe_metricas' if IS_PRODUCTION else 'danfe_metricas')
+METRICS_INTERVALO = int(os.getenv('METRICS_INTERVALO', 5))
+# Espaço em disco das pastas: percorrer o cache a cada coleta compete com a renderização por I/O
+METRICS_DISCO_TTL = int(os.getenv('METRICS_DISCO_TTL', 60))
+BUCKETS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+METRICAS = {
+    'danfe_etapa_segundos': ('histogram', 'Duração das etapas (upload, abertura, extracao, parsing, renderizacao, zip, limpeza, lote, coleta)'),
+    'danfe_documentos_total': ('counter', 'XMLs lidos por resultado (processado, erro, duplicado, ignorado)'),
+    'danfe_lotes_total': ('counter', 'Lotes finalizados por status'),
+    'danfe_cache_total': ('counter', 'Consultas ao cache de DANFEs por resultado'),
+    'danfe_limpeza_removidos_total': ('counter', 'Itens removidos pela limpeza em background (ttl, disco)'),
+    'danfe_bytes_recebidos_total': ('counter', 'Bytes recebidos por rota'),
+    'danfe_bytes_enviados_total': ('counter', 'Bytes enviados por rota'),
+    'danfe_lotes_em_andamento': ('gauge', 'Lotes sendo processados (síncronos e jobs)'),
+    'danfe_jobs_pendentes': ('gauge', 'Jobs na fila ou em processamento'),
+    'danfe_lotes_aguardando': ('gauge', 'Lotes (síncronos e jobs) aguardando na fila do agendador'),
+    'danfe_lotes_recusados_total': ('counter', 'Lotes recusados com 429 por fila cheia'),
+    'danfe_disco_bytes': ('gauge', 'Espaço ocupado por pasta (uploads, resultados, cache)'),
+}
+
+_metricas = {'counter': {}, 'gauge': {}, 'histogram': {}}
+_metricas_lock = threading.Lock()
+_metricas_alteradas = False
+_exportador_pid = None
+
+def rotulos_metrica(rotulos):
+    return ','.join(f'{nome}="{valor}"' for nome, valor in sorted(rotulos.items()))
+
+def incrementar_metrica(nome, valor=1, **rotulos):
+    """Soma valor ao contador (ou gauge) nome{rotulos}"""
+    tipo = METRICAS[nome][0]
+    chave = rotulos_metrica(rotulos)
+    with _metricas_lock:
+        serie = _metricas[tipo].setdefault(nome, {})
+        serie[chave] = serie.get(chave, 0) + valor
+    marcar_metricas_alteradas()
+
+def observar_metrica(nome, valor, **rotulos):
+    """Registra uma observação no histograma nome{rotulos}"""
+    chave = rotulos_metrica(rotulos)
+    with _metricas_lock:
+        serie = _metricas['histogram'].setdefault(nome, {})
+        histograma = serie.setdefault(chave, {'buckets': [0] * (len(BUCKETS_SEGUNDOS) + 1), 'soma': 0.0, 'contagem': 0})
+        histograma['buckets'][bisect.bisect_left(BUCKETS_SEGUNDOS, valor)] += 1
+        histograma['soma'] += valor
+        histograma['contagem'] += 1
+    marcar_metricas_alteradas()
+
+@contextmanager
+def medir_etapa(etapa):
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        observar_metrica('danfe_etapa_segundos', time.perf_counter() - inicio, etapa=etapa)
+
+def medir_iteracao(iteravel, etapa):
+    """Repassa os itens do iterável, medindo o tempo de obter cada um"""
+    iterador = iter(iteravel)
+    while True:
+        inicio = time.perf_counter()
+        try:
+            item = next(iterador)
+        except StopIteration:
+            return
+        observar_metrica('danfe_etapa_segundos', time.perf_counter() - inicio, etapa=etapa)
+        yield item
+
+def marcar_metricas_alteradas():
+    """Marca o snapshot como desatualizado e garante a thread exportadora neste processo"""
+    global _metricas_alteradas, _exportador_pid
+    _metricas_alteradas = True
+    if _exportador_pid != os.getpid():
+        with _metricas_lock:
+            if _exportador_pid != os.getpid():
+                _exportador_pid = os.getpid()
+                threading.Thread(target=exportar_metricas, daemon=True, name='metricas').start()
+
+def snapshot_metricas():
+    with _metricas_lock:
+        snapshot = json.loads(json.dumps(_metricas))
+    snapshot['pid'] = os.getpid()
+    snapshot['mestre'] = os.getppid()
+    return snapshot
+
+def gravar_snapshot_metricas():
+    """Grava o snapshot deste processo em METRICS_FOLDER/metricas_{pid}.json (escrita atômica)"""
+    global _metricas_alteradas
+    _metricas_alteradas = False
+    caminho = os.path.join(METRICS_FOLDER, f'metricas_{os.getpid()}.json')
+    try:
+        os.makedirs(METRICS_FOLDER, exist_ok=True)
+        with open(f'{caminho}.tmp', 'w', encoding='utf-8') as f:
+            json.dump(snapshot_metricas(), f)
+        os.replace(f'{caminho}.tmp', caminho)
+    except OSError as e:
+        logger.warning(f"⚠️ Não foi possível gravar as métricas: {str(e)}")
+
+def exportar_metricas():
+    while True:
+        time.sleep(METRICS_INTERVALO)
+        if _metricas_alteradas:
+            gravar_snapshot_metricas()
+
+def agregar_metricas():
+    """
+    Soma as métricas deste processo com os snapshots dos outros workers do mesmo
+    mestre. Workers já encerrados (reiniciados pelo gunicorn) continuam somando contadores e
+    histogramas, para que os totais não diminuam; seus gauges são descartados.
+    """
+    snapshots = [snapshot_metricas()]
+    for caminho in glob.glob(os.path.join(METRICS_FOLDER, 'metricas_*.json')):
+        try:
+            with open(caminho, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            continue
+
+        if snapshot['pid'] == os.getpid():
+            continue
+        ativo = processo_ativo(snapshot['pid'])
+        if snapshot.get('mestre') != os.getppid():
+            if not ativo:
+                # Sobra de uma execução anterior do servidor
+                try:
+                    os.remove(caminho)
+                except OSError:
+                    pass
+            continue
+        if not ativo:
+            snapshot['gauge'] = {}
+        snapshots.append(snapshot)
+
+    total = {'counter': {}, 'gauge': {}, 'histogram': {}}
+    for snapshot in snapshots:
+        for tipo in ('counter', 'gauge'):
+            for nome, serie in snapshot[tipo].items():
+                destino = total[tipo].setdefault(nome, {})
+                for chave, valor in serie.items():
+                    destino[chave] = destino.get(chave, 0) + valor
+        for nome, serie in snapshot['histogram'].items():
+            destino = total['histogram'].setdefault(nome, {})
+            for chave, histograma in serie.items():
+                if chave not in destino:
+                    destino[chave] = {'buckets': [0] * (len(BUCKETS_SEGUNDOS) + 1), 'soma': 0.0, 'contagem': 0}
+                destino[chave]['buckets'] = [a + b for a, b in zip(destino[chave]['buckets'], histograma['buckets'])]
+                destino[chave]['soma'] += histograma['soma']
+                destino[chave]['contagem'] += histograma['contagem']
+    return total
+
+_tamanhos_pastas = {}
+_tamanhos_pastas_lock = threading.Lock()
+
+def tamanho_pasta_em_cache(pasta):
+    """tamanho_pasta() reaproveitado por METRICS_DISCO_TTL segundos"""
+    with _tamanhos_pastas_lock:
+        medido = _tamanhos_pastas.get(pasta)
+        if medido is None or time.monotonic() - medido[0] >= METRICS_DISCO_TTL:
+            medido = (time.monotonic(), tamanho_pasta(pasta))
+            _tamanhos_pastas[pasta] = medido
+        return medido[1]
+
+def tamanho_pasta(pasta):
+    total = 0
+    for raiz, _, arquivos in os.walk(pasta):
+        for nome in arquivos:
             try:
-                with open(xml_path, 'r', encoding=encoding) as f:
-                    xml_content = f.read()
-                break
-            except UnicodeDecodeError:
+                total += os.path.getsize(os.path.join(raiz, nome))
+            except OSError:
+                pass
+    return total
+
+def linha_metrica(nome, rotulos, valor):
+    return f'{nome}{{{rotulos}}} {valor}' if rotulos else f'{nome} {valor}'
+
+def formatar_metricas(total):
+    """Texto no formato de exposição do Prometheus (text/plain; version=0.0.4)"""
+    linhas = []
+    for nome, (tipo, ajuda) in METRICAS.items():
+        series = total[tipo].get(nome)
+        if not series:
+            continue
+        linhas.append(f'# HELP {nome} {ajuda}')
+        linhas.append(f'# TYPE {nome} {tipo}')
+        for rotulos, valor in sorted(series.items()):
+            if tipo != 'histogram':
+                linhas.append(linha_metrica(nome, rotulos, valor))
                 continue
-        
-        if xml_content is None:
-            with open(xml_path, 'rb') as f:
-                xml_content = f.read().decode('utf-8', errors='ignore')
-        
-        danfe = Danfe(xml=xml_content)
-        danfe.output(pdf_destino)
-        
-        return True, f"Processado: {nome_cliente}"
-    except Exception as e:
-        logger.error(f"❌ Erro ao processar {os.path.basename(xml_path)}: {str(e)}")
-        return False, f"Erro: {str(e)}"
+            acumulado = 0
+            for limite, quantidade in zip(BUCKETS_SEGUNDOS + ('+Inf',), valor['buckets']):
+                acumulado += quantidade
+                rotulos_bucket = ','.join(filter(None, [rotulos, f'le="{limite}"']))
+                linhas.append(linha_metrica(f'{nome}_bucket', rotulos_bucket, acumulado))
+            linhas.append(linha_metrica(f'{nome}_sum', rotulos, round(valor['soma'], 6)))
+            linhas.append(linha_metrica(f'{nome}_count', rotulos, valor['contagem']))
+    return '\n'.join(linhas) + '\n'
 
-def cleanup_old_files():
-    """Remove arquivos temporários antigos (mais de 1 hora)"""
+@app.after_request
+def contar_bytes_transferidos(resposta):
+    rota = request.endpoint or 'desconhecida'
+    if request.content_length:
+        incrementar_metrica('danfe_bytes_recebidos_total', request.content_length, rota=rota)
+    if resposta.content_length:
+        incrementar_metrica('danfe_bytes_enviados_total', resposta.content_length, rota=rota)
+    return resposta
+
+# ========================================
+# CACHE DE DANFES
+# ========================================
+
+_cache_estatisticas = {'hits': 0, 'misses': 0, 'entradas': 0, 'tamanho_bytes': 0}
+_cache_lock = threading.Lock()
+
+def caminho_cache(doc):
+    """Caminho do PDF no cache: {chave}_{sha256 do XML}.pdf, distribuído em subpastas"""
+    hash_xml = hashlib.sha256(doc.conteudo).hexdigest()
+    chave = re.sub(r'\D', '', doc.chave or '')
+    return os.path.join(CACHE_FOLDER, hash_xml[:2], f"{chave}_{hash_xml}.pdf")
+
+def contar_cache(campo):
+    with _cache_lock:
+        _cache_estatisticas[campo] += 1
+    incrementar_metrica('danfe_cache_total', resultado='hit' if campo == 'hits' else 'miss')
+
+def ler_cache(doc):
+    """Retorna o PDF em cache para o documento (ou None), renovando sua posição no LRU"""
+    if CACHE_MAX_MB <= 0 or not doc.nome or not doc.documento:
+        return None
+
+    caminho = caminho_cache(doc)
     try:
-        current_time = datetime.now().timestamp()
-        
-        for folder in [UPLOAD_FOLDER, TEMP_OUTPUT]:
-            if not os.path.exists(folder):
+        with open(caminho, 'rb') as f:
+            pdf = f.read()
+        os.utime(caminho)
+    except OSError:
+        contar_cache('misses')
+        return None
+
+    contar_cache('hits')
+    return pdf
+
+def gravar_cache(doc, pdf):
+    """Grava o PDF renderizado no cache (escrita atômica)"""
+    if CACHE_MAX_MB <= 0:
+        return
+
+    caminho = caminho_cache(doc)
+    try:
+        os.makedirs(os.path.dirname(caminho), exist_ok=True)
+        tmp = f'{caminho}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(pdf)
+        os.replace(tmp, caminho)
+    except OSError as e:
+        logger.warning(f"⚠️ Não foi possível gravar no cache: {str(e)}")
+
+def podar_cache():
+    """Remove os PDFs menos usados até o cache ficar abaixo de CACHE_MAX_MB"""
+    if CACHE_MAX_MB <= 0 or not os.path.exists(CACHE_FOLDER):
+        return
+
+    entradas = []
+    for subpasta in os.scandir(CACHE_FOLDER):
+        if not subpasta.is_dir():
+            continue
+        for item in os.scandir(subpasta.path):
+            try:
+                info = item.stat()
+            except OSError:
                 continue
-                
-            for item in os.listdir(folder):
-                item_path = os.path.join(folder, item)
-                
-                if os.path.getmtime(item_path) < current_time - 3600:  # 1 hora
-                    try:
-                        if os.path.isdir(item_path):
-                            shutil.rmtree(item_path)
-                        else:
-                            os.remove(item_path)
-                        logger.debug(f"🧹 Removido arquivo antigo: {item}")
-                    except Exception as e:
-                        logger.warning(f"⚠️ Não foi possível remover {item}: {str(e)}")
+            entradas.append((info.st_mtime, info.st_size, item.path))
+
+    tamanho = sum(e[1] for e in entradas)
+    limite = CACHE_MAX_MB * 1024 * 1024
+    removidos = 0
+
+    if tamanho > limite:
+        entradas.sort()
+        for _, tamanho_item, caminho in entradas:
+            if tamanho <= limite:
+                break
+            try:
+                os.remove(caminho)
+            except OSError:
+                continue
+            tamanho -= tamanho_item
+            removidos += 1
+        logger.info(f"🧹 Cache podado: {removidos} PDFs removidos")
+
+    with _cache_lock:
+        _cache_estatisticas['entradas'] = len(entradas) - removidos
+        _cache_estatisticas['tamanho_bytes'] = tamanho
+
+def renderizar_medindo(doc):
+    """Executado no pool: devolve (resultado, segundos) para a métrica ser registrada no processo do worker web"""
+    inicio = time.perf_counter()
+    resultado = processar_xml_para_danfe(doc)
+    return resultado, time.perf_counter() - inicio
+
+def _resultado_renderizacao(pool, futuro):
+    """(resultado, segundos de renderização ou None)"""
+    try:
+        return futuro.result()
+    except BrokenProcessPool as e:
+        logger.error(f"❌ Pool de renderização interrompido: {str(e)}")
+        descartar_pool_renderizacao(pool)
+        return (False, f"Erro: {str(e)}", None), None
     except Exception as e:
-        logger.error(f"❌ Erro ao limpar arquivos antigos: {str(e)}")
+        return (False, f"Erro: {str(e)}", None), None
+
+def submeter_renderizacao(pool, doc):
+    """Envia o XML ao pool (recriando-o se estiver quebrado) ou renderiza na hora sem pool; retorna (pool, futuro)"""
+    if pool is None:
+        futuro = Future()
+        futuro.set_result(renderizar_medindo(doc))
+        return None, futuro
+
+    try:
+        return pool, pool.submit(renderizar_medindo, doc)
+    except BrokenProcessPool:
+        descartar_pool_renderizacao(pool)
+        pool = obter_pool_renderizacao()
+        return pool, pool.submit(renderizar_medindo, doc)
+
+def renderizar_em_paralelo(documentos, estatisticas=None):
+    """
+    Renderiza os DANFEs no pool de processos.
+    Gera (documento, (sucesso, mensagem, pdf), segundos) na mesma ordem da entrada
+    (segundos de renderização; None quando o PDF veio do cache),
+    mantendo no máximo RENDER_JANELA XMLs em andamento no lote e
+    DOCUMENTOS_EM_VOO somando todos os lotes do worker.
+    PDFs encontrados no cache não são renderizados de novo; os acertos e
+    faltas são somados em estatisticas['cache_hits'/'cache_misses'].
+    """
+    estatisticas = estatisticas if estatisticas is not None else {}
+    estatisticas.setdefault('cache_hits', 0)
+    estatisticas.setdefault('cache_misses', 0)
+
+    pool = obter_pool_renderizacao() if RENDER_WORKERS > 1 else None
+    janela = deque()
+
+    def entregar():
+        doc, pool_doc, futuro, renderizado = janela.popleft()
+        resultado, segundos = _resultado_renderizacao(pool_doc, futuro)
+        if renderizado:
+            _documentos_em_voo.release()
+        if segundos is not None:
+            observar_metrica('danfe_etapa_segundos', segundos, etapa='renderizacao')
+        if renderizado and resultado[0]:
+            gravar_cache(doc, resultado[2])
+        return doc, resultado, segundos
+
+    try:
+        for doc in documentos:
+            pdf = ler_cache(doc)
+            if pdf is not None:
+                estatisticas['cache_hits'] += 1
+                futuro = Future()
+                futuro.set_result(((True, f"Processado: {doc.nome}", pdf), None))
+                janela.append((doc, None, futuro, False))
+            else:
+                estatisticas['cache_misses'] += 1
+
+                # Vaga no limite de DOCUMENTOS_EM_VOO do worker; enquanto não há vaga,
+                # entrega os próprios resultados em vez de bloquear segurando vagas
+                while not _documentos_em_voo.acquire(blocking=not janela):
+                    yield entregar()
+
+                try:
+                    pool, futuro = submeter_renderizacao(pool, doc)
+                except Exception:
+                    _documentos_em_voo.release()
+                    raise
+                janela.append((doc, pool, futuro, True))
+
+            if len(janela) >= RENDER_JANELA:
+                yield entregar()
+
+        while janela:
+            yield entregar()
+    finally:
+        # Lote interrompido: devolve as vagas dos XMLs que não foram entregues
+        for _, _, _, renderizado in janela:
+            if renderizado:
+                _documentos_em_voo.release()
 
 # ========================================
-# ROTAS DA APLICAÇÃO
+# EXTRAÇÃO PARALELA
 # ========================================
 
-@app.route('/')
-def index():
-    return render_template('index.html')
+def indices_xml(zip_ref):
+    """Posições em infolist() dos membros .xml do ZIP"""
+    return [
+        indice for indice, info in enumerate(zip_ref.infolist())
+        if not info.is_dir() and info.filename.lower().endswith('.xml')
+    ]
 
-@app.route('/favicon.ico')
-def favicon():
-    """Rota explícita para favicon"""
-    return send_from_directory(
-        os.path.join(app.root_path, 'static'),
-        'favicon.ico',
-        mimetype='image/vnd.microsoft.icon'
-    ) if os.path.exists(os.path.join(app.root_path, 'static', 'favicon.ico')) else ('', 204)
+def extrair_faixa(caminho_zip, indices, upload):
+    """
+    Executado no pool: lê e analisa uma faixa de membros com um handle próprio do ZIP.
+    Retorna [(membro, DocumentoXML, segundos de extração, segundos de parsing)].
+    """
+    itens = []
+    with zipfile.ZipFile(caminho_zip, 'r') as zip_ref:
+        infos = zip_ref.infolist()
+        for indice in indices:
+            info = infos[indice]
+            inicio = time.perf_counter()
+            with zip_ref.open(info) as source:
+                conteudo = source.read()
+            extraido = time.perf_counter()
+            doc = carregar_xml(conteudo, os.path.basename(info.filename))._replace(origem=f"{upload}/{info.filename}")
+            itens.append((info.filename, doc, extraido - inicio, time.perf_counter() - extraido))
+    return itens
 
-@app.route('/health')
-def health():
-    """Endpoint para verificar saúde da aplicação"""
-    return jsonify({
-        'status': 'ok',
-        'timestamp': datetime.now().isoformat(),
-        'environment': 'production' if IS_PRODUCTION else 'development',
-        'rar_support': RAR_AVAILABLE
-    }), 200
+def usar_extracao_paralela(arquivo_ref, indices):
+    return (
+        RENDER_WORKERS > 1
+        and EXTRACAO_PARALELA_MIN > 0
+        and isinstance(arquivo_ref, zipfile.ZipFile)
+        and isinstance(arquivo_ref.filename, str)  # compactados internos estão em memória
+        and len(indices) >= EXTRACAO_PARALELA_MIN
+    )
 
-@app.route('/processar', methods=['POST', 'OPTIONS'])
-@validar_cnpj_api
-def processar():
-    if request.method == 'OPTIONS':
-        return '', 204
-    
-    logger.info("=" * 60)
-    logger.info("🚀 INICIANDO PROCESSAMENTO")
-    logger.info("=" * 60)
-    
-    cleanup_old_files()
-    
-    # Aceitar múltiplos arquivos (novo) ou arquivo único (compatibilidade)
+def extrair_em_paralelo(arquivo_ref, indices, upload):
+    """
+    Gera (membro, DocumentoXML) do ZIP na ordem original, com as faixas de
+    EXTRACAO_BLOCO membros lidas e analisadas no pool de renderização.
+    Só RENDER_WORKERS faixas ficam à frente: os XMLs de cada faixa seguem para
+    a renderização assim que ela termina, e as renderizações já enviadas ao
+    pool rodam enquanto as próximas faixas são extraídas.
+    """
+    pool = obter_pool_renderizacao()
+    faixas = deque()
+
+    def entregar():
+        indices_faixa, futuro = faixas.popleft()
+        try:
+            itens = futuro.result()
+        except BrokenProcessPool as e:
+            logger.error(f"❌ Pool interrompido na extração, lendo a faixa neste processo: {str(e)}")
+            descartar_pool_renderizacao(pool)
+            itens = extrair_faixa(arquivo_ref.filename, indices_faixa, upload)
+        for member, doc, segundos_extracao, segundos_parsing in itens:
+            observar_metrica('danfe_etapa_segundos', segundos_extracao, etapa='extracao')
+            observar_metrica('danfe_etapa_segundos', segundos_parsing, etapa='parsing')
+            yield member, doc
+
+    logger.info(f"⚡ Extração paralela: {len(indices)} XMLs em faixas de {EXTRACAO_BLOCO}")
+    for inicio in range(0, len(indices), EXTRACAO_BLOCO):
+        indices_faixa = indices[inicio:inicio + EXTRACAO_BLOCO]
+        try:
+            futuro = pool.submit(extrair_faixa, arquivo_ref.filename, indices_faixa, upload)
+        except BrokenProcessPool:
+            descartar_pool_renderizacao(pool)
+            pool = obter_pool_renderizacao()
+            futuro = pool.submit(extrair_faixa, arquivo_ref.filename, indices_faixa, upload)
+        faixas.append((indices_faixa, futuro))
+        if len(faixas) >= RENDER_WORKERS:
+            yield from entregar()
+
+    while faixas:
+        yield from entregar()
+
+# ========================================
+# PROCESSAMENTO EM LOTE
+# ========================================
+
+class ErroLote(Exception):
+    """Erro de validação do lote, devolvido ao cliente com o status HTTP indicado"""
+    def __init__(self, mensagem, status=400):
+        super().__init__(mensagem)
+        self.mensagem = mensagem
+        self.status = status
+
+def obter_arquivos_enviados():
+    """Aceita múltiplos arquivos (novo) ou arquivo único (compatibilidade)"""
     arquivos = []
     if 'arquivos' in request.files:
         arquivos = request.files.getlist('arquivos')
@@ -328,31 +1010,38 @@ def processar():
     
     if not arquivos:
         logger.error("❌ Nenhum arquivo enviado")
-        return jsonify({'erro': 'Nenhum arquivo enviado'}), 400
+        raise ErroLote('Nenhum arquivo enviado')
     
-    if not arquivos or len(arquivos) == 0 or (len(arquivos) == 1 and arquivos[0].filename == ''):
+    if len(arquivos) == 1 and arquivos[0].filename == '':
         logger.error("❌ Nenhum arquivo selecionado")
-        return jsonify({'erro': 'Nenhum arquivo selecionado'}), 400
+        raise ErroLote('Nenhum arquivo selecionado')
     
     logger.info(f"📦 Arquivos recebidos: {len(arquivos)}")
-    
-    resultados = []
-    total_processados = 0
-    total_erros = 0
-    
-    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-    os.makedirs(TEMP_OUTPUT, exist_ok=True)
-    
+    return arquivos
+
+def caminho_upload(arquivo, temp_dir):
+    """Caminho do upload em disco; sem cópia quando já foi gravado direto em temp_dir"""
+    nome = getattr(arquivo.stream, 'name', None)
+    if isinstance(nome, str) and os.path.dirname(os.path.abspath(nome)) == os.path.abspath(temp_dir):
+        arquivo.stream.flush()
+        return nome
+
+    destino = os.path.join(temp_dir, limpar_nome_arquivo(arquivo.filename))
+    arquivo.save(destino)
+    return destino
+
+def abrir_fontes(arquivos, temp_dir):
+    """
+    Valida os arquivos enviados e abre as fontes de XML do lote.
+    Retorna (xmls_diretos, arquivos_abertos): bytes dos XMLs enviados
+    diretamente e handles de ZIP/RAR lidos em streaming a partir do
+    upload já gravado em temp_dir (e dos ZIP/RAR internos, em memória).
+    """
+    xmls_diretos = []
+    arquivos_abertos = []
+    orcamento = {'descompactado': 0, 'aninhados': 0}
+
     try:
-        import uuid
-        temp_id = str(uuid.uuid4())[:8]
-        temp_dir = os.path.join(UPLOAD_FOLDER, f'temp_{temp_id}')
-        os.makedirs(temp_dir, exist_ok=True)
-        
-        extract_dir = os.path.join(temp_dir, 'extracted')
-        os.makedirs(extract_dir, exist_ok=True)
-        
-        # Processar cada arquivo enviado
         for arquivo in arquivos:
             if arquivo.filename == '':
                 continue
@@ -360,124 +1049,1433 @@ def processar():
             filename_lower = arquivo.filename.lower()
             logger.info(f"📄 Processando: {arquivo.filename}")
             
-            # Se for XML direto, salvar na pasta de extração
+            # Se for XML direto, usar o conteúdo enviado
             if filename_lower.endswith('.xml'):
-                xml_path = os.path.join(extract_dir, limpar_nome_arquivo(arquivo.filename))
-                arquivo.save(xml_path)
-                logger.info(f"✅ XML salvo diretamente: {arquivo.filename}")
+                xmls_diretos.append((limpar_nome_arquivo(arquivo.filename), arquivo.read()))
+                logger.info(f"✅ XML recebido diretamente: {arquivo.filename}")
             
-            # Se for ZIP, extrair
+            # Se for ZIP, ler os membros direto do upload
             elif filename_lower.endswith('.zip'):
-                zip_path = os.path.join(temp_dir, limpar_nome_arquivo(arquivo.filename))
-                arquivo.save(zip_path)
-                logger.info(f"📦 ZIP salvo: {arquivo.filename}")
+                zip_path = caminho_upload(arquivo, temp_dir)
 
                 # ✅ VALIDAÇÃO REAL DO ZIP (CORREÇÃO DO BUG)
                 if not is_valid_zip(zip_path):
                     logger.error(f"❌ Arquivo não é um ZIP válido: {arquivo.filename}")
-                    shutil.rmtree(temp_dir, ignore_errors=True)
-                    return jsonify({
-                        'erro': f"O arquivo '{arquivo.filename}' não é um ZIP válido ou está corrompido."
-                    }), 400
-                safe_extract_zip(zip_path, extract_dir)
+                    raise ErroLote(f"O arquivo '{arquivo.filename}' não é um ZIP válido ou está corrompido.")
 
+                zip_ref = zipfile.ZipFile(zip_path, 'r')
+                zip_ref.nome_upload = arquivo.filename
+                arquivos_abertos.append(zip_ref)
+                validar_membros(zip_ref, temp_dir, orcamento)
+                arquivos_abertos.extend(abrir_aninhados(zip_ref, temp_dir, orcamento))
+                logger.info(f"📦 ZIP aberto para leitura em streaming: {arquivo.filename}")
             
-            # Se for RAR, extrair
+            # Se for RAR, ler os membros do upload em disco
             elif filename_lower.endswith('.rar'):
                 if not RAR_AVAILABLE:
                     logger.error("❌ Suporte para RAR não disponível")
-                    return jsonify({'erro': 'Suporte para arquivos .RAR não está instalado no servidor'}), 400
+                    raise ErroLote('Suporte para arquivos .RAR não está instalado no servidor')
                 
-                rar_path = os.path.join(temp_dir, limpar_nome_arquivo(arquivo.filename))
-                arquivo.save(rar_path)
-                logger.info(f"📦 RAR salvo: {arquivo.filename}")
-                safe_extract_rar(rar_path, extract_dir)
+                rar_ref = rarfile.RarFile(caminho_upload(arquivo, temp_dir), 'r')
+                rar_ref.nome_upload = arquivo.filename
+                arquivos_abertos.append(rar_ref)
+                validar_membros(rar_ref, temp_dir, orcamento)
+                arquivos_abertos.extend(abrir_aninhados(rar_ref, temp_dir, orcamento))
+                logger.info(f"📦 RAR aberto para leitura em streaming: {arquivo.filename}")
             
             else:
                 logger.warning(f"⚠️ Arquivo ignorado (formato não suportado): {arquivo.filename}")
-        
-        # Processar todos os XMLs encontrados
-        pasta_danfe = os.path.join(extract_dir, 'DANFE-XML')
-        os.makedirs(pasta_danfe, exist_ok=True)
-        logger.info(f"📁 Pasta DANFE-XML criada: {pasta_danfe}")
-        
-        xml_count = 0
-        for root, dirs, files in os.walk(extract_dir):
-            if 'DANFE-XML' in root:
-                continue
-            
-            for file in files:
-                if file.endswith('.xml'):
-                    xml_path = os.path.join(root, file)
+    except Exception:
+        for arquivo_ref in arquivos_abertos:
+            arquivo_ref.close()
+        raise
 
-                    # ✅ Ignorar XML que não é NFe (eventos, NFSe, etc)
-                    if not is_xml_nfe(xml_path):
-                        logger.info(f"⏭️ XML ignorado (não é NFe): {file}")
-                        continue
+    return xmls_diretos, arquivos_abertos
 
-                    xml_count += 1
+def contar_xmls(xmls_diretos, arquivos_abertos):
+    """Total de XMLs do lote, lido do diretório central dos arquivos (sem descompactar)"""
+    total = len(xmls_diretos)
+    for arquivo_ref in arquivos_abertos:
+        total += sum(
+            1 for info in arquivo_ref.infolist()
+            if not info.is_dir() and info.filename.lower().endswith('.xml')
+        )
+    return total
 
-                    if xml_count % 10 == 0:
-                        logger.info(f"📊 Processados {xml_count} XMLs...")
+# ========================================
+# PDF UNIFICADO
+# ========================================
 
-                    sucesso, mensagem = processar_xml_para_danfe(xml_path, pasta_danfe)
+SaidaPDF = namedtuple('SaidaPDF', ['modo', 'sumario'])
+SAIDA_PDF_INDIVIDUAL = SaidaPDF('individual', False)
 
-                    if sucesso:
-                        total_processados += 1
-                        resultados.append({'tipo': 'sucesso', 'mensagem': mensagem})
-                    else:
-                        total_erros += 1
-                        resultados.append({'tipo': 'erro', 'mensagem': f"{file}: {mensagem}"})
+def obter_saida_pdf():
+    """Modo de saída dos PDFs pedido no formulário ou na query (?pdf=destinatario&sumario=1)"""
+    modo = (request.values.get('pdf') or PDF_MODO_PADRAO).lower()
+    if modo not in MODOS_PDF:
+        raise ErroLote(f"Modo de PDF inválido: {modo} (use {', '.join(MODOS_PDF)})")
+    if modo != 'individual' and not PYPDF_AVAILABLE:
+        raise ErroLote('PDF unificado não disponível neste servidor (pypdf não instalado)', 501)
+    sumario = request.values.get('sumario', '').lower() in ('1', 'true', 'sim')
+    return SaidaPDF(modo, sumario)
 
-        
-        logger.info(f"📊 Total de XMLs encontrados: {xml_count}")
-        
-        if xml_count == 0:
-            logger.error("❌ Nenhum arquivo XML encontrado")
-            shutil.rmtree(temp_dir)
-            return jsonify({'erro': 'Nenhum arquivo XML encontrado nos arquivos enviados'}), 400
-        
-        # Criar arquivo ZIP com os resultados
-        zip_resultado = os.path.join(TEMP_OUTPUT, f'DANFE-XML_{temp_id}.zip')
-        
-        logger.info(f"📦 Criando ZIP final: {zip_resultado}")
-        with zipfile.ZipFile(zip_resultado, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for root, dirs, files in os.walk(pasta_danfe):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    arcname = os.path.relpath(file_path, extract_dir)
-                    zipf.write(file_path, arcname)
-        
-        logger.info(f"✅ ZIP final criado com sucesso!")
-        
-        shutil.rmtree(temp_dir)
-        logger.info(f"🧹 Arquivos temporários removidos")
-        
-        logger.info("=" * 60)
-        logger.info(f"✅ PROCESSAMENTO CONCLUÍDO!")
-        logger.info(f"   Processados: {total_processados}")
-        logger.info(f"   Erros: {total_erros}")
-        logger.info("=" * 60)
-        
-        return jsonify({
-            'sucesso': True,
-            'total_processados': total_processados,
-            'total_erros': total_erros,
-            'resultados': resultados,
-            'arquivo_zip': os.path.basename(zip_resultado)
-        })
-        
-    except ValueError as e:
-        logger.error(f"🚨 TENTATIVA DE ATAQUE DETECTADA: {str(e)}")
-        return jsonify({'erro': 'Arquivo contém caminhos inválidos'}), 400
-    except Exception as e:
-        logger.error("=" * 60)
-        logger.error(f"❌ ERRO CRÍTICO NO PROCESSAMENTO")
-        logger.error(f"❌ {str(e)}")
-        logger.error(traceback.format_exc())
+class PDFUnificado:
+    """
+    Junta os DANFEs do lote em um PDF por destinatário (DANFE-XML/{nome} - {documento}/DANFE.pdf)
+    ou em um PDF só (DANFE-XML/DANFE.pdf). Os PDFs ficam em disco até o fim do lote e
+    são concatenados em ordem de chave, com recursos repetidos (fontes, imagens) deduplicados.
+    """
+    def __init__(self, pasta, saida):
+        self.pasta = pasta
+        self.saida = saida
+        self.grupos = {}
+        self.total = 0
+        os.makedirs(pasta, exist_ok=True)
+
+    def adicionar(self, doc, pdf):
+        destinatario = f"{doc.nome} - {doc.documento}"
+        destino = 'DANFE-XML/DANFE.pdf' if self.saida.modo == 'lote' else f"DANFE-XML/{destinatario}/DANFE.pdf"
+        # Contador único do lote: com destinatários intercalados, um índice por grupo se repetiria
+        self.total += 1
+        caminho = os.path.join(self.pasta, f'{self.total}.pdf')
+        with open(caminho, 'wb') as f:
+            f.write(pdf)
+        self.grupos.setdefault(destino, []).append((destinatario, doc.chave, caminho))
+
+    def gravar(self, zipf):
+        """Grava os PDFs unificados no ZIP; retorna {chave: (pdf, página inicial, página final)}"""
+        paginas = {}
+        for destino, documentos in self.grupos.items():
+            writer = PdfWriter()
+            marcadores = {}
+            for destinatario, chave, caminho in sorted(documentos):
+                pagina = len(writer.pages)
+                writer.append(caminho, import_outline=False)
+                paginas[chave] = (destino, pagina + 1, len(writer.pages))
+                if not self.saida.sumario:
+                    continue
+                # Sumário por chave de acesso; no PDF do lote, agrupado por destinatário
+                pai = None
+                if self.saida.modo == 'lote':
+                    if destinatario not in marcadores:
+                        marcadores[destinatario] = writer.add_outline_item(destinatario, pagina)
+                    pai = marcadores[destinatario]
+                writer.add_outline_item(chave, pagina, parent=pai)
+            if self.saida.sumario:
+                writer.page_mode = '/UseOutlines'
+            writer.compress_identical_objects(remove_identicals=True, remove_orphans=True)
+
+            # Em disco, não em memória: o PDF do lote pode ter milhares de páginas
+            caminho = os.path.join(self.pasta, 'unificado.pdf')
+            writer.write(caminho)
+            if ZIP_NIVEL_PDF <= 0:
+                zipf.write(caminho, destino, compress_type=zipfile.ZIP_STORED)
+            else:
+                zipf.write(caminho, destino, compress_type=zipfile.ZIP_DEFLATED, compresslevel=ZIP_NIVEL_PDF)
+            os.remove(caminho)
+            logger.info(f"📑 {destino}: {len(documentos)} DANFEs, {len(writer.pages)} páginas")
+        return paginas
+
+# ========================================
+# MANIFESTO E ÍNDICE DO LOTE
+# ========================================
+
+CAMPOS_MANIFESTO = [
+    'chave', 'destinatario', 'documento', 'emissao', 'valor', 'origem', 'status', 'mensagem',
+    'cache', 'renderizacao_ms', 'pdf', 'pagina_inicial', 'pagina_final'
+]
+
+def caminho_indice_resultado(lote_id):
+    return os.path.join(TEMP_OUTPUT, f'DANFE-XML_{lote_id}.indice.json')
+
+def abrir_no_zip(zipf, arcname):
+    """Abre um membro comprimido para escrita incremental no ZIP de resultado"""
+    info = zipfile.ZipInfo(arcname, date_time=time.localtime()[:6])
+    info.compress_type = zipfile.ZIP_DEFLATED
+    return zipf.open(info, 'w', force_zip64=True)
+
+class ManifestoLote:
+    """
+    Uma linha por XML do lote (processado, com erro, duplicado ou ignorado), gravada
+    em disco conforme o lote avança. No fim vira DANFE-XML/manifesto.csv e
+    manifesto.jsonl no ZIP e o índice chave -> PDF usado para baixar uma nota só.
+    """
+    def __init__(self, pasta):
+        self.caminho = os.path.join(pasta, '_manifesto.jsonl')
+        self.arquivo = open(self.caminho, 'w', encoding='utf-8')
+
+    def registrar(self, doc, status, mensagem='', segundos=None, pdf=None):
+        linha = {
+            'chave': doc.chave,
+            'destinatario': doc.nome,
+            'documento': doc.documento,
+            'emissao': doc.emissao,
+            'valor': doc.valor,
+            'origem': doc.origem or doc.nome_arquivo,
+            'status': status,
+            'mensagem': mensagem,
+            'cache': status == 'sucesso' and segundos is None,
+            'renderizacao_ms': round(segundos * 1000) if segundos is not None else None,
+            'pdf': pdf,
+            'pagina_inicial': None,
+            'pagina_final': None,
+        }
+        self.arquivo.write(json.dumps(linha, ensure_ascii=False) + '\n')
+
+    def linhas(self, paginas):
+        with open(self.caminho, encoding='utf-8') as f:
+            for texto in f:
+                linha = json.loads(texto)
+                if linha['status'] == 'sucesso' and linha['chave'] in paginas:
+                    linha['pdf'], linha['pagina_inicial'], linha['pagina_final'] = paginas[linha['chave']]
+                yield linha
+
+    def gravar(self, zipf, paginas):
+        """Grava CSV e JSONL no ZIP; retorna o índice {chave: [pdf, página inicial, página final]}"""
+        self.arquivo.close()
+        indice = {}
+
+        with abrir_no_zip(zipf, 'DANFE-XML/manifesto.csv') as destino:
+            # utf-8 com BOM e ';' para abrir direto no Excel em português
+            texto = io.TextIOWrapper(destino, encoding='utf-8-sig', newline='')
+            escritor = csv.DictWriter(texto, fieldnames=CAMPOS_MANIFESTO, delimiter=';')
+            escritor.writeheader()
+            for linha in self.linhas(paginas):
+                escritor.writerow(linha)
+                if linha['status'] == 'sucesso' and linha['pdf']:
+                    indice[linha['chave']] = [linha['pdf'], linha['pagina_inicial'], linha['pagina_final']]
+            texto.flush()
+            texto.detach()
+
+        with abrir_no_zip(zipf, 'DANFE-XML/manifesto.jsonl') as destino:
+            for linha in self.linhas(paginas):
+                destino.write((json.dumps(linha, ensure_ascii=False) + '\n').encode('utf-8'))
+
+        return indice
+
+def gravar_indice_resultado(lote_id, indice):
+    caminho = caminho_indice_resultado(lote_id)
+    with open(f'{caminho}.tmp', 'w', encoding='utf-8') as f:
+        json.dump(indice, f, ensure_ascii=False)
+    os.replace(f'{caminho}.tmp', caminho)
+
+def ler_indice_resultado(arquivo_zip):
+    """Índice do ZIP de resultado (DANFE-XML_{lote_id}.zip) ou None"""
+    encontrado = REGEX_RESULTADO.match(arquivo_zip)
+    if not encontrado:
+        return None
+    try:
+        with open(caminho_indice_resultado(encontrado.group(1)), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def extrair_danfe_resultado(arquivo_zip, chave):
+    """
+    PDF de uma NF-e lido direto do ZIP de resultado pelo índice, sem extrair o resto.
+    Nos PDFs unificados, copia só as páginas da nota. Retorna None se a chave não existir.
+    """
+    indice = ler_indice_resultado(arquivo_zip)
+    if indice is None or chave not in indice:
+        return None
+
+    membro, pagina_inicial, pagina_final = indice[chave]
+    with zipfile.ZipFile(os.path.join(TEMP_OUTPUT, arquivo_zip)) as zipf:
+        if pagina_inicial is None:
+            return zipf.read(membro)
+
+        # pypdf precisa de um stream com seek: o membro do ZIP vai para a memória antes
+        reader = PdfReader(io.BytesIO(zipf.read(membro)))
+        writer = PdfWriter()
+        for numero in range(pagina_inicial - 1, pagina_final):
+            writer.add_page(reader.pages[numero])
+        buffer = io.BytesIO()
+        writer.write(buffer)
+        return buffer.getvalue()
+
+def executar_lote(lote_id, temp_dir, xmls_diretos, arquivos_abertos, ao_progredir=None, ao_resultado=None,
+                  saida_pdf=SAIDA_PDF_INDIVIDUAL):
+    """
+    Renderiza todos os XMLs do lote e grava DANFE-XML_{lote_id}.zip.
+    ao_progredir(contadores) é chamado após cada XML lido.
+    ao_resultado(doc, resultado) recebe cada resultado à medida que sai; quando
+    informado, os resultados não são acumulados no resumo (modo streaming).
+    saida_pdf escolhe entre um PDF por NF-e e PDFs unificados (ver PDFUnificado).
+    O ZIP leva o manifesto do lote e o índice por chave fica ao lado (ver ManifestoLote).
+    Retorna o resumo no formato de resposta do /processar.
+    """
+    resultados = []
+    contadores = {
+        'total_xmls': contar_xmls(xmls_diretos, arquivos_abertos),
+        'xmls_lidos': 0,
+        'total_processados': 0,
+        'total_erros': 0,
+        'total_duplicados': 0,
+    }
+    duplicados = []
+    estatisticas = {}
+
+    def analisar(membros, upload=None):
+        for member, conteudo in medir_iteracao(membros, 'extracao'):
+            with medir_etapa('parsing'):
+                doc = carregar_xml(conteudo, os.path.basename(member))
+            yield member, doc._replace(origem=f"{upload}/{member}" if upload else member)
+
+    def listar_documentos():
+        """(membro, DocumentoXML) de cada XML enviado direto ou compactado, na ordem do upload"""
+        yield from analisar(xmls_diretos)
+        for arquivo_ref in arquivos_abertos:
+            upload = getattr(arquivo_ref, 'nome_upload', None) or os.path.basename(arquivo_ref.filename)
+            indices = indices_xml(arquivo_ref) if isinstance(arquivo_ref, zipfile.ZipFile) else []
+            if usar_extracao_paralela(arquivo_ref, indices):
+                yield from extrair_em_paralelo(arquivo_ref, indices, upload)
+            else:
+                yield from analisar(iterar_xmls_compactado(arquivo_ref), upload)
+
+    def listar_xmls_nfe():
+        chaves_vistas = set()
+        for member, doc in listar_documentos():
+            file = os.path.basename(member)
+
+            # ✅ Ignorar XML que não é NFe (eventos, NFSe, etc)
+            if not doc.is_nfe:
+                logger.info(f"⏭️ XML ignorado (não é NFe): {file}")
+                incrementar_metrica('danfe_documentos_total', status='ignorado')
+                manifesto.registrar(doc, 'ignorado', 'XML não é NF-e')
+            # ✅ Deduplicar por chave de acesso antes de renderizar
+            elif doc.chave and doc.chave in chaves_vistas:
+                logger.info(f"⏭️ XML duplicado (chave já presente no lote): {member}")
+                incrementar_metrica('danfe_documentos_total', status='duplicado')
+                contadores['total_duplicados'] += 1
+                duplicados.append({'arquivo': member, 'chave': doc.chave})
+                manifesto.registrar(doc, 'duplicado', 'Chave já presente no lote')
+            else:
+                chaves_vistas.add(doc.chave)
+                yield doc
+                continue
+
+            contadores['xmls_lidos'] += 1
+            if ao_progredir:
+                ao_progredir(contadores)
+
+    inicio_lote = time.perf_counter()
+    concluido = False
+    incrementar_metrica('danfe_lotes_em_andamento', 1)
+    manifesto = ManifestoLote(temp_dir)
+    try:
+        # ZIP de resultado gravado incrementalmente, conforme cada DANFE fica pronto
+        zip_resultado = os.path.join(TEMP_OUTPUT, f'DANFE-XML_{lote_id}.zip')
+        zip_parcial = f'{zip_resultado}.part'
+        logger.info(f"📦 Gravando ZIP final: {zip_resultado}")
+
+        xml_count = 0
+        ultimo_toque = time.monotonic()
+        # Compactados internos deixados de fora (ver abrir_aninhados) contam como erro do lote
+        for arquivo_ref in arquivos_abertos:
+            for origem, motivo in getattr(arquivo_ref, 'compactados_ignorados', ()):
+                doc = DocumentoXML(os.path.basename(origem), b'', 'utf-8', False, None, None, None, origem=origem)
+                manifesto.registrar(doc, 'erro', motivo)
+                contadores['total_erros'] += 1
+                resultado = {'tipo': 'erro', 'mensagem': f"{origem}: {motivo}"}
+                if ao_resultado:
+                    ao_resultado(doc, resultado)
+                else:
+                    resultados.append(resultado)
+
+        unificado = None
+        if saida_pdf.modo != 'individual':
+            unificado = PDFUnificado(os.path.join(temp_dir, '_pdfs'), saida_pdf)
+        with zipfile.ZipFile(zip_parcial, 'w') as zipf:
+            for doc, (sucesso, mensagem, pdf), segundos in renderizar_em_paralelo(listar_xmls_nfe(), estatisticas):
+                xml_count += 1
+                contadores['xmls_lidos'] += 1
+
+                if xml_count % 10 == 0:
+                    logger.info(f"📊 Processados {xml_count} XMLs...")
+
+                # Lotes longos: mantém a pasta recente para a limpeza por TTL não removê-la
+                if time.monotonic() - ultimo_toque >= intervalo_renovacao():
+                    ultimo_toque = time.monotonic()
+                    try:
+                        os.utime(temp_dir)
+                    except OSError:
+                        pass
+
+                caminho_pdf = None
+                if doc.nome and doc.documento:
+                    with medir_etapa('zip'):
+                        if unificado and pdf is not None:
+                            unificado.adicionar(doc, pdf)
+                            pdf = None
+                        caminho_pdf = gravar_documento_zip(zipf, doc, pdf)
+                manifesto.registrar(doc, 'sucesso' if sucesso else 'erro', mensagem, segundos, caminho_pdf)
+
+                incrementar_metrica('danfe_documentos_total', status='processado' if sucesso else 'erro')
+                if sucesso:
+                    contadores['total_processados'] += 1
+                    resultado = {'tipo': 'sucesso', 'mensagem': mensagem}
+                else:
+                    contadores['total_erros'] += 1
+                    resultado = {'tipo': 'erro', 'mensagem': f"{doc.nome_arquivo}: {mensagem}"}
+
+                if ao_resultado:
+                    ao_resultado(doc, resultado)
+                else:
+                    resultados.append(resultado)
+
+                if ao_progredir:
+                    ao_progredir(contadores)
+
+            paginas = {}
+            if unificado:
+                with medir_etapa('unificacao'):
+                    paginas = unificado.gravar(zipf)
+            if xml_count:
+                indice = manifesto.gravar(zipf, paginas)
+
+        logger.info(f"📊 Total de XMLs encontrados: {xml_count}")
+        
+        if xml_count == 0:
+            logger.error("❌ Nenhum arquivo XML encontrado")
+            os.remove(zip_parcial)
+            raise ErroLote('Nenhum arquivo XML encontrado nos arquivos enviados')
+        
+        gravar_indice_resultado(lote_id, indice)
+        os.replace(zip_parcial, zip_resultado)
+        concluido = True
+        logger.info(f"✅ ZIP final criado com sucesso!")
+    finally:
+        with medir_etapa('limpeza'):
+            manifesto.arquivo.close()
+            for arquivo_ref in arquivos_abertos:
+                arquivo_ref.close()
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        logger.info(f"🧹 Arquivos temporários removidos")
+        incrementar_metrica('danfe_lotes_em_andamento', -1)
+        incrementar_metrica('danfe_lotes_total', status='concluido' if concluido else 'erro')
+        observar_metrica('danfe_etapa_segundos', time.perf_counter() - inicio_lote, etapa='lote')
+    
+    logger.info("=" * 60)
+    logger.info(f"✅ PROCESSAMENTO CONCLUÍDO!")
+    logger.info(f"   Processados: {contadores['total_processados']}")
+    logger.info(f"   Erros: {contadores['total_erros']}")
+    logger.info(f"   Duplicados: {contadores['total_duplicados']}")
+    logger.info(f"   Cache: {estatisticas['cache_hits']} hits / {estatisticas['cache_misses']} misses")
+    logger.info("=" * 60)
+    
+    return {
+        'sucesso': True,
+        'total_processados': contadores['total_processados'],
+        'total_erros': contadores['total_erros'],
+        'total_duplicados': contadores['total_duplicados'],
+        'duplicados': duplicados,
+        'cache': {'hits': estatisticas['cache_hits'], 'misses': estatisticas['cache_misses']},
+        'resultados': resultados,
+        'arquivo_zip': os.path.basename(zip_resultado)
+    }
+
+# ========================================
+# AGENDAMENTO DE LOTES
+# ========================================
+
+# Limites por worker do gunicorn; valem para o /processar e para os jobs
+LOTES_SIMULTANEOS = int(os.getenv('LOTES_SIMULTANEOS', os.getenv('JOBS_WORKERS', 2)))
+LOTES_SIMULTANEOS_CLIENTE = int(os.getenv('LOTES_SIMULTANEOS_CLIENTE', 1))
+LOTES_FILA_MAX = int(os.getenv('LOTES_FILA_MAX', os.getenv('JOBS_FILA_MAX', 20)))
+LOTES_FILA_MAX_CLIENTE = int(os.getenv('LOTES_FILA_MAX_CLIENTE', 5))
+
+def cliente_da_requisicao():
+    """Chave de fila do cliente: CNPJ do X-CNPJ (validar_cnpj_api) ou IP para acesso pelo site"""
+    cnpj = g.get('cnpj')
+    # remote_addr e não access_route: o X-Forwarded-For mais à esquerda é escolhido pelo cliente (ver PROXY_HOPS)
+    return cnpj if cnpj else f'ip:{request.remote_addr}'
+
+class AgendadorLotes:
+    """
+    Fila justa de lotes: uma fila FIFO por cliente, atendidas em rodízio por
+    LOTES_SIMULTANEOS threads, com no máximo LOTES_SIMULTANEOS_CLIENTE lotes
+    do mesmo cliente rodando ao mesmo tempo. Um cliente com muitos lotes
+    não atrasa os lotes pequenos dos outros.
+    Enquanto esperam, os lotes mantêm recentes as pastas/arquivos de que
+    dependem (manter), para a limpeza por TTL não removê-los antes da execução.
+    """
+    def __init__(self):
+        self.filas = OrderedDict()
+        self.em_execucao = {}
+        self.aguardando = 0
+        self.condicao = threading.Condition()
+        self.pid = None
+
+    def tem_vaga(self, cliente):
+        """A fila aceitaria mais um lote do cliente agora? (não reserva a vaga)"""
+        with self.condicao:
+            return self.aguardando < LOTES_FILA_MAX and len(self.filas.get(cliente, ())) < LOTES_FILA_MAX_CLIENTE
+
+    def verificar_vaga(self, cliente):
+        """ErroLote(429) se a fila estiver cheia para o cliente"""
+        if not self.tem_vaga(cliente):
+            incrementar_metrica('danfe_lotes_recusados_total')
+            logger.warning(f"🚦 Fila cheia, lote recusado para {cliente}")
+            raise ErroLote('Fila de processamento cheia, tente novamente mais tarde', 429)
+
+    def submeter(self, cliente, funcao, *args, manter=()):
+        """Enfileira funcao(*args) e retorna o Future; ErroLote(429) se a fila estiver cheia"""
+        with self.condicao:
+            self.verificar_vaga(cliente)
+
+            futuro = Future()
+            self.filas.setdefault(cliente, deque()).append((cliente, futuro, funcao, args, manter))
+            self.aguardando += 1
+            self.iniciar_threads()
+            self.condicao.notify_all()
+
+        incrementar_metrica('danfe_lotes_aguardando', 1)
+        return futuro
+
+    def iniciar_threads(self):
+        # Após o fork do gunicorn as threads do processo mestre não existem no worker
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            for i in range(max(LOTES_SIMULTANEOS, 1)):
+                threading.Thread(target=self.trabalhar, daemon=True, name=f'lote-{i}').start()
+            threading.Thread(target=self.manter_aguardando, daemon=True, name='lote-manter').start()
+            logger.info(f"⚙️ Agendador de lotes iniciado com {LOTES_SIMULTANEOS} threads")
+
+    def proximo(self):
+        """Próximo lote em rodízio entre os clientes que ainda não atingiram o limite de execução"""
+        with self.condicao:
+            while True:
+                for cliente, fila in self.filas.items():
+                    if self.em_execucao.get(cliente, 0) < LOTES_SIMULTANEOS_CLIENTE:
+                        break
+                else:
+                    self.condicao.wait()
+                    continue
+
+                item = fila.popleft()
+                if fila:
+                    self.filas.move_to_end(cliente)
+                else:
+                    del self.filas[cliente]
+                self.aguardando -= 1
+                self.em_execucao[cliente] = self.em_execucao.get(cliente, 0) + 1
+                return item
+
+    def finalizar(self, cliente):
+        with self.condicao:
+            self.em_execucao[cliente] -= 1
+            if not self.em_execucao[cliente]:
+                del self.em_execucao[cliente]
+            self.condicao.notify_all()
+
+    def manter_aguardando(self):
+        """Renova o mtime do que os lotes na fila usam (o lote em execução renova o próprio temp_dir)"""
+        while True:
+            time.sleep(intervalo_renovacao())
+            with self.condicao:
+                caminhos = [caminho for fila in self.filas.values() for item in fila for caminho in item[4]]
+            for caminho in caminhos:
+                try:
+                    os.utime(caminho)
+                except OSError:
+                    pass
+
+    def trabalhar(self):
+        while True:
+            cliente, futuro, funcao, args, _ = self.proximo()
+            incrementar_metrica('danfe_lotes_aguardando', -1)
+            try:
+                if futuro.set_running_or_notify_cancel():
+                    try:
+                        futuro.set_result(funcao(*args))
+                    except BaseException as e:
+                        futuro.set_exception(e)
+            finally:
+                self.finalizar(cliente)
+
+    def resumo(self):
+        with self.condicao:
+            return {
+                'aguardando': self.aguardando,
+                'em_execucao': sum(self.em_execucao.values()),
+                'clientes_na_fila': len(self.filas),
+            }
+
+agendador_lotes = AgendadorLotes()
+
+# ========================================
+# JOBS ASSÍNCRONOS
+# ========================================
+
+JOBS_RETRY_AFTER = int(os.getenv('JOBS_RETRY_AFTER', 30))
+REGEX_JOB_ID = re.compile(r'^[0-9a-f]{32}$')
+
+def caminho_estado_job(job_id):
+    return os.path.join(TEMP_OUTPUT, f'job_{job_id}.json')
+
+def gravar_estado_job(estado):
+    """Grava o estado do job em disco (escrita atômica, visível para todos os workers)"""
+    estado['atualizado_em'] = datetime.now().isoformat()
+    caminho = caminho_estado_job(estado['job_id'])
+    tmp = f'{caminho}.{os.getpid()}.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(estado, f, ensure_ascii=False)
+    os.replace(tmp, caminho)
+
+def ler_estado_job(job_id):
+    """Lê o estado do job; jobs cujo processo morreu são reportados como erro"""
+    try:
+        with open(caminho_estado_job(job_id), 'r', encoding='utf-8') as f:
+            estado = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+    if estado['status'] in ('na_fila', 'processando') and not processo_ativo(estado.get('pid')):
+        estado['status'] = 'erro'
+        estado['erro'] = 'Processamento interrompido (worker reiniciado)'
+    return estado
+
+def processo_ativo(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except (OSError, TypeError):
+        return False
+
+def submeter_job(job_id, temp_dir, xmls_diretos, arquivos_abertos, saida_pdf=SAIDA_PDF_INDIVIDUAL):
+    """Enfileira o lote no agendador; levanta ErroLote(429) se a fila estiver cheia"""
+    estado = {
+        'job_id': job_id,
+        'status': 'na_fila',
+        'pid': os.getpid(),
+        'criado_em': datetime.now().isoformat(),
+        'total_xmls': contar_xmls(xmls_diretos, arquivos_abertos),
+        'xmls_lidos': 0,
+        'total_processados': 0,
+        'total_erros': 0,
+        'total_duplicados': 0,
+        'progresso': 0.0,
+    }
+    gravar_estado_job(estado)
+    incrementar_metrica('danfe_jobs_pendentes', 1)
+    try:
+        agendador_lotes.submeter(
+            cliente_da_requisicao(), executar_job, dict(estado), temp_dir, xmls_diretos, arquivos_abertos, saida_pdf,
+            manter=(temp_dir, caminho_estado_job(job_id))
+        )
+    except ErroLote:
+        incrementar_metrica('danfe_jobs_pendentes', -1)
+        os.remove(caminho_estado_job(job_id))
+        raise
+    return estado
+
+def executar_job(estado, temp_dir, xmls_diretos, arquivos_abertos, saida_pdf=SAIDA_PDF_INDIVIDUAL):
+    """Executa o lote em background, gravando o progresso no estado do job"""
+    ultima_gravacao = 0
+
+    def ao_progredir(contadores):
+        nonlocal ultima_gravacao
+        estado.update(contadores)
+        if contadores['total_xmls']:
+            estado['progresso'] = round(100.0 * contadores['xmls_lidos'] / contadores['total_xmls'], 1)
+        if time.monotonic() - ultima_gravacao >= 1:
+            ultima_gravacao = time.monotonic()
+            gravar_estado_job(estado)
+
+    try:
+        logger.info(f"🚀 Job {estado['job_id']} iniciado")
+        estado['status'] = 'processando'
+        gravar_estado_job(estado)
+
+        resumo = executar_lote(
+            estado['job_id'], temp_dir, xmls_diretos, arquivos_abertos, ao_progredir, saida_pdf=saida_pdf
+        )
+        estado.update(resumo)
+        estado['status'] = 'concluido'
+        estado['progresso'] = 100.0
+    except ErroLote as e:
+        estado['status'] = 'erro'
+        estado['erro'] = e.mensagem
+    except Exception as e:
+        logger.error(f"❌ Erro no job {estado['job_id']}: {str(e)}")
+        logger.error(traceback.format_exc())
+        estado['status'] = 'erro'
+        estado['erro'] = f'Erro ao processar: {str(e)}'
+    finally:
+        gravar_estado_job(estado)
+        incrementar_metrica('danfe_jobs_pendentes', -1)
+
+def iniciar_job(job_id, temp_dir, arquivos, remover_em_erro=True, saida_pdf=SAIDA_PDF_INDIVIDUAL):
+    """Abre as fontes do upload em temp_dir e enfileira o job"""
+    try:
+        with medir_etapa('abertura'):
+            xmls_diretos, arquivos_abertos = abrir_fontes(arquivos, temp_dir)
+        try:
+            estado = submeter_job(job_id, temp_dir, xmls_diretos, arquivos_abertos, saida_pdf)
+        except Exception:
+            for arquivo_ref in arquivos_abertos:
+                arquivo_ref.close()
+            raise
+    except Exception:
+        if remover_em_erro:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        raise
+
+    logger.info(f"📥 Job {job_id} enfileirado ({estado['total_xmls']} XMLs)")
+    return estado
+
+def resposta_job(job_id, estado):
+    return jsonify({
+        'job_id': job_id,
+        'status': estado['status'],
+        'status_url': f'/jobs/{job_id}',
+        'result_url': f'/jobs/{job_id}/result'
+    }), 202
+
+def resposta_erro_lote(e):
+    resposta = jsonify({'erro': e.mensagem})
+    if e.status == 429:
+        resposta.headers['Retry-After'] = str(JOBS_RETRY_AFTER)
+    return resposta, e.status
+
+# ========================================
+# STREAMING DE PROGRESSO (NDJSON / SSE)
+# ========================================
+
+# Intervalo máximo sem eventos antes de mandar um keepalive (proxies derrubam conexões ociosas)
+STREAM_KEEPALIVE = int(os.getenv('STREAM_KEEPALIVE', '15'))
+# Intervalo mínimo entre eventos de progresso
+STREAM_INTERVALO_PROGRESSO = 0.5
+
+def formato_stream():
+    """'ndjson' ou 'sse' quando o cliente pede resposta em streaming (?stream= ou Accept)"""
+    formato = request.args.get('stream', '').lower()
+    if formato in ('ndjson', 'sse'):
+        return formato
+    aceita = request.headers.get('Accept', '')
+    if 'application/x-ndjson' in aceita:
+        return 'ndjson'
+    if 'text/event-stream' in aceita:
+        return 'sse'
+    return None
+
+def formatar_evento(formato, evento):
+    dados = json.dumps(evento, ensure_ascii=False)
+    if formato == 'sse':
+        return f"event: {evento['tipo']}\ndata: {dados}\n\n"
+    return dados + '\n'
+
+def resposta_lote_em_stream(formato, lote_id, temp_dir, xmls_diretos, arquivos_abertos, saida_pdf=SAIDA_PDF_INDIVIDUAL):
+    """
+    Enfileira o lote e responde com um evento por linha, à medida que o lote avança:
+    na_fila, inicio, progresso, documento (um por DANFE) e, por último, resumo
+    (sem a lista de resultados, com o link do ZIP) ou erro.
+    Levanta ErroLote antes de abrir o stream se a fila recusar o lote.
+    """
+    eventos = queue.Queue()
+    encerrado = threading.Event()
+    ultimo_progresso = 0
+
+    def emitir(evento):
+        # Cliente desconectou: o lote termina normalmente, mas ninguém lê mais os eventos
+        if not encerrado.is_set():
+            eventos.put(evento)
+
+    def ao_progredir(contadores):
+        nonlocal ultimo_progresso
+        fim = contadores['xmls_lidos'] >= contadores['total_xmls']
+        if not fim and time.monotonic() - ultimo_progresso < STREAM_INTERVALO_PROGRESSO:
+            return
+        ultimo_progresso = time.monotonic()
+        evento = dict(contadores, tipo='progresso')
+        if contadores['total_xmls']:
+            evento['progresso'] = round(100.0 * contadores['xmls_lidos'] / contadores['total_xmls'], 1)
+        emitir(evento)
+
+    def ao_resultado(doc, resultado):
+        emitir({
+            'tipo': 'documento',
+            'status': resultado['tipo'],
+            'arquivo': doc.nome_arquivo,
+            'chave': doc.chave,
+            'mensagem': resultado['mensagem']
+        })
+
+    def executar():
+        emitir({'tipo': 'inicio'})
+        return executar_lote(lote_id, temp_dir, xmls_diretos, arquivos_abertos, ao_progredir, ao_resultado, saida_pdf)
+
+    total_xmls = contar_xmls(xmls_diretos, arquivos_abertos)
+    futuro = agendador_lotes.submeter(cliente_da_requisicao(), executar, manter=(temp_dir,))
+    # Roda na thread do lote depois do último evento, então fecha a fila na ordem certa
+    futuro.add_done_callback(lambda _: eventos.put(None))
+
+    def gerar():
+        try:
+            yield formatar_evento(formato, {'tipo': 'na_fila', 'total_xmls': total_xmls})
+            while True:
+                try:
+                    evento = eventos.get(timeout=STREAM_KEEPALIVE)
+                except queue.Empty:
+                    yield ': keepalive\n\n' if formato == 'sse' else formatar_evento(formato, {'tipo': 'keepalive'})
+                    continue
+                if evento is None:
+                    break
+                yield formatar_evento(formato, evento)
+
+            try:
+                resumo = futuro.result()
+                resumo.pop('resultados', None)
+                resumo['download_url'] = f"/download/{resumo['arquivo_zip']}"
+                yield formatar_evento(formato, dict(resumo, tipo='resumo'))
+            except ErroLote as e:
+                yield formatar_evento(formato, {'tipo': 'erro', 'erro': e.mensagem})
+            except Exception as e:
+                logger.error(f"❌ Erro no lote {lote_id}: {str(e)}")
+                logger.error(traceback.format_exc())
+                yield formatar_evento(formato, {'tipo': 'erro', 'erro': f'Erro ao processar: {str(e)}'})
+        finally:
+            encerrado.set()
+
+    return app.response_class(
+        gerar(),
+        mimetype='text/event-stream' if formato == 'sse' else 'application/x-ndjson',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+# ========================================
+# LIMPEZA EM BACKGROUND
+# ========================================
+
+# Um único worker por vez (lease via flock) remove uploads e resultados antigos,
+# fora do caminho das requisições.
+CLEANUP_TTL_SECONDS = int(os.getenv('CLEANUP_TTL_SECONDS', 3600))
+CLEANUP_INTERVALO = int(os.getenv('CLEANUP_INTERVALO', 60))
+CLEANUP_DISCO_MAX_PCT = float(os.getenv('CLEANUP_DISCO_MAX_PCT', 90))
+REGEX_RESULTADO = re.compile(r'^DANFE-XML_(\w+)\.zip$')
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+_limpeza_pid = None
+_limpeza_lock = threading.Lock()
+
+def intervalo_renovacao():
+    """De quanto em quanto tempo lotes na fila ou em execução renovam o mtime das suas pastas"""
+    return max(min(60, CLEANUP_TTL_SECONDS / 2), 1)
+
+def remover_item(caminho):
+    if os.path.isdir(caminho):
+        shutil.rmtree(caminho)
+    else:
+        os.remove(caminho)
+
+def cleanup_old_files():
+    """Remove arquivos temporários e resultados mais antigos que CLEANUP_TTL_SECONDS"""
+    limite = time.time() - CLEANUP_TTL_SECONDS
+    removidos = 0
+
+    for folder in [UPLOAD_FOLDER, TEMP_OUTPUT]:
+        if not os.path.exists(folder):
+            continue
+
+        for item in os.listdir(folder):
+            if item.startswith('.'):
+                continue
+            item_path = os.path.join(folder, item)
+
+            try:
+                if os.path.getmtime(item_path) < limite:
+                    remover_item(item_path)
+                    removidos += 1
+                    logger.debug(f"🧹 Removido arquivo antigo: {item}")
+            except FileNotFoundError:
+                continue
+            except Exception as e:
+                logger.warning(f"⚠️ Não foi possível remover {item}: {str(e)}")
+
+    return removidos
+
+def liberar_espaco_disco():
+    """Com o disco acima de CLEANUP_DISCO_MAX_PCT, remove os resultados mais antigos primeiro"""
+    if CLEANUP_DISCO_MAX_PCT <= 0 or not os.path.exists(TEMP_OUTPUT):
+        return 0
+
+    uso = shutil.disk_usage(TEMP_OUTPUT)
+    excesso = uso.used - uso.total * CLEANUP_DISCO_MAX_PCT / 100
+    if excesso <= 0:
+        return 0
+
+    resultados = []
+    for nome in os.listdir(TEMP_OUTPUT):
+        encontrado = REGEX_RESULTADO.match(nome)
+        if not encontrado:
+            continue
+        try:
+            info = os.stat(os.path.join(TEMP_OUTPUT, nome))
+        except OSError:
+            continue
+        resultados.append((info.st_mtime, info.st_size, nome, encontrado.group(1)))
+
+    removidos = 0
+    for _, tamanho, nome, lote_id in sorted(resultados):
+        if excesso <= 0:
+            break
+        try:
+            os.remove(os.path.join(TEMP_OUTPUT, nome))
+        except OSError:
+            continue
+        # Sem o ZIP, o estado do job e o índice apontariam para um resultado inexistente
+        for caminho in (caminho_estado_job(lote_id), caminho_indice_resultado(lote_id)):
+            try:
+                os.remove(caminho)
+            except OSError:
+                pass
+        excesso -= tamanho
+        removidos += 1
+
+    logger.warning(f"💽 Disco acima de {CLEANUP_DISCO_MAX_PCT:g}%: {removidos} resultados antigos removidos")
+    return removidos
+
+def obter_lease_limpeza():
+    """
+    Tenta assumir a limpeza com um flock exclusivo em TEMP_OUTPUT/.limpeza.lock.
+    O lock fica com o processo enquanto ele viver; se o worker morrer, outro assume.
+    Retorna o arquivo do lock, ou None se outro worker já é o responsável.
+    """
+    os.makedirs(TEMP_OUTPUT, exist_ok=True)
+    arquivo = open(os.path.join(TEMP_OUTPUT, '.limpeza.lock'), 'a')
+    if fcntl is None:
+        # Sem flock (Windows/desenvolvimento): cada processo limpa por conta própria
+        return arquivo
+
+    try:
+        fcntl.flock(arquivo, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        arquivo.close()
+        return None
+    return arquivo
+
+def limpar_em_background():
+    lease = None
+    while True:
+        try:
+            if lease is None:
+                lease = obter_lease_limpeza()
+                if lease is not None:
+                    logger.info(f"🧹 Limpeza em background assumida pelo processo {os.getpid()}")
+
+            if lease is not None:
+                with medir_etapa('coleta'):
+                    removidos_ttl = cleanup_old_files()
+                    removidos_disco = liberar_espaco_disco()
+                    podar_cache()
+                if removidos_ttl:
+                    incrementar_metrica('danfe_limpeza_removidos_total', removidos_ttl, motivo='ttl')
+                if removidos_disco:
+                    incrementar_metrica('danfe_limpeza_removidos_total', removidos_disco, motivo='disco')
+        except Exception as e:
+            logger.error(f"❌ Erro ao limpar arquivos antigos: {str(e)}")
+
+        time.sleep(CLEANUP_INTERVALO)
+
+def iniciar_limpeza():
+    """Inicia a thread de limpeza no processo atual (uma vez por worker, após o fork)"""
+    global _limpeza_pid
+    if _limpeza_pid == os.getpid():
+        return
+    with _limpeza_lock:
+        if _limpeza_pid != os.getpid():
+            _limpeza_pid = os.getpid()
+            threading.Thread(target=limpar_em_background, daemon=True, name='limpeza').start()
+
+@app.before_request
+def garantir_limpeza_em_background():
+    iniciar_limpeza()
+
+@app.before_request
+def garantir_pool_aquecido():
+    # Sem --preload (ou no servidor de desenvolvimento) o pool sobe na primeira requisição
+    preaquecer_pool()
+
+# ========================================
+# UPLOAD EM PARTES (RETOMÁVEL)
+# ========================================
+
+UPLOAD_CHUNK_MAX_MB = int(os.getenv('UPLOAD_CHUNK_MAX_MB', 32))
+# Sessões abertas (ainda não concluídas) por cliente; cada uma reserva até MAX_CONTENT_LENGTH em disco
+UPLOAD_SESSOES_MAX_CLIENTE = int(os.getenv('UPLOAD_SESSOES_MAX_CLIENTE', 5))
+EXTENSOES_UPLOAD = ('.zip', '.rar', '.xml')
+
+def pasta_sessao_upload(sessao_id):
+    return os.path.join(UPLOAD_FOLDER, f'upload_{sessao_id}')
+
+def ler_sessao_upload(sessao_id):
+    """Metadados da sessão de upload em partes (ou None se não existir)"""
+    if not REGEX_JOB_ID.match(sessao_id):
+        return None
+    try:
+        with open(os.path.join(pasta_sessao_upload(sessao_id), 'sessao.json'), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def gravar_sessao_upload(sessao):
+    caminho = os.path.join(pasta_sessao_upload(sessao['sessao_id']), 'sessao.json')
+    tmp = f'{caminho}.{os.getpid()}.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(sessao, f, ensure_ascii=False)
+    os.replace(tmp, caminho)
+
+def upload_encerrado(sessao):
+    """Sessão já concluída ou em conclusão: o arquivo montado pertence (ou vai pertencer) ao job"""
+    return bool(sessao.get('job_id')) or os.path.exists(os.path.join(pasta_sessao_upload(sessao['sessao_id']), 'concluir.lock'))
+
+def sessoes_abertas(cliente):
+    """Sessões de upload do cliente ainda não concluídas (as abandonadas saem na limpeza por TTL)"""
+    total = 0
+    for nome in os.listdir(UPLOAD_FOLDER) if os.path.isdir(UPLOAD_FOLDER) else ():
+        if not nome.startswith('upload_'):
+            continue
+        sessao = ler_sessao_upload(nome[len('upload_'):])
+        if sessao and sessao.get('cliente') == cliente and not sessao.get('job_id'):
+            total += 1
+    return total
+
+def partes_recebidas(sessao_id):
+    """Índices das partes já recebidas e conferidas (marcadores parte_NNNNNN.ok)"""
+    pasta = pasta_sessao_upload(sessao_id)
+    return sorted(
+        int(nome[6:-3]) for nome in os.listdir(pasta)
+        if nome.startswith('parte_') and nome.endswith('.ok')
+    )
+
+def resumo_sessao_upload(sessao):
+    recebidos = partes_recebidas(sessao['sessao_id'])
+    faltando = sorted(set(range(sessao['total_chunks'])) - set(recebidos))
+    return {
+        'sessao_id': sessao['sessao_id'],
+        'tamanho': sessao['tamanho'],
+        'tamanho_chunk': sessao['tamanho_chunk'],
+        'total_chunks': sessao['total_chunks'],
+        'recebidos': recebidos,
+        'proximo': faltando[0] if faltando else None,
+        'job_id': sessao.get('job_id'),
+    }
+
+# ========================================
+# ROTAS DA APLICAÇÃO
+# ========================================
+
+@app.route('/')
+def index():
+    return render_template('index.html')
+
+@app.route('/favicon.ico')
+def favicon():
+    """Rota explícita para favicon"""
+    return send_from_directory(
+        os.path.join(app.root_path, 'static'),
+        'favicon.ico',
+        mimetype='image/vnd.microsoft.icon'
+    ) if os.path.exists(os.path.join(app.root_path, 'static', 'favicon.ico')) else ('', 204)
+
+@app.route('/health')
+def health():
+    """Endpoint para verificar saúde da aplicação"""
+    return jsonify({
+        'status': 'erro' if _autoteste['status'] == 'falhou' else 'ok',
+        'timestamp': datetime.now().isoformat(),
+        'environment': 'production' if IS_PRODUCTION else 'development',
+        'rar_support': RAR_AVAILABLE,
+        'cache': dict(_cache_estatisticas, habilitado=CACHE_MAX_MB > 0),
+        'fila': agendador_lotes.resumo(),
+        'renderizador': dict(_autoteste, workers=RENDER_WORKERS)
+    }), 503 if _autoteste['status'] == 'falhou' else 200
+
+@app.route('/metrics')
+def metrics():
+    """Métricas de todos os workers no formato de texto do Prometheus"""
+    gravar_snapshot_metricas()
+    total = agregar_metricas()
+    # Pastas compartilhadas entre os workers: medidas na coleta, no máximo a cada METRICS_DISCO_TTL segundos
+    total['gauge']['danfe_disco_bytes'] = {
+        rotulos_metrica({'pasta': nome}): tamanho_pasta_em_cache(pasta)
+        for nome, pasta in (('uploads', UPLOAD_FOLDER), ('resultados', TEMP_OUTPUT), ('cache', CACHE_FOLDER))
+    }
+    return formatar_metricas(total), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@app.route('/processar', methods=['POST', 'OPTIONS'])
+@validar_cnpj_api
+def processar():
+    """
+    Processamento síncrono: responde ao final do lote, ou vai enviando o progresso
+    em NDJSON/SSE quando pedido com ?stream=ndjson|sse (ou pelo Accept)
+    """
+    if request.method == 'OPTIONS':
+        return '', 204
+    
+    logger.info("=" * 60)
+    logger.info("🚀 INICIANDO PROCESSAMENTO")
+    logger.info("=" * 60)
+    
+    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+    os.makedirs(TEMP_OUTPUT, exist_ok=True)
+    
+    temp_id = str(uuid.uuid4())[:8]
+    temp_dir = os.path.join(UPLOAD_FOLDER, f'temp_{temp_id}')
+    os.makedirs(temp_dir, exist_ok=True)
+    request.pasta_upload = temp_dir
+    
+    try:
+        try:
+            # Fila cheia: 429 antes de receber o upload, sem gastar banda nem disco
+            agendador_lotes.verificar_vaga(cliente_da_requisicao())
+            with medir_etapa('upload'):
+                arquivos = obter_arquivos_enviados()
+            saida_pdf = obter_saida_pdf()
+            with medir_etapa('abertura'):
+                xmls_diretos, arquivos_abertos = abrir_fontes(arquivos, temp_dir)
+        except Exception:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            raise
+
+        try:
+            formato = formato_stream()
+            if formato:
+                return resposta_lote_em_stream(formato, temp_id, temp_dir, xmls_diretos, arquivos_abertos, saida_pdf)
+            futuro = agendador_lotes.submeter(
+                cliente_da_requisicao(), executar_lote, temp_id, temp_dir, xmls_diretos, arquivos_abertos,
+                None, None, saida_pdf, manter=(temp_dir,)
+            )
+        except ErroLote:
+            for arquivo_ref in arquivos_abertos:
+                arquivo_ref.close()
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            raise
+
+        # A thread da requisição espera a vez do lote na fila do agendador
+        return jsonify(futuro.result())
+        
+    except ErroLote as e:
+        return resposta_erro_lote(e)
+    except ValueError as e:
+        logger.error(f"🚨 TENTATIVA DE ATAQUE DETECTADA: {str(e)}")
+        return jsonify({'erro': 'Arquivo contém caminhos inválidos'}), 400
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error("=" * 60)
+        logger.error(f"❌ ERRO CRÍTICO NO PROCESSAMENTO")
+        logger.error(f"❌ {str(e)}")
+        logger.error(traceback.format_exc())
         logger.error("=" * 60)
         return jsonify({'erro': f'Erro ao processar: {str(e)}'}), 500
 
+@app.route('/jobs', methods=['POST', 'OPTIONS'])
+@validar_cnpj_api
+def criar_job():
+    """Recebe o upload e enfileira o lote; responde imediatamente com o id do job"""
+    if request.method == 'OPTIONS':
+        return '', 204
+    
+    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+    os.makedirs(TEMP_OUTPUT, exist_ok=True)
+    
+    job_id = uuid.uuid4().hex
+    temp_dir = os.path.join(UPLOAD_FOLDER, f'temp_{job_id}')
+    os.makedirs(temp_dir, exist_ok=True)
+    request.pasta_upload = temp_dir
+    
+    try:
+        try:
+            # Fila cheia: 429 antes de receber o upload, sem gastar banda nem disco
+            agendador_lotes.verificar_vaga(cliente_da_requisicao())
+            with medir_etapa('upload'):
+                arquivos = obter_arquivos_enviados()
+            saida_pdf = obter_saida_pdf()
+        except Exception:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            raise
+
+        estado = iniciar_job(job_id, temp_dir, arquivos, saida_pdf=saida_pdf)
+        return resposta_job(job_id, estado)
+        
+    except ErroLote as e:
+        return resposta_erro_lote(e)
+    except ValueError as e:
+        logger.error(f"🚨 TENTATIVA DE ATAQUE DETECTADA: {str(e)}")
+        return jsonify({'erro': 'Arquivo contém caminhos inválidos'}), 400
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"❌ Erro ao criar job: {str(e)}")
+        logger.error(traceback.format_exc())
+        return jsonify({'erro': f'Erro ao processar: {str(e)}'}), 500
+
+@app.route('/jobs/<job_id>')
+def status_job(job_id):
+    """Progresso e contadores do job"""
+    estado = ler_estado_job(job_id) if REGEX_JOB_ID.match(job_id) else None
+    if estado is None:
+        return jsonify({'erro': 'Job não encontrado'}), 404
+    
+    estado.pop('pid', None)
+    return jsonify(estado)
+
+def estado_job_concluido(job_id):
+    """(estado, None) do job concluído ou (None, resposta de erro)"""
+    estado = ler_estado_job(job_id) if REGEX_JOB_ID.match(job_id) else None
+    if estado is None:
+        return None, (jsonify({'erro': 'Job não encontrado'}), 404)
+    
+    if estado['status'] == 'erro':
+        return None, (jsonify({'erro': estado.get('erro', 'Erro ao processar')}), 409)
+    
+    if estado['status'] != 'concluido':
+        resposta = jsonify({'erro': 'Job ainda em processamento', 'progresso': estado.get('progresso', 0)})
+        resposta.headers['Retry-After'] = '5'
+        return None, (resposta, 409)
+    
+    return estado, None
+
+@app.route('/jobs/<job_id>/result')
+def resultado_job(job_id):
+    """Download do ZIP de resultado de um job concluído"""
+    estado, erro = estado_job_concluido(job_id)
+    if erro:
+        return erro
+    
+    return download(estado['arquivo_zip'])
+
+@app.route('/jobs/<job_id>/danfe/<chave>')
+def danfe_job(job_id, chave):
+    """PDF de uma única NF-e do resultado de um job concluído"""
+    estado, erro = estado_job_concluido(job_id)
+    if erro:
+        return erro
+    
+    return download_danfe(estado['arquivo_zip'], chave)
+
+@app.route('/uploads', methods=['POST', 'OPTIONS'])
+@validar_cnpj_api
+def criar_upload():
+    """
+    Abre uma sessão de upload em partes.
+    Corpo JSON: nome, tamanho, tamanho_chunk e (opcional) sha256 do arquivo inteiro.
+    """
+    if request.method == 'OPTIONS':
+        return '', 204
+    
+    dados = request.get_json(silent=True) or {}
+    nome = limpar_nome_arquivo(os.path.basename(str(dados.get('nome', ''))))
+    tamanho = dados.get('tamanho')
+    tamanho_chunk = dados.get('tamanho_chunk')
+    
+    if not nome.lower().endswith(EXTENSOES_UPLOAD):
+        return jsonify({'erro': 'Nome de arquivo inválido (use .zip, .rar ou .xml)'}), 400
+    
+    if not isinstance(tamanho, int) or not isinstance(tamanho_chunk, int) or tamanho <= 0 or tamanho_chunk <= 0:
+        return jsonify({'erro': 'tamanho e tamanho_chunk devem ser inteiros positivos'}), 400
+    
+    if tamanho > app.config['MAX_CONTENT_LENGTH']:
+        return jsonify({'erro': 'Arquivo excede o tamanho máximo permitido'}), 413
+    
+    if tamanho_chunk > UPLOAD_CHUNK_MAX_MB * 1024 * 1024:
+        return jsonify({'erro': f'tamanho_chunk excede {UPLOAD_CHUNK_MAX_MB}MB'}), 400
+    
+    cliente = cliente_da_requisicao()
+    if sessoes_abertas(cliente) >= UPLOAD_SESSOES_MAX_CLIENTE:
+        logger.warning(f"🚦 Limite de sessões de upload atingido para {cliente}")
+        return resposta_erro_lote(ErroLote(
+            f'Limite de {UPLOAD_SESSOES_MAX_CLIENTE} uploads em andamento atingido, conclua um deles ou tente mais tarde', 429
+        ))
+    
+    sessao_id = uuid.uuid4().hex
+    pasta = pasta_sessao_upload(sessao_id)
+    os.makedirs(pasta, exist_ok=True)
+    
+    # Arquivo final pré-alocado: cada parte é gravada direto na sua posição
+    arquivo = f'upload_{nome}'
+    with open(os.path.join(pasta, arquivo), 'wb') as f:
+        f.truncate(tamanho)
+    
+    sessao = {
+        'sessao_id': sessao_id,
+        'nome': nome,
+        'arquivo': arquivo,
+        'tamanho': tamanho,
+        'tamanho_chunk': tamanho_chunk,
+        'total_chunks': -(-tamanho // tamanho_chunk),
+        'sha256': str(dados.get('sha256') or '').lower() or None,
+        'cliente': cliente,
+        'criado_em': datetime.now().isoformat(),
+    }
+    gravar_sessao_upload(sessao)
+    
+    logger.info(f"📤 Sessão de upload {sessao_id} criada: {nome} ({sessao['total_chunks']} partes)")
+    return jsonify(resumo_sessao_upload(sessao)), 201
+
+@app.route('/uploads/<sessao_id>')
+@validar_cnpj_api
+def status_upload(sessao_id):
+    """Partes já recebidas da sessão, para o cliente retomar da primeira que falta"""
+    sessao = ler_sessao_upload(sessao_id)
+    if sessao is None:
+        return jsonify({'erro': 'Sessão de upload não encontrada'}), 404
+    
+    return jsonify(resumo_sessao_upload(sessao))
+
+@app.route('/uploads/<sessao_id>/<int:indice>', methods=['PUT', 'OPTIONS'])
+@validar_cnpj_api
+def enviar_parte_upload(sessao_id, indice):
+    """Recebe uma parte (corpo bruto) e confere o SHA-256 do header X-Chunk-SHA256"""
+    if request.method == 'OPTIONS':
+        return '', 204
+    
+    sessao = ler_sessao_upload(sessao_id)
+    if sessao is None:
+        return jsonify({'erro': 'Sessão de upload não encontrada'}), 404
+    
+    # Depois do concluir o arquivo montado pertence ao job
+    if upload_encerrado(sessao):
+        return jsonify({'erro': 'Upload já concluído', 'job_id': sessao.get('job_id')}), 409
+
+    if indice >= sessao['total_chunks']:
+        return jsonify({'erro': 'Índice de parte inválido'}), 400
+    
+    inicio = indice * sessao['tamanho_chunk']
+    esperado = min(sessao['tamanho_chunk'], sessao['tamanho'] - inicio)
+    sha_esperado = request.headers.get('X-Chunk-SHA256', '').lower()
+    
+    if request.content_length != esperado:
+        return jsonify({'erro': f'Tamanho da parte inválido (esperado {esperado} bytes)'}), 400
+    
+    if not sha_esperado:
+        return jsonify({'erro': 'Header X-Chunk-SHA256 obrigatório'}), 400
+    
+    pasta = pasta_sessao_upload(sessao_id)
+    sha = hashlib.sha256()
+    recebido = 0
+    try:
+        with medir_etapa('upload'), open(os.path.join(pasta, sessao['arquivo']), 'r+b') as f:
+            f.seek(inicio)
+            while True:
+                bloco = request.stream.read(64 * 1024)
+                if not bloco:
+                    break
+                sha.update(bloco)
+                f.write(bloco)
+                recebido += len(bloco)
+    except FileNotFoundError:
+        # Concluir (ou a limpeza) levou o arquivo entre a checagem acima e a abertura
+        sessao = ler_sessao_upload(sessao_id)
+        if sessao is None:
+            return jsonify({'erro': 'Sessão de upload não encontrada'}), 404
+        return jsonify({'erro': 'Upload já concluído', 'job_id': sessao.get('job_id')}), 409
+    
+    # Concluir começou durante a gravação: a parte não é registrada
+    sessao = ler_sessao_upload(sessao_id) or sessao
+    if upload_encerrado(sessao):
+        return jsonify({'erro': 'Upload já concluído', 'job_id': sessao.get('job_id')}), 409
+    
+    if recebido != esperado or sha.hexdigest() != sha_esperado:
+        logger.warning(f"⚠️ Parte {indice} da sessão {sessao_id} com checksum inválido")
+        return jsonify({'erro': 'Checksum da parte não confere'}), 400
+    
+    marcador = os.path.join(pasta, f'parte_{indice:06d}.ok')
+    with open(f'{marcador}.tmp', 'w') as f:
+        f.write(sha_esperado)
+    os.replace(f'{marcador}.tmp', marcador)
+    
+    return jsonify({'indice': indice, 'recebido': True})
+
+@app.route('/uploads/<sessao_id>/concluir', methods=['POST', 'OPTIONS'])
+@validar_cnpj_api
+def concluir_upload(sessao_id):
+    """
+    Confere que todas as partes chegaram e enfileira o job com o arquivo montado,
+    movido para a pasta do job. A sessão continua registrando o job_id, para um
+    concluir repetido ou um GET /uploads/<id> devolverem o mesmo job.
+    """
+    if request.method == 'OPTIONS':
+        return '', 204
+    
+    sessao = ler_sessao_upload(sessao_id)
+    if sessao is None:
+        return jsonify({'erro': 'Sessão de upload não encontrada'}), 404
+    
+    if sessao.get('job_id'):
+        return resposta_job(sessao['job_id'], ler_estado_job(sessao['job_id']) or {'status': 'processando'})
+    
+    resumo = resumo_sessao_upload(sessao)
+    if resumo['proximo'] is not None:
+        faltando = sorted(set(range(sessao['total_chunks'])) - set(resumo['recebidos']))
+        return jsonify({'erro': 'Upload incompleto', 'faltando': faltando[:100]}), 409
+    
+    pasta = pasta_sessao_upload(sessao_id)
+    caminho = os.path.join(pasta, sessao['arquivo'])
+    
+    # Trava entre workers: só uma conclusão por sessão
+    trava = os.path.join(pasta, 'concluir.lock')
+    try:
+        os.close(os.open(trava, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        return jsonify({'erro': 'Upload já está sendo concluído'}), 409
+    
+    try:
+        # Fila cheia: 429 antes de conferir o checksum e abrir o arquivo montado
+        agendador_lotes.verificar_vaga(cliente_da_requisicao())
+        saida_pdf = obter_saida_pdf()
+        if sessao['sha256']:
+            sha = hashlib.sha256()
+            with open(caminho, 'rb') as f:
+                for bloco in iter(lambda: f.read(1024 * 1024), b''):
+                    sha.update(bloco)
+            if sha.hexdigest() != sessao['sha256']:
+                logger.warning(f"⚠️ Checksum final inválido na sessão {sessao_id}, partes descartadas")
+                for indice in resumo['recebidos']:
+                    os.remove(os.path.join(pasta, f'parte_{indice:06d}.ok'))
+                return jsonify({'erro': 'Checksum do arquivo não confere, reenvie as partes'}), 400
+        
+        os.makedirs(TEMP_OUTPUT, exist_ok=True)
+        job_id = uuid.uuid4().hex
+        temp_dir = os.path.join(UPLOAD_FOLDER, f'temp_{job_id}')
+        os.makedirs(temp_dir)
+        destino = os.path.join(temp_dir, sessao['arquivo'])
+        os.replace(caminho, destino)
+        try:
+            with open(destino, 'rb') as stream:
+                arquivo = FileStorage(stream=stream, filename=sessao['nome'])
+                estado = iniciar_job(job_id, temp_dir, [arquivo], remover_em_erro=False, saida_pdf=saida_pdf)
+        except Exception:
+            # Devolve o arquivo à sessão: o cliente pode tentar concluir de novo (429, por exemplo)
+            os.replace(destino, caminho)
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            raise
+        
+        sessao['job_id'] = job_id
+        gravar_sessao_upload(sessao)
+        return resposta_job(job_id, estado)
+        
+    except ErroLote as e:
+        return resposta_erro_lote(e)
+    except ValueError as e:
+        logger.error(f"🚨 TENTATIVA DE ATAQUE DETECTADA: {str(e)}")
+        return jsonify({'erro': 'Arquivo contém caminhos inválidos'}), 400
+    except Exception as e:
+        logger.error(f"❌ Erro ao concluir upload {sessao_id}: {str(e)}")
+        logger.error(traceback.format_exc())
+        return jsonify({'erro': f'Erro ao processar: {str(e)}'}), 500
+    finally:
+        if not sessao.get('job_id'):
+            try:
+                os.remove(trava)
+            except OSError:
+                pass
+
 @app.route('/download/<filename>')
 def download(filename):
     """Endpoint para download do arquivo ZIP processado"""
@@ -489,22 +2487,96 @@ def download(filename):
             logger.error(f"❌ Arquivo não encontrado: {safe_filename}")
             return jsonify({'erro': 'Arquivo não encontrado'}), 404
         
-        logger.info(f"⬇️ Download iniciado: {safe_filename}")
+        if 'Range' in request.headers:
+            logger.info(f"⬇️ Download retomado: {safe_filename} ({request.headers['Range']})")
+        else:
+            logger.info(f"⬇️ Download iniciado: {safe_filename}")
         
-        return send_file(
+        # conditional/etag: responde 206 a Range (validado por If-Range) e 304 a If-None-Match
+        resposta = send_file(
             file_path,
             as_attachment=True,
             download_name='DANFE-XML.zip',
-            max_age=0
+            max_age=0,
+            conditional=True,
+            etag=True
         )
+        resposta.headers['Accept-Ranges'] = 'bytes'
+        return resposta
     except Exception as e:
         logger.error(f"❌ Erro ao baixar arquivo: {str(e)}")
         return jsonify({'erro': f'Erro ao baixar arquivo: {str(e)}'}), 500
 
+@app.route('/download/<filename>/danfe/<chave>')
+def download_danfe(filename, chave):
+    """PDF de uma única NF-e, lido do ZIP de resultado pelo índice do lote"""
+    try:
+        pdf = extrair_danfe_resultado(os.path.basename(filename), chave)
+        if pdf is None:
+            return jsonify({'erro': 'DANFE não encontrado no resultado'}), 404
+        
+        logger.info(f"⬇️ DANFE avulso: {chave} de {filename}")
+        return send_file(io.BytesIO(pdf), mimetype='application/pdf', download_name=f'{chave}.pdf', max_age=0)
+    except Exception as e:
+        logger.error(f"❌ Erro ao extrair DANFE {chave}: {str(e)}")
+        return jsonify({'erro': f'Erro ao extrair DANFE: {str(e)}'}), 500
+
+@app.route('/danfe', methods=['POST', 'OPTIONS'])
+@validar_cnpj_api
+def danfe_avulso():
+    """
+    Renderiza um único XML (corpo da requisição ou campo 'arquivo') e devolve o PDF,
+    sem pasta temporária. ETag forte = sha256 do XML: If-None-Match igual responde 304
+    sem renderizar; o cache de DANFEs evita renderizar de novo o mesmo XML.
+    """
+    if request.method == 'OPTIONS':
+        return '', 204
+    
+    # Fora do multipart o corpo é o próprio XML (sem deixar o parser de formulário consumi-lo)
+    arquivo = request.files.get('arquivo') if request.mimetype == 'multipart/form-data' else None
+    conteudo = arquivo.read() if arquivo else request.get_data()
+    if not conteudo:
+        return jsonify({'erro': 'Envie o XML no corpo da requisição ou no campo arquivo'}), 400
+    
+    etag = hashlib.sha256(conteudo).hexdigest()
+    if request.if_none_match.contains(etag):
+        resposta = app.response_class(status=304)
+        resposta.set_etag(etag)
+        return resposta
+    
+    try:
+        with medir_etapa('parsing'):
+            doc = carregar_xml(conteudo, limpar_nome_arquivo(arquivo.filename) if arquivo else 'documento.xml')
+        if not doc.is_nfe:
+            incrementar_metrica('danfe_documentos_total', status='ignorado')
+            return jsonify({'erro': 'O XML enviado não é uma NF-e'}), 422
+        
+        _, (sucesso, mensagem, pdf), _ = list(renderizar_em_paralelo([doc]))[0]
+        incrementar_metrica('danfe_documentos_total', status='processado' if sucesso else 'erro')
+        if not sucesso:
+            return jsonify({'erro': mensagem}), 422
+        
+        logger.info(f"📄 DANFE avulso gerado: {doc.chave}")
+        return send_file(io.BytesIO(pdf), mimetype='application/pdf', download_name=f'{doc.chave}.pdf', max_age=0, etag=etag)
+    except Exception as e:
+        logger.error(f"❌ Erro ao gerar DANFE avulso: {str(e)}")
+        logger.error(traceback.format_exc())
+        return jsonify({'erro': f'Erro ao processar: {str(e)}'}), 500
+
 # ========================================
 # EXECUÇÃO DA APLICAÇÃO
 # ========================================
 
+# Processos do pool importam este módulo: só o processo principal faz o autoteste
+if RENDER_AUTOTESTE and os.getenv('DANFE_PROCESSO_RENDERIZACAO') != '1':
+    executar_autoteste()
+
+# Com gunicorn --preload, cada worker criado por fork sobe o seu pool já aquecido
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(
+        after_in_child=lambda: threading.Thread(target=preaquecer_pool, daemon=True, name='preaquecimento').start()
+    )
+
 if __name__ == '__main__':
     logger.info("=" * 60)
     logger.info("🚀 SISTEMA DANFE INICIADO!")
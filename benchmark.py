@@ -0,0 +1,340 @@
+"""
+Benchmark do pipeline XML → DANFE.
+
+Gera um corpus sintético de NF-e (quantidade de itens variável, UTF-8 e
+ISO-8859-1, eventos, XMLs que não são NF-e e duplicados), empacota em ZIP e
+mede cada etapa do processamento: validação (Zip Slip), extração, parsing,
+renderização e montagem do ZIP de resultado, além da rota /processar completa.
+
+A saída é JSON, para comparar commits e detectar regressões:
+
+    python benchmark.py --documentos 100 1000 --saida bench.json
+    python benchmark.py --documentos 20000 --amostra-render 500 --sem-rota
+
+O corpus é determinístico para a mesma --semente. Arquivos .RAR não são gerados
+(o formato só pode ser criado com o binário proprietário do WinRAR); a leitura
+de ZIP e RAR passa pelo mesmo código (iterar_xmls_compactado).
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+import shutil
+from datetime import datetime
+
+
+# ========================================
+# ARGUMENTOS
+# ========================================
+
+def ler_argumentos():
+    parser = argparse.ArgumentParser(description="Benchmark do conversor XML → DANFE")
+    parser.add_argument('--documentos', type=int, nargs='+', default=[100, 1000],
+                        help="Tamanhos do corpus (NF-e únicas por arquivo), ex.: 100 1000 20000")
+    parser.add_argument('--itens', type=int, nargs='+', default=[1, 5, 30],
+                        help="Quantidades de itens por NF-e, sorteadas entre os valores informados")
+    parser.add_argument('--latin1', type=float, default=0.2,
+                        help="Proporção de XMLs em ISO-8859-1 (padrão: 0.2)")
+    parser.add_argument('--eventos', type=float, default=0.05,
+                        help="Proporção de XMLs de evento (procEventoNFe) (padrão: 0.05)")
+    parser.add_argument('--nao-nfe', type=float, default=0.02,
+                        help="Proporção de XMLs que não são NF-e (padrão: 0.02)")
+    parser.add_argument('--duplicados', type=float, default=0.05,
+                        help="Proporção de NF-e repetidas em outra pasta do ZIP (padrão: 0.05)")
+    parser.add_argument('--amostra-render', type=int, default=0,
+                        help="Renderiza só as N primeiras NF-e na etapa de renderização (0 = todas)")
+    parser.add_argument('--repeticoes', type=int, default=1,
+                        help="Repetições de cada etapa; o JSON traz a mediana e as amostras")
+    parser.add_argument('--workers', type=int,
+                        help="Sobrescreve RENDER_WORKERS")
+    parser.add_argument('--com-cache', action='store_true',
+                        help="Mantém o cache de DANFEs ligado (por padrão é desligado para medir a renderização)")
+    parser.add_argument('--sem-rota', action='store_true',
+                        help="Não mede a rota /processar completa")
+    parser.add_argument('--semente', type=int, default=42,
+                        help="Semente do gerador do corpus (padrão: 42)")
+    parser.add_argument('--saida',
+                        help="Arquivo JSON de saída (padrão: stdout)")
+    return parser.parse_args()
+
+
+def log(mensagem):
+    print(mensagem, file=sys.stderr, flush=True)
+
+
+# ========================================
+# CORPUS SINTÉTICO
+# ========================================
+
+NOMES = ["EMPRESA TESTE LTDA", "JOÃO DA SILVA ME", "COMÉRCIO DE AÇAÍ SÃO JOSÉ", "MERCADO BOA VISTA"]
+
+def gerar_chave(numero):
+    """Chave de acesso de 44 dígitos (UF 52, AAMM 2511, CNPJ do emitente, modelo 55)"""
+    return f"5225112746950900013455003{numero:09d}1{numero % 10 ** 8:08d}{numero % 10}"
+
+
+def gerar_nfe(chave, itens, nome, encoding):
+    """XML de NF-e autorizada (nfeProc) com a quantidade de itens pedida"""
+    dets = "".join(
+        f'<det nItem="{i}"><prod><cProd>{i}</cProd><cEAN>SEM GTIN</cEAN><xProd>PRODUTO {i} AÇÚCAR</xProd>'
+        f'<NCM>22030000</NCM><CFOP>5102</CFOP><uCom>UN</uCom><qCom>1.0000</qCom><vUnCom>10.00</vUnCom>'
+        f'<vProd>10.00</vProd><cEANTrib>SEM GTIN</cEANTrib><uTrib>UN</uTrib><qTrib>1.0000</qTrib>'
+        f'<vUnTrib>10.00</vUnTrib><indTot>1</indTot></prod><imposto><ICMS><ICMS00><orig>0</orig>'
+        f'<CST>00</CST><modBC>3</modBC><vBC>10.00</vBC><pICMS>17.00</pICMS><vICMS>1.70</vICMS>'
+        f'</ICMS00></ICMS></imposto></det>'
+        for i in range(1, itens + 1)
+    )
+    total = f"{itens * 10}.00"
+    xml = (
+        f'<?xml version="1.0" encoding="{encoding.upper()}"?>'
+        f'<nfeProc xmlns="http://www.portalfiscal.inf.br/nfe" versao="4.00"><NFe>'
+        f'<infNFe Id="NFe{chave}" versao="4.00"><ide><cUF>52</cUF><cNF>{chave[35:43]}</cNF>'
+        f'<natOp>VENDA DE MERCADORIA</natOp><mod>55</mod><serie>3</serie><nNF>{int(chave[25:34])}</nNF>'
+        f'<dhEmi>2025-11-20T10:00:00-03:00</dhEmi><tpNF>1</tpNF><idDest>1</idDest><cMunFG>5208707</cMunFG>'
+        f'<tpImp>1</tpImp><tpEmis>1</tpEmis><cDV>{chave[-1]}</cDV><tpAmb>1</tpAmb><finNFe>1</finNFe>'
+        f'<indFinal>0</indFinal><indPres>1</indPres><procEmi>0</procEmi><verProc>1.0</verProc></ide>'
+        f'<emit><CNPJ>27469509000134</CNPJ><xNome>EMITENTE LTDA</xNome><enderEmit><xLgr>RUA A</xLgr>'
+        f'<nro>1</nro><xBairro>CENTRO</xBairro><cMun>5208707</cMun><xMun>GOIÂNIA</xMun><UF>GO</UF>'
+        f'<CEP>74000000</CEP><fone>6233333333</fone></enderEmit><IE>123456789</IE><CRT>3</CRT></emit>'
+        f'<dest><CNPJ>12345678000190</CNPJ><xNome>{nome}</xNome><enderDest><xLgr>RUA B</xLgr><nro>2</nro>'
+        f'<xBairro>CENTRO</xBairro><cMun>5208707</cMun><xMun>GOIÂNIA</xMun><UF>GO</UF><CEP>74000000</CEP>'
+        f'</enderDest><indIEDest>9</indIEDest></dest>{dets}'
+        f'<total><ICMSTot><vBC>0</vBC><vICMS>0</vICMS><vICMSDeson>0</vICMSDeson><vFCP>0</vFCP>'
+        f'<vBCST>0</vBCST><vST>0</vST><vFCPST>0</vFCPST><vFCPSTRet>0</vFCPSTRet><vProd>{total}</vProd>'
+        f'<vFrete>0</vFrete><vSeg>0</vSeg><vDesc>0</vDesc><vII>0</vII><vIPI>0</vIPI><vIPIDevol>0</vIPIDevol>'
+        f'<vPIS>0</vPIS><vCOFINS>0</vCOFINS><vOutro>0</vOutro><vNF>{total}</vNF></ICMSTot></total>'
+        f'<transp><modFrete>9</modFrete></transp><pag><detPag><tPag>01</tPag><vPag>{total}</vPag>'
+        f'</detPag></pag></infNFe></NFe><protNFe versao="4.00"><infProt><tpAmb>1</tpAmb>'
+        f'<verAplic>1</verAplic><chNFe>{chave}</chNFe><dhRecbto>2025-11-20T10:00:05-03:00</dhRecbto>'
+        f'<nProt>152250000000000</nProt><digVal>x</digVal><cStat>100</cStat><xMotivo>Autorizado o uso da NF-e</xMotivo>'
+        f'</infProt></protNFe></nfeProc>'
+    )
+    return xml.encode(encoding)
+
+
+def gerar_evento(chave):
+    """XML de evento (cancelamento/CC-e): é XML válido, mas não é NF-e"""
+    return (
+        f'<?xml version="1.0" encoding="UTF-8"?><procEventoNFe xmlns="http://www.portalfiscal.inf.br/nfe" versao="1.00">'
+        f'<evento versao="1.00"><infEvento Id="ID110110{chave}01"><chNFe>{chave}</chNFe><tpEvento>110110</tpEvento>'
+        f'<nSeqEvento>1</nSeqEvento><detEvento versao="1.00"><descEvento>Carta de Correcao</descEvento>'
+        f'<xCorrecao>Correção do endereço</xCorrecao></detEvento></infEvento></evento></procEventoNFe>'
+    ).encode('utf-8')
+
+
+def gerar_nao_nfe(numero):
+    return f'<?xml version="1.0" encoding="UTF-8"?><relatorio><numero>{numero}</numero></relatorio>'.encode('utf-8')
+
+
+def gerar_corpus(args, documentos, caminho_zip):
+    """Grava o ZIP do corpus e retorna a contagem de cada tipo de XML"""
+    rnd = random.Random(args.semente + documentos)
+    contagem = {'nfe': documentos, 'latin1': 0, 'eventos': 0, 'nao_nfe': 0, 'duplicados': 0}
+
+    with zipfile.ZipFile(caminho_zip, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        for i in range(documentos):
+            chave = gerar_chave(i + 1)
+            encoding = 'iso-8859-1' if rnd.random() < args.latin1 else 'utf-8'
+            contagem['latin1'] += encoding == 'iso-8859-1'
+            xml = gerar_nfe(chave, rnd.choice(args.itens), rnd.choice(NOMES), encoding)
+            zipf.writestr(f"notas/{chave}-nfe.xml", xml)
+
+            if rnd.random() < args.duplicados:
+                zipf.writestr(f"copia/{chave}-nfe.xml", xml)
+                contagem['duplicados'] += 1
+            if rnd.random() < args.eventos:
+                zipf.writestr(f"eventos/{chave}-evento.xml", gerar_evento(chave))
+                contagem['eventos'] += 1
+            if rnd.random() < args.nao_nfe:
+                zipf.writestr(f"outros/relatorio-{i}.xml", gerar_nao_nfe(i))
+                contagem['nao_nfe'] += 1
+
+    return contagem
+
+
+# ========================================
+# MEDIÇÃO DAS ETAPAS
+# ========================================
+
+def medir(repeticoes, funcao):
+    """Executa a etapa N vezes; retorna (último resultado, lista de tempos em segundos)"""
+    tempos = []
+    resultado = None
+    for _ in range(repeticoes):
+        inicio = time.perf_counter()
+        resultado = funcao()
+        tempos.append(time.perf_counter() - inicio)
+    return resultado, tempos
+
+
+def resumo_etapa(tempos, quantidade):
+    mediana = statistics.median(tempos)
+    return {
+        'segundos': round(mediana, 4),
+        'docs_por_segundo': round(quantidade / mediana, 1) if mediana > 0 else None,
+        'quantidade': quantidade,
+        'amostras': [round(t, 4) for t in tempos],
+    }
+
+
+def executar_cenario(app, args, documentos, pasta):
+    caminho_zip = os.path.join(pasta, f"corpus_{documentos}.zip")
+    log(f"📦 Gerando corpus com {documentos} NF-e...")
+    contagem = gerar_corpus(args, documentos, caminho_zip)
+    cenario = {
+        'documentos': documentos,
+        'arquivo_bytes': os.path.getsize(caminho_zip),
+        'corpus': contagem,
+        'etapas': {},
+    }
+    etapas = cenario['etapas']
+
+    with zipfile.ZipFile(caminho_zip) as zip_ref:
+        total_membros = len(zip_ref.namelist())
+
+        log("🔒 Validação (Zip Slip e zip bomb)...")
+        _, tempos = medir(args.repeticoes, lambda: app.validar_membros(zip_ref, pasta, {'descompactado': 0, 'aninhados': 0}))
+        etapas['validacao'] = resumo_etapa(tempos, total_membros)
+
+        log("📂 Extração...")
+        membros, tempos = medir(args.repeticoes, lambda: list(app.iterar_xmls_compactado(zip_ref)))
+        etapas['extracao'] = resumo_etapa(tempos, len(membros))
+
+    log("🔍 Parsing...")
+    docs, tempos = medir(args.repeticoes, lambda: [app.carregar_xml(conteudo, nome) for nome, conteudo in membros])
+    etapas['parsing'] = resumo_etapa(tempos, len(docs))
+
+    nfes = []
+    chaves = set()
+    for doc in docs:
+        if doc.is_nfe and doc.chave not in chaves:
+            chaves.add(doc.chave)
+            nfes.append(doc)
+    if args.amostra_render:
+        nfes = nfes[:args.amostra_render]
+
+    log(f"🖨️ Renderização de {len(nfes)} DANFEs ({app.RENDER_WORKERS} workers)...")
+    renderizados, tempos = medir(args.repeticoes, lambda: list(app.renderizar_em_paralelo(nfes)))
+    etapas['renderizacao'] = resumo_etapa(tempos, len(nfes))
+    etapas['renderizacao']['erros'] = sum(1 for _, (sucesso, _, _), _ in renderizados if not sucesso)
+
+    log("🗜️ Montagem do ZIP de resultado...")
+    caminho_resultado = os.path.join(pasta, 'resultado.zip')
+
+    def montar_zip():
+        with zipfile.ZipFile(caminho_resultado, 'w') as zipf:
+            for doc, (sucesso, _, pdf), _ in renderizados:
+                app.gravar_documento_zip(zipf, doc, pdf if sucesso else None)
+
+    _, tempos = medir(args.repeticoes, montar_zip)
+    etapas['zip'] = resumo_etapa(tempos, len(renderizados))
+    etapas['zip']['arquivo_bytes'] = os.path.getsize(caminho_resultado)
+
+    if not args.sem_rota:
+        log("🌐 Rota /processar completa...")
+        client = app.app.test_client()
+
+        def processar():
+            with open(caminho_zip, 'rb') as f:
+                resposta = client.post('/processar', data={'arquivo': (f, 'corpus.zip')},
+                                       content_type='multipart/form-data')
+            dados = resposta.get_json()
+            if dados.get('arquivo_zip'):
+                os.remove(os.path.join(app.TEMP_OUTPUT, dados['arquivo_zip']))
+            return resposta.status_code, dados
+
+        (status, dados), tempos = medir(args.repeticoes, processar)
+        etapas['rota_processar'] = resumo_etapa(tempos, documentos)
+        etapas['rota_processar'].update({
+            'status_http': status,
+            'total_processados': dados.get('total_processados'),
+            'total_erros': dados.get('total_erros'),
+            'total_duplicados': dados.get('total_duplicados'),
+        })
+
+    return cenario
+
+
+# ========================================
+# EXECUÇÃO
+# ========================================
+
+def versao_codigo():
+    """Commit atual (quando rodando dentro do repositório git)"""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    args = ler_argumentos()
+
+    # O app lê a configuração do ambiente ao ser importado
+    if args.workers is not None:
+        os.environ['RENDER_WORKERS'] = str(args.workers)
+    if not args.com_cache:
+        os.environ['CACHE_MAX_MB'] = '0'
+
+    import logging
+    import app
+    logging.getLogger(app.__name__).setLevel(logging.WARNING)
+
+    pasta = tempfile.mkdtemp(prefix='danfe_bench_')
+    try:
+        # Sobe o pool antes de medir, para não contar o spawn dos workers na primeira etapa
+        if app.RENDER_WORKERS > 1:
+            app.obter_pool_renderizacao().submit(int).result()
+
+        cenarios = [executar_cenario(app, args, n, pasta) for n in args.documentos]
+    finally:
+        shutil.rmtree(pasta, ignore_errors=True)
+        if app._pool_renderizacao is not None:
+            app._pool_renderizacao.shutdown()
+
+    relatorio = {
+        'versao': versao_codigo(),
+        'data': datetime.now().isoformat(timespec='seconds'),
+        'ambiente': {
+            'python': platform.python_version(),
+            'plataforma': platform.platform(),
+            'cpus': app.CPUS_DISPONIVEIS,
+            'render_workers': app.RENDER_WORKERS,
+            'render_janela': app.RENDER_JANELA,
+            'cache': args.com_cache,
+        },
+        'parametros': {
+            'itens': args.itens,
+            'latin1': args.latin1,
+            'eventos': args.eventos,
+            'nao_nfe': args.nao_nfe,
+            'duplicados': args.duplicados,
+            'amostra_render': args.amostra_render,
+            'repeticoes': args.repeticoes,
+            'semente': args.semente,
+        },
+        'cenarios': cenarios,
+    }
+
+    saida = json.dumps(relatorio, ensure_ascii=False, indent=2)
+    if args.saida:
+        with open(args.saida, 'w', encoding='utf-8') as f:
+            f.write(saida + '\n')
+        log(f"✅ Resultado salvo em {args.saida}")
+    else:
+        print(saida)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,12 +4,23 @@ import time
 import re
 import zipfile
 import shutil
+import hashlib
 import logging
+import socket
+import threading
 import requests
 import configparser
+from concurrent.futures import ThreadPoolExecutor
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
+import io
 import json
+import codecs
+import multiprocessing
+import xml.etree.ElementTree as ET
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 # ============================
 # CONFIGURAÇÃO - Carregar .ini
@@ -34,13 +45,42 @@ config.read(CONFIG_PATH, encoding="utf-8")
 
 CNPJ = re.sub(r"\D", "", config.get("API", "cnpj"))
 API_URL = config.get("API", "url_processar")
-API_DOWNLOAD = config.get("API", "url_download")
+API_BASE = config.get("API", "url_base", fallback=API_URL.rsplit("/", 1)[0])
+INTERVALO_CONSULTA = config.getint("API", "intervalo_consulta", fallback=3)
+TIMEOUT_JOB = config.getint("API", "timeout_job", fallback=3600)
+TAMANHO_CHUNK = config.getint("API", "tamanho_chunk_mb", fallback=4) * 1024 * 1024
+TENTATIVAS_UPLOAD = config.getint("API", "tentativas_upload", fallback=5)
+TENTATIVAS_DOWNLOAD = config.getint("API", "tentativas_download", fallback=5)
+# individual (um PDF por nota), destinatario (um PDF por pasta) ou lote (um PDF só)
+PARAMETROS_PDF = {
+    "pdf": config.get("API", "modo_pdf", fallback="individual"),
+    "sumario": "1" if config.getboolean("API", "sumario_pdf", fallback=False) else "0",
+}
+TAMANHO_BLOCO_DOWNLOAD = 1024 * 1024
 
 PASTA_MONITORADA = config.get("PASTAS", "monitorar")
 PASTA_SAIDA = config.get("PASTAS", "saida")
 
+# Quantos ZIPs são processados ao mesmo tempo e quanto tempo sem mudanças indica cópia concluída
+MAX_SIMULTANEOS = config.getint("AGENTE", "max_simultaneos", fallback=2)
+ESTABILIDADE_SEGUNDOS = config.getfloat("AGENTE", "estabilidade_segundos", fallback=3)
+# Envia só as NF-e que ainda não foram convertidas na pasta da referência
+FILTRAR_ENVIO = config.getboolean("AGENTE", "filtrar_envio", fallback=True)
+# Porta local (127.0.0.1) do canal de status lido pelo monitor_gui
+PORTA_STATUS = config.getint("AGENTE", "porta_status", fallback=48765)
+# servidor (padrão), local (renderiza nesta máquina, servidor como reserva) ou auto (o mais rápido medido)
+MODO_RENDER = config.get("AGENTE", "modo_render", fallback="servidor").strip().lower()
+PROCESSOS_LOCAIS = config.getint("AGENTE", "processos_locais", fallback=max(1, (os.cpu_count() or 2) - 1))
+
 HEADERS = {"X-CNPJ": CNPJ}
 
+# Renderização local depende do brazilfiscalreport (o mesmo renderizador do servidor)
+try:
+    from brazilfiscalreport.danfe import Danfe
+    RENDER_LOCAL_DISPONIVEL = True
+except ImportError:
+    RENDER_LOCAL_DISPONIVEL = False
+
 # ============================
 # LOGGING
 # ============================
@@ -63,38 +103,801 @@ logger = logging.getLogger("AGENTE-DANFE")
 # ============================
 REGEX_REFERENCIA = r"(19|20)\d{2}[-_]?(0[1-9]|1[0-2])"
 STATUS_FILE = os.path.join(BASE_DIR, "status.json")
+UPLOADS_PENDENTES_FILE = os.path.join(BASE_DIR, "uploads_pendentes.json")
+ARQUIVO_INDICE_CHAVES = ".chaves_convertidas"
+REGEX_CHAVE_NFE = re.compile(rb"<(?:\w+:)?infNFe\b[^>]*?\bId\s*=\s*[\"']NFe(\d{44})[\"']")
+NS_NFE = "{http://www.portalfiscal.inf.br/nfe}"
+REGEX_ENCODING_XML = re.compile(rb'^\s*<\?xml[^>]*?encoding\s*=\s*["\']([A-Za-z0-9._-]+)["\']')
+MODOS_RENDER = ("servidor", "local", "auto")
+# ZIPs dentro do ZIP são abertos em memória até esta profundidade (o servidor aplica o próprio limite)
+PROFUNDIDADE_ANINHADOS = 3
+# Verificações com o arquivo parado, mas sem ser um ZIP íntegro, antes de desistir dele
+VERIFICACOES_ZIP_INVALIDO = 10
+# No modo auto, a cada quantas conversões o caminho mais lento é medido de novo
+REAVALIAR_A_CADA = 10
+
+# Etapas finais de um arquivo: depois delas ele sai do painel
+ETAPAS_FINAIS = ("concluido", "dispensado", "erro")
+
+# ============================
+# CANAL DE STATUS
+# ============================
+
+class CanalStatus:
+    """
+    Servidor TCP em 127.0.0.1 que empurra eventos de status para o monitor_gui,
+    um JSON por linha: um snapshot ao conectar e, depois, cada mudança (status,
+    profundidade da fila e progresso de cada arquivo com bytes e velocidade).
+    Clientes lentos ou desconectados são descartados e reconectam sozinhos.
+    """
+
+    def __init__(self, porta):
+        self.porta = porta
+        self.lock = threading.Lock()
+        self.clientes = []
+        self.estado = {
+            "status": "INICIANDO",
+            "detalhe": "",
+            "fila": {"copiando": 0, "na_fila": 0, "processando": 0},
+            "arquivos": {},
+        }
+
+    def iniciar(self):
+        try:
+            self.servidor = socket.create_server(("127.0.0.1", self.porta))
+        except OSError as e:
+            logger.warning(f"⚠️ Canal de status indisponível na porta {self.porta}: {e}")
+            return
+        threading.Thread(target=self._aceitar, daemon=True, name="canal-status").start()
+        logger.info(f"📡 Canal de status em 127.0.0.1:{self.porta}")
+
+    def _aceitar(self):
+        while True:
+            conexao, _ = self.servidor.accept()
+            conexao.settimeout(1)
+            with self.lock:
+                if self._enviar(conexao, dict(self.estado, tipo="snapshot")):
+                    self.clientes.append(conexao)
+
+    def _enviar(self, conexao, evento):
+        try:
+            conexao.sendall((json.dumps(evento, ensure_ascii=False) + "\n").encode("utf-8"))
+            return True
+        except OSError:
+            conexao.close()
+            return False
+
+    def publicar(self, evento):
+        with self.lock:
+            if evento["tipo"] == "status":
+                self.estado["status"] = evento["status"]
+                self.estado["detalhe"] = evento["detalhe"]
+            elif evento["tipo"] == "fila":
+                self.estado["fila"] = evento["fila"]
+            elif evento["tipo"] == "arquivo":
+                if evento["etapa"] in ETAPAS_FINAIS:
+                    self.estado["arquivos"].pop(evento["arquivo"], None)
+                else:
+                    self.estado["arquivos"][evento["arquivo"]] = evento
+
+            self.clientes = [conexao for conexao in self.clientes if self._enviar(conexao, evento)]
+
+
+canal_status = CanalStatus(PORTA_STATUS)
+
+# Progresso por arquivo: (etapa, início da etapa, último evento publicado)
+_progresso = {}
+_progresso_lock = threading.Lock()
+
+
+def progresso_arquivo(nome, etapa, feitos=0, total=None):
+    """
+    Publica a etapa de um arquivo (filtrando, enviando, processando, baixando,
+    extraindo, concluido, dispensado, erro) com bytes/itens feitos, total e
+    velocidade. Dentro da mesma etapa publica no máximo 4 eventos por segundo.
+    """
+    agora = time.time()
+    with _progresso_lock:
+        anterior = _progresso.get(nome)
+        mudou_etapa = anterior is None or anterior[0] != etapa
+        inicio = agora if mudou_etapa else anterior[1]
+        if not mudou_etapa and agora - anterior[2] < 0.25 and feitos != total:
+            return
+        if etapa in ETAPAS_FINAIS:
+            _progresso.pop(nome, None)
+        else:
+            _progresso[nome] = (etapa, inicio, agora)
+
+    decorrido = agora - inicio
+    canal_status.publicar({
+        "tipo": "arquivo",
+        "arquivo": nome,
+        "etapa": etapa,
+        "feitos": feitos,
+        "total": total,
+        "por_segundo": round(feitos / decorrido) if decorrido > 0 and feitos else 0,
+    })
 
 # ============================
 # FUNÇÕES AUXILIARES
 # ============================
 
+# status.json e uploads_pendentes.json são gravados por vários processamentos ao mesmo tempo
+_status_lock = threading.Lock()
+_uploads_pendentes_lock = threading.Lock()
+_ultimo_status_gravado = (None, 0)
+
 def atualizar_status(status, detalhe=""):
-    with open(STATUS_FILE, "w", encoding="utf-8") as f:
-        json.dump({
-            "status": status,
-            "detalhe": detalhe,
-            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S")
-        }, f, ensure_ascii=False, indent=2)
-
-def aguardar_copia(caminho, timeout=60):
-    logger.debug("⏳ Aguardando término da cópia...")
-    tamanho_anterior = -1
+    """
+    Publica o status no canal e grava status.json (para monitores antigos) de forma
+    atômica, só quando o status muda ou a cada 2 s, sem regravar a cada progresso.
+    """
+    global _ultimo_status_gravado
+    canal_status.publicar({"tipo": "status", "status": status, "detalhe": detalhe})
+
+    with _status_lock:
+        ultimo_status, ultima_gravacao = _ultimo_status_gravado
+        if status == ultimo_status and time.time() - ultima_gravacao < 2:
+            return
+        _ultimo_status_gravado = (status, time.time())
+
+        tmp = f"{STATUS_FILE}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({
+                "status": status,
+                "detalhe": detalhe,
+                "timestamp": time.strftime("%Y-%m-%d %H:%M:%S")
+            }, f, ensure_ascii=False, indent=2)
+        try:
+            os.replace(tmp, STATUS_FILE)
+        except PermissionError:
+            pass  # Windows: monitor lendo o arquivo neste instante; vale a próxima gravação
+
+
+def enviar_job(caminho_zip, nome):
+    """Envia o ZIP para /jobs e retorna o id do job (respeita Retry-After com a fila cheia)"""
+    tamanho = os.path.getsize(caminho_zip)
+    while True:
+        progresso_arquivo(nome, "enviando", 0, tamanho)
+        with open(caminho_zip, "rb") as f:
+            response = requests.post(
+                f"{API_BASE}/jobs",
+                headers=HEADERS,
+                data=PARAMETROS_PDF,
+                files={"arquivo": (nome, f, "application/zip")},
+                timeout=600
+            )
+
+        logger.info(f"📡 Status HTTP: {response.status_code}")
+
+        if response.status_code == 429:
+            espera = int(response.headers.get("Retry-After", 30))
+            logger.warning(f"⏳ Fila do servidor cheia, nova tentativa em {espera}s")
+            atualizar_status("AGUARDANDO", f"Servidor ocupado, nova tentativa em {espera}s: {nome}")
+            time.sleep(espera)
+            continue
+
+        logger.debug(f"📨 Resposta: {response.text}")
+
+        if response.status_code != 202:
+            raise Exception("API retornou erro")
+
+        progresso_arquivo(nome, "enviando", tamanho, tamanho)
+        return response.json()["job_id"]
+
+
+def sha256_arquivo(caminho):
+    sha = hashlib.sha256()
+    with open(caminho, "rb") as f:
+        for bloco in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(bloco)
+    return sha.hexdigest()
+
+
+def carregar_uploads_pendentes():
+    try:
+        with open(UPLOADS_PENDENTES_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def salvar_uploads_pendentes(pendentes):
+    tmp = f"{UPLOADS_PENDENTES_FILE}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(pendentes, f, indent=2)
+    os.replace(tmp, UPLOADS_PENDENTES_FILE)
+
+
+def assinatura_upload(caminho_zip, chaves=None):
+    """
+    Identifica o upload para retomá-lo depois de uma queda: o ZIP de origem e,
+    num envio reduzido, as chaves enviadas. O ZIP reduzido é remontado a cada
+    tentativa, mas com as mesmas chaves sai igual byte a byte (ver preparar_envio).
+    """
+    assinatura = f"{os.path.abspath(caminho_zip)}|{os.path.getsize(caminho_zip)}|{int(os.path.getmtime(caminho_zip))}"
+    if chaves:
+        assinatura += "|" + hashlib.sha256("\n".join(sorted(chaves)).encode()).hexdigest()[:16]
+    return assinatura
+
+
+def registrar_upload_pendente(assinatura, sessao_id=None):
+    """
+    Grava (ou remove, com sessao_id=None) a sessão de upload do arquivo sem perder
+    as dos outros. Descarta as sessões de arquivos que já não estão na pasta.
+    """
+    with _uploads_pendentes_lock:
+        pendentes = carregar_uploads_pendentes()
+        if sessao_id:
+            pendentes[assinatura] = sessao_id
+        else:
+            pendentes.pop(assinatura, None)
+        pendentes = {a: s for a, s in pendentes.items() if os.path.exists(a.split("|", 1)[0])}
+        salvar_uploads_pendentes(pendentes)
+
+
+def obter_sessao_upload(caminho_zip, nome, assinatura):
+    """Retoma a sessão de upload salva para o arquivo ou cria uma nova no servidor"""
+    sessao_id = carregar_uploads_pendentes().get(assinatura)
+
+    if sessao_id:
+        response = requests.get(f"{API_BASE}/uploads/{sessao_id}", headers=HEADERS, timeout=30)
+        if response.status_code == 200:
+            return response.json()
+        logger.info(f"ℹ️ Sessão de upload {sessao_id} expirada, criando outra")
+
+    response = requests.post(
+        f"{API_BASE}/uploads",
+        headers=HEADERS,
+        json={
+            "nome": nome,
+            "tamanho": os.path.getsize(caminho_zip),
+            "tamanho_chunk": TAMANHO_CHUNK,
+            "sha256": sha256_arquivo(caminho_zip)
+        },
+        timeout=30
+    )
+
+    if response.status_code == 404:
+        return None
+
+    if response.status_code != 201:
+        raise Exception(f"API retornou erro ao criar sessão de upload (HTTP {response.status_code})")
+
+    sessao = response.json()
+    registrar_upload_pendente(assinatura, sessao["sessao_id"])
+    return sessao
+
+
+def enviar_em_partes(caminho_zip, nome, assinatura=None):
+    """
+    Upload retomável: envia o ZIP em partes (com SHA-256 de cada uma) e
+    conclui a sessão, que vira um job no servidor. Em caso de falha retoma
+    a partir da primeira parte que o servidor ainda não tem.
+    Retorna o id do job, ou None se o servidor não suportar upload em partes.
+    """
+    assinatura = assinatura or assinatura_upload(caminho_zip)
+
+    for tentativa in range(1, TENTATIVAS_UPLOAD + 1):
+        try:
+            sessao = obter_sessao_upload(caminho_zip, nome, assinatura)
+            if sessao is None:
+                return None
+
+            sessao_id = sessao["sessao_id"]
+            total = sessao["total_chunks"]
+
+            if not sessao.get("job_id"):
+                recebidos = set(sessao["recebidos"])
+                tamanho = os.path.getsize(caminho_zip)
+                if recebidos:
+                    logger.info(f"↩️ Retomando upload {sessao_id}: {len(recebidos)}/{total} partes já no servidor")
+
+                with open(caminho_zip, "rb") as f:
+                    for indice in range(total):
+                        if indice in recebidos:
+                            continue
+
+                        f.seek(indice * sessao["tamanho_chunk"])
+                        bloco = f.read(sessao["tamanho_chunk"])
+
+                        response = requests.put(
+                            f"{API_BASE}/uploads/{sessao_id}/{indice}",
+                            headers={
+                                **HEADERS,
+                                "Content-Type": "application/octet-stream",
+                                "X-Chunk-SHA256": hashlib.sha256(bloco).hexdigest()
+                            },
+                            data=bloco,
+                            timeout=120
+                        )
+
+                        if response.status_code != 200:
+                            raise Exception(f"Falha ao enviar parte {indice} (HTTP {response.status_code})")
+
+                        logger.debug(f"📤 Parte {indice + 1}/{total} enviada")
+                        recebidos.add(indice)
+                        enviados = min(len(recebidos) * sessao["tamanho_chunk"], tamanho)
+                        progresso_arquivo(nome, "enviando", enviados, tamanho)
+                        atualizar_status("PROCESSANDO", f"Enviando {nome}: {100 * len(recebidos) // total}%")
+
+            while True:
+                response = requests.post(
+                    f"{API_BASE}/uploads/{sessao_id}/concluir",
+                    headers=HEADERS,
+                    params=PARAMETROS_PDF,
+                    timeout=600
+                )
+                if response.status_code != 429:
+                    break
+                espera = int(response.headers.get("Retry-After", 30))
+                logger.warning(f"⏳ Fila do servidor cheia, nova tentativa em {espera}s")
+                atualizar_status("AGUARDANDO", f"Servidor ocupado, nova tentativa em {espera}s: {nome}")
+                time.sleep(espera)
+
+            logger.debug(f"📨 Resposta: {response.text}")
+
+            if response.status_code != 202:
+                raise Exception(f"API retornou erro ao concluir upload (HTTP {response.status_code})")
+
+            registrar_upload_pendente(assinatura)
+            return response.json()["job_id"]
+
+        except Exception as e:
+            logger.warning(f"⚠️ Falha no upload (tentativa {tentativa}/{TENTATIVAS_UPLOAD}): {e}")
+            if tentativa < TENTATIVAS_UPLOAD:
+                time.sleep(min(60, 2 ** tentativa))
+
+    raise Exception("Não foi possível concluir o upload em partes")
+
+
+def aguardar_job(job_id, nome):
+    """Consulta o progresso do job até concluir; retorna o estado final"""
     inicio = time.time()
 
-    while time.time() - inicio < timeout:
-        tamanho = os.path.getsize(caminho)
-        if tamanho == tamanho_anterior:
-            return True
-        tamanho_anterior = tamanho
-        time.sleep(1)
+    while time.time() - inicio < TIMEOUT_JOB:
+        try:
+            response = requests.get(f"{API_BASE}/jobs/{job_id}", headers=HEADERS, timeout=30)
+        except requests.RequestException as e:
+            logger.warning(f"⚠️ Falha ao consultar job {job_id}: {e}")
+            time.sleep(INTERVALO_CONSULTA)
+            continue
+
+        if response.status_code != 200:
+            raise Exception("API retornou erro ao consultar job")
 
-    return False
+        estado = response.json()
+
+        if estado["status"] == "concluido":
+            return estado
+
+        if estado["status"] == "erro":
+            raise Exception(f"Erro no processamento: {estado.get('erro')}")
+
+        logger.debug(f"⏳ Job {job_id}: {estado.get('progresso', 0)}%")
+        progresso_arquivo(nome, "processando", estado.get("xmls_lidos", 0), estado.get("total_xmls"))
+        atualizar_status("PROCESSANDO", f"{nome}: {estado.get('progresso', 0)}%")
+        time.sleep(INTERVALO_CONSULTA)
+
+    raise Exception("Timeout aguardando processamento do job")
+
+
+def baixar_arquivo(url, destino, nome):
+    """
+    Baixa em blocos direto para destino.part e renomeia ao final.
+    Se a conexão cair, retoma do ponto parado com Range + If-Range (ETag).
+    """
+    parcial = destino + ".part"
+    if os.path.exists(parcial):
+        os.remove(parcial)
+    etag = None
+    total = None
+
+    for tentativa in range(1, TENTATIVAS_DOWNLOAD + 1):
+        inicio = os.path.getsize(parcial) if os.path.exists(parcial) else 0
+        headers = dict(HEADERS)
+        if inicio and etag:
+            headers["Range"] = f"bytes={inicio}-"
+            headers["If-Range"] = etag
+
+        try:
+            with requests.get(url, headers=headers, stream=True, timeout=(30, 300)) as r:
+                if r.status_code == 206:
+                    modo = "ab"
+                    total = int(r.headers["Content-Range"].rsplit("/", 1)[1])
+                elif r.status_code == 200:
+                    # Range ignorado ou arquivo diferente (If-Range falhou): recomeça
+                    modo = "wb"
+                    inicio = 0
+                    total = int(r.headers["Content-Length"]) if "Content-Length" in r.headers else None
+                else:
+                    raise Exception(f"API retornou erro no download (HTTP {r.status_code})")
+
+                etag = r.headers.get("ETag")
+                baixados = inicio
+                ultimo_status = 0
+                progresso_arquivo(nome, "baixando", baixados, total)
+                with open(parcial, modo) as f:
+                    for bloco in r.iter_content(TAMANHO_BLOCO_DOWNLOAD):
+                        f.write(bloco)
+                        baixados += len(bloco)
+                        progresso_arquivo(nome, "baixando", baixados, total)
+                        if total and time.time() - ultimo_status >= 1:
+                            ultimo_status = time.time()
+                            atualizar_status(
+                                "PROCESSANDO",
+                                f"Baixando {nome}: {baixados * 100 // total}%"
+                            )
+
+            if total is None or os.path.getsize(parcial) >= total:
+                os.replace(parcial, destino)
+                return
+            logger.warning(f"⚠️ Download incompleto ({os.path.getsize(parcial)}/{total} bytes), retomando")
+        except requests.RequestException as e:
+            if tentativa == TENTATIVAS_DOWNLOAD:
+                raise
+            logger.warning(f"⚠️ Falha no download (tentativa {tentativa}): {e}")
+
+        time.sleep(min(2 ** tentativa, 30))
+
+    raise Exception(f"Download incompleto após {TENTATIVAS_DOWNLOAD} tentativas")
 
 
 def extrair_referencia(nome):
     match = re.search(REGEX_REFERENCIA, nome)
     return match.group(0).replace("_", "-") if match else None
 
+# ============================
+# FILTRO DE ENVIO
+# ============================
+
+_travas_referencia = {}
+_travas_referencia_lock = threading.Lock()
+
+
+def trava_referencia(referencia):
+    """Arquivos da mesma referência são processados um de cada vez (mesmo índice de chaves)"""
+    with _travas_referencia_lock:
+        return _travas_referencia.setdefault(referencia, threading.Lock())
+
+
+def chave_nfe(conteudo):
+    """Chave de acesso se o XML for uma NF-e (eventos e outros XMLs retornam None)"""
+    match = REGEX_CHAVE_NFE.search(conteudo)
+    if match:
+        return match.group(1).decode("ascii")
+
+    # Encodings sem ASCII (UTF-16) ou atributos fora do padrão: confirma analisando o XML
+    try:
+        root = ET.fromstring(conteudo)
+    except ET.ParseError:
+        return None
+    inf_nfe = root.find(f".//{NS_NFE}infNFe")
+    if inf_nfe is None:
+        return None
+    return inf_nfe.get("Id", "").replace("NFe", "") or None
+
+
+def carregar_chaves_convertidas(pasta_destino):
+    """
+    Chaves já convertidas na pasta da referência. Sem o índice (pastas de versões
+    anteriores do agente), monta-o a partir dos XMLs já extraídos.
+    """
+    caminho = os.path.join(pasta_destino, ARQUIVO_INDICE_CHAVES)
+    if os.path.exists(caminho):
+        with open(caminho, "r", encoding="utf-8") as f:
+            return {linha.strip() for linha in f if linha.strip()}
+
+    chaves = set()
+    for _, _, arquivos in os.walk(pasta_destino):
+        for arquivo in arquivos:
+            base, extensao = os.path.splitext(arquivo)
+            if extensao.lower() == ".xml" and re.fullmatch(r"\d{44}", base):
+                chaves.add(base)
+    registrar_chaves_convertidas(pasta_destino, chaves)
+    return chaves
+
+
+def registrar_chaves_convertidas(pasta_destino, chaves):
+    with open(os.path.join(pasta_destino, ARQUIVO_INDICE_CHAVES), "a", encoding="utf-8") as f:
+        f.writelines(f"{chave}\n" for chave in sorted(chaves))
+
+
+def iterar_membros(zip_ref, prefixo="", profundidade=0):
+    """
+    Gera (caminho, bytes) dos XMLs e compactados do ZIP, entrando nos ZIPs internos
+    em memória até PROFUNDIDADE_ANINHADOS níveis (caminho: interno.zip/nota.xml).
+    RARs internos e ZIPs além do limite saem inteiros, para o servidor abrir.
+    """
+    for info in zip_ref.infolist():
+        nome = info.filename.lower()
+        if info.is_dir() or not nome.endswith((".xml", ".zip", ".rar")):
+            continue
+
+        conteudo = zip_ref.read(info)
+        interno = None
+        if nome.endswith(".zip") and profundidade < PROFUNDIDADE_ANINHADOS:
+            try:
+                interno = zipfile.ZipFile(io.BytesIO(conteudo), "r")
+            except zipfile.BadZipFile:
+                pass  # Vai inteiro: o servidor responde pelo arquivo inválido
+
+        if interno is None:
+            yield prefixo + info.filename, conteudo
+            continue
+        with interno:
+            yield from iterar_membros(interno, f"{prefixo}{info.filename}/", profundidade + 1)
+
+
+def preparar_envio(caminho_zip, pasta_destino, chaves_convertidas):
+    """
+    Monta um ZIP só com as NF-e que ainda não estão em chaves_convertidas, sem
+    eventos, XMLs que não são NF-e e chaves repetidas. Os XMLs de ZIPs internos
+    são filtrados do mesmo jeito; RARs internos seguem inteiros.
+    Retorna (ZIP a enviar, chaves enviadas): o próprio arquivo se nada foi
+    descartado, ou (None, vazio) se não há nada novo para enviar.
+    Os membros vão com data fixa: com as mesmas chaves o ZIP sai igual e o
+    upload interrompido pode ser retomado (ver assinatura_upload).
+    """
+    envio = os.path.join(pasta_destino, f".envio-{os.path.basename(caminho_zip)}")
+    novas = set()
+    descartados = 0
+    repassados = 0
+
+    with zipfile.ZipFile(caminho_zip, "r") as origem, \
+            zipfile.ZipFile(envio, "w", zipfile.ZIP_DEFLATED) as destino:
+        for caminho, conteudo in iterar_membros(origem):
+            if not caminho.lower().endswith(".xml"):
+                repassados += 1
+                destino.writestr(zipfile.ZipInfo(caminho), conteudo, zipfile.ZIP_DEFLATED)
+                continue
+
+            chave = chave_nfe(conteudo)
+            if chave is None or chave in chaves_convertidas or chave in novas:
+                descartados += 1
+                continue
+
+            novas.add(chave)
+            destino.writestr(zipfile.ZipInfo(caminho), conteudo, zipfile.ZIP_DEFLATED)
+
+    logger.info(f"🔎 Pré-filtro: {len(novas)} NF-e novas, {descartados} XMLs descartados (já convertidos, repetidos ou não NF-e)")
+    if repassados:
+        logger.info(f"📦 {repassados} compactados internos enviados sem filtro")
+
+    if not (novas or repassados) or not descartados:
+        os.remove(envio)
+        return (caminho_zip if novas or repassados else None), novas
+
+    logger.info(f"📦 Enviando ZIP reduzido: {os.path.getsize(envio)} de {os.path.getsize(caminho_zip)} bytes")
+    return envio, novas
+
+
+def chaves_do_resultado(zip_ref):
+    """Chaves convertidas com sucesso: pelo manifesto do resultado ou, sem ele, pelos PDFs individuais"""
+    try:
+        manifesto = zip_ref.read("DANFE-XML/manifesto.jsonl").decode("utf-8")
+    except KeyError:
+        return {
+            os.path.splitext(os.path.basename(nome))[0]
+            for nome in zip_ref.namelist() if nome.lower().endswith(".pdf")
+        }
+
+    chaves = set()
+    for linha in manifesto.splitlines():
+        item = json.loads(linha)
+        if item["status"] == "sucesso" and item["chave"]:
+            chaves.add(item["chave"])
+    return chaves
+
+
+# ============================
+# RENDERIZAÇÃO LOCAL
+# ============================
+
+def decodificar_xml(conteudo):
+    """Decodifica o XML pelo BOM ou pelo encoding declarado, caindo para utf-8/iso-8859-1"""
+    if conteudo.startswith(codecs.BOM_UTF8):
+        declarado = "utf-8-sig"
+    elif conteudo.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        declarado = "utf-16"
+    else:
+        match = REGEX_ENCODING_XML.match(conteudo[:256])
+        declarado = match.group(1).decode("ascii").lower() if match else "utf-8"
+
+    for encoding in (declarado, "utf-8", "iso-8859-1"):
+        try:
+            return conteudo.decode(encoding)
+        except (UnicodeDecodeError, LookupError):
+            continue
+
+
+def renderizar_xml(conteudo, nome_arquivo):
+    """
+    Executado nos processos do pool local, com os mesmos dados e o mesmo
+    renderizador de processar_xml_para_danfe() no servidor.
+    Retorna (nome, documento, chave, pdf, erro); nome None indica que o XML não é NF-e.
+    """
+    texto = decodificar_xml(conteudo)
+    try:
+        root = ET.fromstring(texto)
+    except ET.ParseError:
+        return None, None, None, None, None
+
+    inf_nfe = root.find(f".//{NS_NFE}infNFe")
+    if inf_nfe is None:
+        return None, None, None, None, None
+
+    dest = root.find(f".//{NS_NFE}dest")
+    if dest is None:
+        return None, None, None, None, "Destinatário não encontrado"
+
+    nome = dest.findtext(f"{NS_NFE}xNome") or "CLIENTE_DESCONHECIDO"
+    documento = dest.findtext(f"{NS_NFE}CNPJ") or dest.findtext(f"{NS_NFE}CPF") or "00000000000000"
+    chave = inf_nfe.get("Id", "").replace("NFe", "") or os.path.basename(nome_arquivo).replace(".xml", "")
+    nome = re.sub(r'[<>:"/\\|?*]', "", nome)
+
+    try:
+        return nome, documento, chave, bytes(Danfe(xml=texto).output()), None
+    except Exception as e:
+        return nome, documento, chave, None, str(e)
+
+
+_pool_local = None
+_pool_local_lock = threading.Lock()
+
+
+def obter_pool_local():
+    """Pool de processos da renderização local, criado na primeira conversão e compartilhado pelos arquivos"""
+    global _pool_local
+    with _pool_local_lock:
+        if _pool_local is None:
+            # spawn também no Linux: o agente já tem threads rodando quando o pool é criado
+            _pool_local = ProcessPoolExecutor(
+                max_workers=PROCESSOS_LOCAIS,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+            logger.info(f"⚙️ Pool de renderização local iniciado com {PROCESSOS_LOCAIS} processos")
+        return _pool_local
+
+
+def descartar_pool_local(pool):
+    """Descarta um pool quebrado (processo morto) para que a próxima conversão crie outro"""
+    global _pool_local
+    with _pool_local_lock:
+        if _pool_local is pool:
+            _pool_local = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def converter_localmente(caminho_envio, nome, pasta_destino):
+    """
+    Renderiza os DANFEs no pool local e grava em pasta_destino a mesma estrutura do
+    ZIP do servidor: DANFE-XML/{nome} - {documento}/{chave}.xml|pdf (um PDF por NF-e).
+    Ignora XMLs que não são NF-e e chaves repetidas; entra nos ZIPs internos (RARs
+    internos só o servidor lê). Retorna quantas NF-e foram convertidas.
+    """
+    atualizar_status("PROCESSANDO", f"Renderizando localmente: {nome}")
+    logger.info("🖥️ Renderizando localmente...")
+
+    pool = obter_pool_local()
+    convertidas = set()
+    vistas = set()
+    erros = 0
+
+    def gravar(nome_arquivo, conteudo, resultado):
+        nonlocal erros
+        nome_dest, documento, chave, pdf, erro = resultado
+        if nome_dest is None:
+            if erro:
+                erros += 1
+                logger.error(f"❌ Erro ao renderizar {nome_arquivo}: {erro}")
+            return
+        if chave in vistas:
+            return
+        vistas.add(chave)
+
+        pasta = os.path.join(pasta_destino, "DANFE-XML", f"{nome_dest} - {documento}")
+        os.makedirs(pasta, exist_ok=True)
+        with open(os.path.join(pasta, f"{chave}.xml"), "wb") as f:
+            f.write(conteudo)
+        if pdf is None:
+            erros += 1
+            logger.error(f"❌ Erro ao renderizar {nome_arquivo}: {erro}")
+            return
+        with open(os.path.join(pasta, f"{chave}.pdf"), "wb") as f:
+            f.write(pdf)
+        convertidas.add(chave)
+
+    pendentes = deque()
+    feitos = 0
+
+    def entregar():
+        nonlocal feitos
+        nome_arquivo, conteudo, futuro = pendentes.popleft()
+        gravar(nome_arquivo, conteudo, futuro.result())
+        feitos += 1
+        progresso_arquivo(nome, "renderizando", feitos, total)
+        if total and (feitos % 50 == 0 or feitos == total):
+            atualizar_status("PROCESSANDO", f"Renderizando {nome}: {100 * feitos // total}%")
+
+    try:
+        with zipfile.ZipFile(caminho_envio, "r") as zip_ref:
+            nomes = [info.filename.lower() for info in zip_ref.infolist() if not info.is_dir()]
+            # Com compactados internos o total só é conhecido ao abri-los
+            aninhados = any(nome_membro.endswith((".zip", ".rar")) for nome_membro in nomes)
+            total = None if aninhados else sum(nome_membro.endswith(".xml") for nome_membro in nomes)
+
+            # Poucos XMLs em andamento por vez: o ZIP não é carregado inteiro na memória
+            for caminho, conteudo in iterar_membros(zip_ref):
+                if not caminho.lower().endswith(".xml"):
+                    raise Exception(f"Compactado interno só pode ser lido pelo servidor: {caminho}")
+                pendentes.append((caminho, conteudo, pool.submit(renderizar_xml, conteudo, caminho)))
+                if len(pendentes) >= PROCESSOS_LOCAIS * 4:
+                    entregar()
+            while pendentes:
+                entregar()
+    except BrokenProcessPool:
+        descartar_pool_local(pool)
+        raise
+
+    registrar_chaves_convertidas(pasta_destino, convertidas)
+    logger.info(f"✅ Renderização local concluída: {len(convertidas)} processados, {erros} erros")
+    return len(convertidas)
+
+
+class SeletorRenderizacao:
+    """
+    Escolhe onde cada arquivo é convertido. servidor e local fixam o caminho (o
+    local usa o servidor como reserva). auto mede as NF-e por segundo de cada
+    caminho, do envio até a extração (média móvel), e prefere o mais rápido,
+    medindo de novo o mais lento a cada REAVALIAR_A_CADA conversões; uma falha
+    zera a medida do caminho e o arquivo segue pelo outro.
+    """
+
+    def __init__(self, modo):
+        self.modo = modo
+        self.lock = threading.Lock()
+        self.vazao = {}
+        self.conversoes = 0
+
+    def caminhos(self):
+        """Caminhos a tentar para o próximo arquivo, em ordem de preferência"""
+        if self.modo == "servidor":
+            return ["servidor"]
+        if self.modo == "local":
+            return ["local", "servidor"]
+
+        with self.lock:
+            self.conversoes += 1
+            medidos = sorted(self.vazao, key=self.vazao.get, reverse=True)
+            if len(medidos) < 2:
+                # Mede primeiro o caminho que ainda não tem medida
+                preferido = "servidor" if "local" in medidos else "local"
+            elif self.conversoes % REAVALIAR_A_CADA == 0:
+                preferido = medidos[-1]
+            else:
+                preferido = medidos[0]
+        return [preferido, "servidor" if preferido == "local" else "local"]
+
+    def registrar(self, caminho, notas, segundos):
+        if not notas or segundos <= 0:
+            return
+        with self.lock:
+            vazao = notas / segundos
+            anterior = self.vazao.get(caminho)
+            self.vazao[caminho] = vazao if not anterior else 0.7 * anterior + 0.3 * vazao
+            logger.debug(f"📈 Vazão {caminho}: {vazao:.1f} NF-e/s (média {self.vazao[caminho]:.1f})")
+
+    def registrar_falha(self, caminho):
+        with self.lock:
+            self.vazao[caminho] = 0
+
+
+seletor_renderizacao = SeletorRenderizacao(MODO_RENDER)
+
+# ============================
+# CONVERSÃO
+# ============================
 
 def processar_zip(caminho_zip):
     nome = os.path.basename(caminho_zip)
@@ -110,6 +913,62 @@ def processar_zip(caminho_zip):
     pasta_destino = os.path.join(PASTA_SAIDA, referencia)
     os.makedirs(pasta_destino, exist_ok=True)
 
+    with trava_referencia(referencia):
+        caminho_envio = caminho_zip
+        assinatura = assinatura_upload(caminho_zip)
+        if FILTRAR_ENVIO:
+            progresso_arquivo(nome, "filtrando")
+            caminho_envio, novas = preparar_envio(caminho_zip, pasta_destino, carregar_chaves_convertidas(pasta_destino))
+            if caminho_envio not in (None, caminho_zip):
+                assinatura = assinatura_upload(caminho_zip, novas)
+
+        if caminho_envio is None:
+            logger.info(f"⏭ Nenhuma NF-e nova em {nome}, envio dispensado")
+            os.remove(caminho_zip)
+            logger.info("🗑️ Arquivo original removido")
+            progresso_arquivo(nome, "dispensado")
+            atualizar_status("CONCLUÍDO", f"Nenhuma nota nova para {referencia}")
+            return
+
+        try:
+            converter_zip(caminho_zip, caminho_envio, nome, referencia, pasta_destino, assinatura)
+        finally:
+            if caminho_envio != caminho_zip and os.path.exists(caminho_envio):
+                os.remove(caminho_envio)
+
+
+def converter_zip(caminho_zip, caminho_envio, nome, referencia, pasta_destino, assinatura):
+    """Converte caminho_envio no servidor ou localmente (ver SeletorRenderizacao) e remove o original"""
+    caminhos = seletor_renderizacao.caminhos()
+    for tentativa, caminho in enumerate(caminhos, 1):
+        inicio = time.time()
+        try:
+            if caminho == "local":
+                convertidas = converter_localmente(caminho_envio, nome, pasta_destino)
+            else:
+                convertidas = converter_no_servidor(caminho_envio, nome, pasta_destino, assinatura)
+        except Exception as e:
+            seletor_renderizacao.registrar_falha(caminho)
+            if tentativa == len(caminhos):
+                raise
+            logger.warning(f"⚠️ Falha na conversão ({caminho}): {e}. Tentando: {caminhos[tentativa]}")
+            continue
+
+        seletor_renderizacao.registrar(caminho, convertidas, time.time() - inicio)
+        break
+
+    os.remove(caminho_zip)
+    logger.info("🗑️ Arquivo original removido")
+
+    progresso_arquivo(nome, "concluido")
+    atualizar_status("CONCLUÍDO", f"Processamento concluído para {referencia}")
+
+
+def converter_no_servidor(caminho_envio, nome, pasta_destino, assinatura):
+    """
+    Envia caminho_envio (retomando o upload salvo sob assinatura), aguarda o job e
+    extrai o resultado em pasta_destino; retorna quantas NF-e foram convertidas
+    """
     # ===============================
     # ENVIO PARA API
     # ===============================
@@ -117,40 +976,23 @@ def processar_zip(caminho_zip):
 
     logger.info("📤 Enviando para API...")
 
-    with open(caminho_zip, "rb") as f:
-        response = requests.post(
-            API_URL,
-            headers=HEADERS,
-            files={"arquivo": (nome, f, "application/zip")},
-            timeout=600
-        )
-
-    logger.info(f"📡 Status HTTP: {response.status_code}")
-    logger.debug(f"📨 Resposta: {response.text}")
-
-    if response.status_code != 200:
-        raise Exception("API retornou erro")
-
-    dados = response.json()
-    zip_saida = dados.get("arquivo_zip")
+    job_id = enviar_em_partes(caminho_envio, nome, assinatura)
+    if job_id is None:
+        logger.info("ℹ️ Servidor sem upload em partes, enviando o arquivo inteiro")
+        job_id = enviar_job(caminho_envio, nome)
+    logger.info(f"🆔 Job criado: {job_id}")
 
-    if not zip_saida:
-        raise Exception("Resposta da API inválida")
+    dados = aguardar_job(job_id, nome)
+    logger.info(f"✅ Job concluído: {dados.get('total_processados')} processados, {dados.get('total_erros')} erros")
 
     # ===============================
     # DOWNLOAD DO ZIP FINAL
     # ===============================
-    logger.info(f"📥 Baixando ZIP final: {zip_saida}")
-
-    resp_zip = requests.get(
-        f"{API_DOWNLOAD}/{zip_saida}",
-        timeout=600
-    )
-
-    zip_local = os.path.join(pasta_destino, "DANFE-XML.zip")
+    logger.info(f"📥 Baixando ZIP final: {dados.get('arquivo_zip')}")
 
-    with open(zip_local, "wb") as f:
-        f.write(resp_zip.content)
+    # Um nome por job: dois arquivos da mesma referência podem estar sendo baixados juntos
+    zip_local = os.path.join(pasta_destino, f"DANFE-XML_{job_id}.zip")
+    baixar_arquivo(f"{API_BASE}/jobs/{job_id}/result", zip_local, nome)
 
     logger.info(f"💾 ZIP salvo em: {zip_local}")
 
@@ -160,45 +1002,176 @@ def processar_zip(caminho_zip):
     logger.info("📂 Extraindo XMLs e DANFEs...")
 
     with zipfile.ZipFile(zip_local, "r") as zip_ref:
-        zip_ref.extractall(pasta_destino)
+        membros = zip_ref.infolist()
+        for i, membro in enumerate(membros, 1):
+            zip_ref.extract(membro, pasta_destino)
+            progresso_arquivo(nome, "extraindo", i, len(membros))
+        convertidas = chaves_do_resultado(zip_ref)
+        registrar_chaves_convertidas(pasta_destino, convertidas)
 
     # ===============================
-    # LIMPEZA TOTAL
+    # LIMPEZA
     # ===============================
     os.remove(zip_local)
-    logger.info("🗑️ DANFE-XML.zip removido")
+    logger.info(f"🗑️ {os.path.basename(zip_local)} removido")
 
-    os.remove(caminho_zip)
-    logger.info("🗑️ Arquivo original removido")
-
-    atualizar_status("CONCLUÍDO", f"Processamento concluído para {referencia}")
+    return len(convertidas)
 
 # ============================
-# WATCHDOG
+# FILA DE TRABALHO
 # ============================
 
-class MonitorHandler(FileSystemEventHandler):
-    def on_created(self, event):
-        if event.is_directory:
-            return
+def arquivo_monitorado(caminho):
+    nome = os.path.basename(caminho).lower()
+    return nome.startswith("arquivos-") and nome.endswith(".zip")
 
-        caminho = event.src_path
-        nome = os.path.basename(caminho).lower()
 
-        if not nome.startswith("arquivos-") or not nome.endswith(".zip"):
-            logger.debug(f"⏭ Ignorado: {nome}")
-            return
+def assinatura_arquivo(caminho):
+    """(tamanho, mtime) do arquivo, ou None se ele não existir mais"""
+    try:
+        info = os.stat(caminho)
+    except OSError:
+        return None
+    return info.st_size, info.st_mtime_ns
+
 
-        logger.info(f"📥 Novo arquivo detectado: {caminho}")
+class FilaArquivos:
+    """
+    Recebe os eventos do watchdog sem bloquear a thread do observer.
+    Cada evento do arquivo reinicia um timer de ESTABILIDADE_SEGUNDOS; quando
+    ele dispara com tamanho/mtime iguais e um ZIP íntegro (o diretório central
+    só existe com a cópia completa), o arquivo vai para um pool de até
+    MAX_SIMULTANEOS processamentos ao mesmo tempo. Um arquivo parado que
+    continua sem ser ZIP é descartado com erro após VERIFICACOES_ZIP_INVALIDO
+    verificações (volta para a fila se for modificado).
+    """
 
-        if not aguardar_copia(caminho):
-            logger.error("❌ Timeout ao aguardar cópia")
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timers = {}
+        self.em_processamento = set()
+        self.ativos = 0
+        self.ultima_fila = None
+        self.executor = ThreadPoolExecutor(max_workers=MAX_SIMULTANEOS, thread_name_prefix="processamento")
+
+    def notificar(self, caminho):
+        caminho = os.path.abspath(caminho)
+        if not arquivo_monitorado(caminho):
+            logger.debug(f"⏭ Ignorado: {os.path.basename(caminho)}")
             return
 
+        with self.lock:
+            if caminho in self.em_processamento:
+                return
+            timer = self.timers.pop(caminho, None)
+            if timer:
+                timer.cancel()
+            else:
+                logger.info(f"📥 Novo arquivo detectado: {caminho}")
+            self._agendar(caminho, assinatura_arquivo(caminho))
+            self._publicar()
+
+    def _publicar(self):
+        """Profundidade da fila para o canal de status, só quando muda (chamado com self.lock)"""
+        fila = {
+            "copiando": len(self.timers),
+            "na_fila": len(self.em_processamento) - self.ativos,
+            "processando": self.ativos,
+        }
+        if fila != self.ultima_fila:
+            self.ultima_fila = fila
+            canal_status.publicar({"tipo": "fila", "fila": fila})
+
+    def _agendar(self, caminho, assinatura, estaveis=0):
+        timer = threading.Timer(ESTABILIDADE_SEGUNDOS, self._verificar, (caminho, assinatura, estaveis))
+        timer.daemon = True
+        self.timers[caminho] = timer
+        timer.start()
+
+    def _verificar(self, caminho, assinatura, estaveis):
+        atual = assinatura_arquivo(caminho)
+        parado = atual == assinatura and atual is not None
+        completo = parado and zipfile.is_zipfile(caminho)
+
+        with self.lock:
+            # Outro evento chegou e reagendou a verificação
+            if self.timers.get(caminho) is not threading.current_thread():
+                return
+            del self.timers[caminho]
+
+            if atual is None:
+                logger.debug(f"⏭ Arquivo removido antes de ser processado: {caminho}")
+                self._publicar()
+                return
+            if parado and not completo and estaveis + 1 >= VERIFICACOES_ZIP_INVALIDO:
+                logger.error(f"❌ Arquivo não é um ZIP válido ou está corrompido: {caminho}")
+                self._publicar()
+                progresso_arquivo(os.path.basename(caminho), "erro")
+                atualizar_status("ERRO", f"ZIP inválido: {os.path.basename(caminho)}")
+                return
+            if not completo:
+                # Ainda sendo copiado (compartilhamentos de rede nem sempre geram eventos)
+                self._agendar(caminho, atual, estaveis + 1 if parado else 0)
+                return
+            self.em_processamento.add(caminho)
+            self._publicar()
+
+        logger.debug(f"📋 Na fila de processamento: {os.path.basename(caminho)}")
+        progresso_arquivo(os.path.basename(caminho), "fila")
+        self.executor.submit(self._processar, caminho)
+
+    def _processar(self, caminho):
+        with self.lock:
+            self.ativos += 1
+            self._publicar()
         try:
             processar_zip(caminho)
         except Exception as e:
-            logger.exception(f"❌ Erro ao processar {nome}: {e}")
+            logger.exception(f"❌ Erro ao processar {os.path.basename(caminho)}: {e}")
+            progresso_arquivo(os.path.basename(caminho), "erro")
+        finally:
+            with self.lock:
+                self.ativos -= 1
+                self.em_processamento.discard(caminho)
+                self._publicar()
+
+    def varrer_pasta(self):
+        """Enfileira os arquivos que chegaram enquanto o agente estava parado"""
+        for nome in sorted(os.listdir(PASTA_MONITORADA)):
+            caminho = os.path.join(PASTA_MONITORADA, nome)
+            if os.path.isfile(caminho):
+                self.notificar(caminho)
+
+    def encerrar(self):
+        with self.lock:
+            for timer in self.timers.values():
+                timer.cancel()
+            self.timers.clear()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+# ============================
+# WATCHDOG
+# ============================
+
+class MonitorHandler(FileSystemEventHandler):
+    """Só repassa os eventos para a fila: nenhuma espera ou processamento na thread do observer"""
+
+    def __init__(self, fila):
+        super().__init__()
+        self.fila = fila
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self.fila.notificar(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.fila.notificar(event.src_path)
+
+    def on_moved(self, event):
+        # Downloads e cópias que gravam com nome temporário e renomeiam no fim
+        if not event.is_directory:
+            self.fila.notificar(event.dest_path)
 
 
 # ============================
@@ -206,18 +1179,38 @@ class MonitorHandler(FileSystemEventHandler):
 # ============================
 
 if __name__ == "__main__":
+    # Processos do pool local no EXE (PyInstaller)
+    multiprocessing.freeze_support()
+
+    if MODO_RENDER not in MODOS_RENDER:
+        raise ValueError(f"❌ modo_render inválido: {MODO_RENDER} (use {', '.join(MODOS_RENDER)})")
+    if MODO_RENDER != "servidor" and not RENDER_LOCAL_DISPONIVEL:
+        logger.warning("⚠️ brazilfiscalreport não instalado: renderização local desativada, usando o servidor")
+        seletor_renderizacao.modo = "servidor"
+    elif MODO_RENDER != "servidor" and PARAMETROS_PDF["pdf"] != "individual":
+        logger.warning(f"⚠️ modo_pdf {PARAMETROS_PDF['pdf']} só é gerado pelo servidor: renderização local desativada")
+        seletor_renderizacao.modo = "servidor"
+
     logger.info("🚀 Agente DANFE iniciado")
     logger.info(f"📁 Monitorando: {PASTA_MONITORADA}")
     logger.info(f"🔐 CNPJ configurado: {CNPJ}")
+    logger.info(f"⚙️ Processamentos simultâneos: {MAX_SIMULTANEOS}")
+    logger.info(f"🖨️ Renderização: {seletor_renderizacao.modo}")
+
+    canal_status.iniciar()
+    atualizar_status("AGUARDANDO", f"Monitorando {PASTA_MONITORADA}")
 
+    fila = FilaArquivos()
     observer = Observer()
-    observer.schedule(MonitorHandler(), PASTA_MONITORADA, recursive=False)
+    observer.schedule(MonitorHandler(fila), PASTA_MONITORADA, recursive=False)
     observer.start()
+    fila.varrer_pasta()
 
     try:
         while True:
             time.sleep(1)
     except KeyboardInterrupt:
         observer.stop()
+        fila.encerrar()
 
     observer.join()
@@ -1,35 +1,154 @@
 import json
-import time
 import os
+import socket
+import sys
+import threading
+import configparser
 import tkinter as tk
+from tkinter import ttk
 
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+if getattr(sys, "frozen", False):
+    BASE_DIR = os.path.dirname(sys.executable)
+else:
+    BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 STATUS_FILE = os.path.join(BASE_DIR, "status.json")
 
+config = configparser.ConfigParser()
+config.read(os.path.join(BASE_DIR, "config.ini"), encoding="utf-8")
+PORTA_STATUS = config.getint("AGENTE", "porta_status", fallback=48765)
+
+ETAPAS = {
+    "fila": "Na fila",
+    "filtrando": "Filtrando notas",
+    "enviando": "Enviando",
+    "processando": "Processando",
+    "renderizando": "Renderizando localmente",
+    "baixando": "Baixando",
+    "extraindo": "Extraindo",
+}
+# Etapas em que feitos/total são bytes (as demais contam XMLs/arquivos)
+ETAPAS_BYTES = ("enviando", "baixando")
+
 def ler_status():
-    if not os.path.exists(STATUS_FILE):
+    """Último status gravado em disco (usado enquanto o canal do agente não responde)"""
+    try:
+        with open(STATUS_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+            return data["status"], data["detalhe"]
+    except (OSError, ValueError, KeyError):
         return "INICIANDO", ""
 
-    with open(STATUS_FILE, "r", encoding="utf-8") as f:
-        data = json.load(f)
-        return data["status"], data["detalhe"]
+def mb(valor):
+    return f"{valor / 1048576:.1f} MB"
+
+def descrever(evento):
+    etapa = evento["etapa"]
+    feitos, total = evento["feitos"], evento["total"]
+    texto = f"{evento['arquivo']} - {ETAPAS.get(etapa, etapa)}"
+    if etapa in ETAPAS_BYTES:
+        texto += f": {mb(feitos)}" + (f" / {mb(total)}" if total else "")
+        if evento["por_segundo"]:
+            texto += f" ({mb(evento['por_segundo'])}/s)"
+    elif total:
+        texto += f": {feitos}/{total}"
+        if evento["por_segundo"]:
+            texto += f" ({evento['por_segundo']}/s)"
+    return texto
+
+# ============================
+# EVENTOS DO AGENTE
+# ============================
 
-def atualizar():
+def escutar_agente():
+    """
+    Thread de leitura: conecta no canal de status do agente e repassa cada
+    evento para a thread da interface. Sem agente, tenta de novo a cada 2 s.
+    """
+    while True:
+        try:
+            with socket.create_connection(("127.0.0.1", PORTA_STATUS), timeout=2) as conexao:
+                conexao.settimeout(None)
+                for linha in conexao.makefile("r", encoding="utf-8"):
+                    evento = json.loads(linha)
+                    root.after(0, aplicar_evento, evento)
+        except (OSError, ValueError):
+            pass
+        root.after(0, agente_desconectado)
+        threading.Event().wait(2)
+
+def agente_desconectado():
     status, detalhe = ler_status()
-    lbl_status.config(text=f"Status: {status}")
-    lbl_detalhe.config(text=f"Detalhe: {detalhe}")
-    root.after(1000, atualizar)
+    aplicar_evento({"tipo": "snapshot", "status": status, "detalhe": f"{detalhe} (agente sem conexão)",
+                    "fila": None, "arquivos": {}})
+
+def aplicar_evento(evento):
+    tipo = evento["tipo"]
+    if tipo in ("snapshot", "status"):
+        lbl_status.config(text=f"Status: {evento['status']}")
+        lbl_detalhe.config(text=f"Detalhe: {evento['detalhe']}")
+    if tipo in ("snapshot", "fila"):
+        fila = evento["fila"]
+        lbl_fila.config(text=(
+            f"Copiando: {fila['copiando']}  |  Na fila: {fila['na_fila']}  |  Processando: {fila['processando']}"
+            if fila else ""
+        ))
+    if tipo == "snapshot":
+        for nome in list(barras):
+            remover_arquivo(nome)
+        for arquivo in evento["arquivos"].values():
+            atualizar_arquivo(arquivo)
+    elif tipo == "arquivo":
+        if evento["etapa"] in ETAPAS:
+            atualizar_arquivo(evento)
+        else:
+            remover_arquivo(evento["arquivo"])
+
+# ============================
+# PROGRESSO POR ARQUIVO
+# ============================
+
+barras = {}
+
+def atualizar_arquivo(evento):
+    nome = evento["arquivo"]
+    if nome not in barras:
+        quadro = tk.Frame(frm_arquivos)
+        quadro.pack(fill="x", pady=4)
+        rotulo = tk.Label(quadro, anchor="w", font=("Segoe UI", 9))
+        rotulo.pack(fill="x")
+        barra = ttk.Progressbar(quadro, maximum=100)
+        barra.pack(fill="x")
+        barras[nome] = (quadro, rotulo, barra)
+
+    _, rotulo, barra = barras[nome]
+    rotulo.config(text=descrever(evento))
+    if evento["total"]:
+        barra.stop()
+        barra.config(mode="determinate", value=100 * evento["feitos"] / evento["total"])
+    elif str(barra.cget("mode")) != "indeterminate":
+        barra.config(mode="indeterminate")
+        barra.start(20)
+
+def remover_arquivo(nome):
+    if nome in barras:
+        barras.pop(nome)[0].destroy()
 
 root = tk.Tk()
 root.title("Agente DANFE - Status")
-root.geometry("400x150")
-root.resizable(False, False)
+root.geometry("520x320")
+root.minsize(400, 200)
 
 lbl_status = tk.Label(root, text="Status:", font=("Segoe UI", 14))
 lbl_status.pack(pady=10)
 
-lbl_detalhe = tk.Label(root, text="", font=("Segoe UI", 10))
+lbl_detalhe = tk.Label(root, text="", font=("Segoe UI", 10), wraplength=480)
 lbl_detalhe.pack()
 
-atualizar()
+lbl_fila = tk.Label(root, text="", font=("Segoe UI", 9))
+lbl_fila.pack(pady=5)
+
+frm_arquivos = tk.Frame(root)
+frm_arquivos.pack(fill="both", expand=True, padx=10)
+
+threading.Thread(target=escutar_agente, daemon=True).start()
 root.mainloop()
@@ -0,0 +1,39 @@
+import io
+import os
+import sys
+import zipfile
+from types import SimpleNamespace
+
+from pypdf import PdfReader, PdfWriter
+
+os.environ.setdefault('RENDER_AUTOTESTE', '0')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+def pdf_de_uma_pagina(largura):
+    """PDF com uma página em branco; a largura identifica a nota de origem"""
+    writer = PdfWriter()
+    writer.add_blank_page(width=largura, height=100)
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+def test_destinatarios_intercalados_nao_misturam_pdfs(tmp_path):
+    saida = SimpleNamespace(modo='destinatario', sumario=False)
+    unificado = app.PDFUnificado(str(tmp_path / '_pdfs'), saida)
+
+    for indice in range(6):
+        nome, documento = ('ALFA', '111') if indice % 2 == 0 else ('BETA', '222')
+        doc = SimpleNamespace(nome=nome, documento=documento, chave=f'{indice:044d}')
+        unificado.adicionar(doc, pdf_de_uma_pagina(100 + indice))
+
+    with zipfile.ZipFile(tmp_path / 'resultado.zip', 'w') as zipf:
+        unificado.gravar(zipf)
+
+    with zipfile.ZipFile(tmp_path / 'resultado.zip') as zipf:
+        for destinatario, larguras in (('ALFA - 111', [100, 102, 104]), ('BETA - 222', [101, 103, 105])):
+            leitor = PdfReader(io.BytesIO(zipf.read(f'DANFE-XML/{destinatario}/DANFE.pdf')))
+            assert [int(pagina.mediabox.width) for pagina in leitor.pages] == larguras